@@ -68,8 +68,8 @@ def calc_dists(collection, path, i):
     try:
         geo = treeCl.DistanceMatrix.from_csv(os.path.join(cache_dir, 'geo.csv.gz'))
     except:
-        geo = collection.get_inter_tree_distances('geo')
-        geo.to_csv(os.path.join(cache_dir, 'geo.csv.gz'))
+        # Resumes from geo.npy if a previous run was interrupted
+        geo = collection.get_inter_tree_distances('geo', checkpoint=os.path.join(cache_dir, 'geo.npy'))
     return geo
 
 def cluster(dm, path, index, nclust):
@@ -37,8 +37,9 @@ def calc_dists(collection, path, jobhandler):
     try:
         geo = treeCl.DistanceMatrix.from_csv(os.path.join(cache_dir, 'geo.csv.gz'))
     except:
-        geo = collection.get_inter_tree_distances('geo', jobhandler=jobhandler)
-        geo.to_csv(os.path.join(cache_dir, 'geo.csv.gz'))
+        # Resumes from geo.npy if a previous run was interrupted
+        geo = collection.get_inter_tree_distances('geo', jobhandler=jobhandler,
+                                                  checkpoint=os.path.join(cache_dir, 'geo.npy'))
     return geo
 
 def get_jobhandler(nthreads):
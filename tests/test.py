@@ -26,6 +26,96 @@ class AlignmentTests(unittest.TestCase):
         expected = ['Sp1', 'Sp2', 'Sp3', 'Sp4', 'Sp5']
         self.assertListEqual(expected, al.get_names())
 
+    def test_array_backend(self):
+        filename = os.path.join(thisdir, 'data', 'mini', 'class1_1.phy')
+        al = Alignment(filename, 'phylip')
+        arr = Alignment(filename, 'phylip', backend='array')
+        self.assertEqual(arr.backend, 'array')
+        self.assertEqual(al.get_sequences(), arr.get_sequences())
+        self.assertEqual(al.get_sites(), arr.get_sites())
+        self.assertEqual(arr.get_array().shape, (5, len(al)))
+        conc = Alignment([arr, arr.take(names=['Sp1', 'Sp3'], sites=slice(0, 10))])
+        self.assertEqual(len(conc), len(al) + 10)
+        self.assertEqual(dict(conc.get_sequences())['Sp2'][-10:], 'X' * 10)
+
+    def test_site_patterns(self):
+        filename = os.path.join(thisdir, 'data', 'class1_1.phy')
+        al = Alignment(filename, 'phylip')
+        patterns, weights = al.get_site_patterns()
+        self.assertEqual(weights.sum(), len(al))
+        self.assertEqual(len(set(patterns.get_sites())), len(patterns))
+        sites = al.get_sites()
+        self.assertEqual(dict(zip(patterns.get_sites(), weights)), dict((s, sites.count(s)) for s in set(sites)))
+
+    def test_pairdists_matches_brent(self):
+        import numpy as np
+        import phylo_utils.likelihood
+        from phylo_utils.models import LG
+        from phylo_utils.markov import TransitionMatrix
+        from treeCl.alignment import brent_optimise
+        al = Alignment(os.path.join(thisdir, 'data', 'class1_1.phy'), 'phylip')
+        dm, vm = al.compute_distances(LG())
+        patterns, weights = al.get_site_patterns()
+        partials = treeCl.utils.alignment_to_partials(patterns)
+        nodes = [phylo_utils.likelihood.LnlModel(TransitionMatrix(LG())) for _ in range(2)]
+        for node, name in zip(nodes, al.get_names()):
+            node.set_partials(partials[name])
+        brlen, var = brent_optimise(nodes[0], nodes[1], weights=weights)
+        self.assertAlmostEqual(dm.values[0, 1], brlen, places=4)
+        self.assertAlmostEqual(vm.values[0, 1], var, places=4)
+
+    def test_pairdists_jobhandler(self):
+        import numpy as np
+        from phylo_utils.models import LG
+        import treeCl.alignment
+        al = Alignment(os.path.join(thisdir, 'data', 'class1_1.phy'), 'phylip')
+        dm, vm = treeCl.alignment.pairdists(al, LG())
+        blocksize = treeCl.alignment.PAIRDISTS_BLOCK_ELEMENTS
+        treeCl.alignment.PAIRDISTS_BLOCK_ELEMENTS = 1  # one pair per block
+        try:
+            for handler in (treeCl.parutils.SharedProcesspoolJobHandler(2),
+                            treeCl.parutils.ProcesspoolJobHandler(2)):
+                with handler:
+                    dm2, vm2 = treeCl.alignment.pairdists(al, LG(), jobhandler=handler)
+                self.assertTrue(np.allclose(dm.values, dm2.values))
+                self.assertTrue(np.allclose(vm.values, vm2.values))
+            self.assertEqual(treeCl.parutils._shared_store, {})
+        finally:
+            treeCl.alignment.PAIRDISTS_BLOCK_ELEMENTS = blocksize
+
+    def test_replicate_generator(self):
+        from treeCl.alignment import ReplicateGenerator
+        al = Alignment(os.path.join(thisdir, 'data', 'class1_1.phy'), 'phylip')
+        gen = ReplicateGenerator(al, random_state=1)
+        boot = gen.bootstrap()
+        self.assertEqual(len(boot), len(al))
+        self.assertEqual(boot.get_sites(), sorted(boot.get_sites()))
+        self.assertTrue(set(boot.get_sites()) <= set(al.get_sites()))
+        perm = next(gen.replicates(1, 'permutation'))
+        self.assertEqual(sorted(perm.get_sites()), sorted(al.get_sites()))
+        with treeCl.utils.fileIO.TempFile() as tmp:
+            gen.write_phylip([tmp], 'permutation')
+            self.assertEqual(sorted(Alignment(tmp, 'phylip').get_sites()), sorted(al.get_sites()))
+
+    def test_sniff_phylip_layout(self):
+        from treeCl.alignment import sniff_phylip_layout
+        sequential = '2 12\nA         ACGTAC\nGTACGT\nB         ACGTAC\nGTACGA\n'
+        interleaved = '2 12\nA  ACGTAC\nB  ACGTAC\n\nGTACGT\nGTACGA\n'
+        self.assertEqual(sniff_phylip_layout(sequential), 'sequential')
+        self.assertEqual(sniff_phylip_layout(interleaved), 'interleaved')
+
+    def test_alignment_input(self):
+        from treeCl.tasks import PhylipData, alignment_input, _scratch_alignment
+        phy = os.path.join(thisdir, 'data', 'mini', 'class1_1.phy')
+        self.assertEqual(alignment_input(Alignment(phy, 'phylip')), os.path.abspath(phy))
+        al = Alignment(os.path.join(thisdir, 'data', 'mini', 'class1_1.fas'), 'fasta')
+        data = alignment_input(al)
+        self.assertIsInstance(data, PhylipData)
+        filename, in_scratch = _scratch_alignment(data)
+        self.assertTrue(in_scratch)
+        self.assertEqual(Alignment(filename, 'phylip').get_sequences(), al.get_sequences())
+        os.remove(filename)
+
     def test_read_fasta_file(self):
         filename = os.path.join(thisdir, 'data', 'mini', 'class1_1.fas')
         al = Alignment(filename, 'fasta')
@@ -128,6 +218,44 @@ class CollectionTests(unittest.TestCase):
         self.assertEqual(rec.parameters.nj_tree[:72],
                          '((((Sp1:1.47856,(Sp4:1.20999,((Sp8:0.00595845,Sp9:0.00469589):0.27853,Sp')
 
+    def test_parameter_store(self):
+        import json
+        import numpy as np
+        self.c.read_parameters(os.path.join(thisdir, 'data', 'cache'))
+        with treeCl.utils.fileIO.TempFile() as tmp:
+            self.c.write_parameter_store(tmp)
+            c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'), param_dir=tmp,
+                                  file_format='phylip', show_progress=False)
+            for rec, orig in zip(c, self.c):
+                self.assertEqual(rec.parameters.nj_tree, orig.parameters.nj_tree)
+                self.assertEqual(rec.parameters.partitions.alpha, orig.parameters.partitions.alpha)
+                self.assertTrue(np.allclose(rec.parameters.partitions.distances,
+                                            orig.parameters.partitions.distances))
+            # JSON export still works when the matrices are memory-mapped arrays
+            from six import StringIO
+            buf = StringIO()
+            c[0].parameters.write(buf)
+            self.assertEqual(json.loads(buf.getvalue())['partitions']['0']['variances'],
+                             self.c[0].parameters.partitions.variances)
+
+    def test_parameter_store_rewrite_in_place(self):
+        import numpy as np
+        from treeCl.parameters import ParameterStore
+        self.c.read_parameters(os.path.join(thisdir, 'data', 'cache'))
+        with treeCl.utils.fileIO.TempFile() as tmp:
+            self.c.write_parameter_store(tmp)
+            # records now hold memory-mapped views of tmp while it is rewritten
+            self.c.read_parameter_store(tmp)
+            self.c.write_parameter_store(tmp)
+            store = ParameterStore(tmp)
+            ParameterStore.write(tmp, [(name, store[name]) for name in store.names()])
+            c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'), param_dir=tmp,
+                                  file_format='phylip', show_progress=False)
+            for rec, orig in zip(c, self.c):
+                self.assertEqual(rec.parameters.nj_tree, orig.parameters.nj_tree)
+                self.assertTrue(np.allclose(rec.parameters.partitions.distances,
+                                            orig.parameters.partitions.distances))
+
     def test_read_trees(self):
         self.c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'),
                                    trees_dir=os.path.join(thisdir, 'data', 'trees'),
@@ -138,6 +266,78 @@ class CollectionTests(unittest.TestCase):
                          '((((Sp1:1.48316688535948748573,(Sp4:1.16694627918414717271,((Sp8:0.00749')
 
 
+    def test_concatenation_in_memory(self):
+        from treeCl.utils import concatenate
+        al = self.c.concatenate([0, 3, 7]).alignment
+        expected = concatenate([self.c[i].to_biopython_msa() for i in (0, 3, 7)])
+        self.assertEqual(sorted(al.get_sequences()), sorted((sr.id, str(sr.seq)) for sr in expected))
+        with treeCl.utils.fileIO.TempFile() as tmp:
+            al.write_alignment(tmp, 'phylip')
+            self.assertEqual(Alignment(tmp, 'phylip').get_sequences(), al.get_sequences())
+
+    def test_parallel_load(self):
+        from treeCl.parutils import ThreadpoolJobHandler
+        c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'), file_format='phylip',
+                              show_progress=False, jobhandler=ThreadpoolJobHandler(2))
+        self.assertEqual([rec.name for rec in c], [rec.name for rec in self.c])
+        self.assertEqual(c[7].get_sequences(), self.c[7].get_sequences())
+
+
+    def test_tree_cache(self):
+        c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'),
+                              trees_dir=os.path.join(thisdir, 'data', 'trees'),
+                              file_format='phylip', show_progress=False)
+        trees = c.parsed_trees()
+        phylotrees = c.phylotrees()
+        self.assertTrue(all(a is b for (a, b) in zip(trees, c.parsed_trees())))
+        self.assertTrue(all(a is b for (a, b) in zip(phylotrees, c.phylotrees())))
+        c[1].parameters.ml_tree = c[0].parameters.ml_tree
+        self.assertIsNot(c.parsed_trees()[1], trees[1])
+        self.assertEqual(c.parsed_trees()[1].newick, trees[0].newick)
+        self.assertIs(c.parsed_trees()[2], trees[2])
+
+    def test_permuted_copy(self):
+        perm = self.c.permuted_copy(Partition([1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3]), random_state=1)
+        self.assertEqual(perm.names, self.c.names)
+        self.assertEqual(perm.lengths, self.c.lengths)
+        original = sorted(self.c.concatenate(list(range(5))).alignment.get_sites())
+        self.assertEqual(sorted(perm.concatenate(list(range(5))).alignment.get_sites()), original)
+
+    def test_lazy_collection(self):
+        c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'), file_format='phylip',
+                              param_dir=os.path.join(thisdir, 'data', 'cache'),
+                              show_progress=False, lazy=True, cache_size=2)
+        self.assertFalse(any(rec.is_loaded() for rec in c))
+        self.assertEqual(c.names, self.c.names)
+        self.assertEqual(c[0].parameters.nj_tree[:30], '((((Sp1:1.47856,(Sp4:1.20999,(')
+        self.assertFalse(any(rec.is_loaded() for rec in c))
+        self.assertEqual(c.lengths, self.c.lengths)
+        self.assertEqual(len(c.alignment_cache), 2)
+        self.assertFalse(c[0].is_loaded())
+        self.assertEqual(c[0].get_sequences(), self.c[0].get_sequences())
+
+    def test_alignment_digest(self):
+        import hashlib
+        c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'), file_format='phylip',
+                              show_progress=False, lazy=True, cache_size=1)
+        arrays = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'), file_format='phylip',
+                                   show_progress=False, backend='array')
+        h = hashlib.sha1()
+        for name, seq in sorted(self.c[0].get_sequences()):
+            h.update('>{}\n{}\n'.format(name, seq).encode('utf-8'))
+        self.assertEqual(self.c[0].get_digest(), h.hexdigest())
+        self.assertEqual(arrays[0].get_digest(), h.hexdigest())
+        self.assertEqual(Alignment(self.c[0].get_sequences()[::-1]).get_digest(), h.hexdigest())
+        self.assertNotEqual(self.c[1].get_digest(), h.hexdigest())
+
+        # A lazy record keeps its digest after its sequences are evicted
+        self.assertEqual(c[0].get_digest(), h.hexdigest())
+        c[1].get_names()
+        self.assertFalse(c[0].is_loaded())
+        self.assertEqual(c[0].get_digest(), h.hexdigest())
+        self.assertFalse(c[0].is_loaded())
+
+
 class ScorerTests(unittest.TestCase):
 
     def setUp(self):
@@ -164,6 +364,107 @@ class ScorerTests(unittest.TestCase):
 
         self.assertTrue(len(files)>0)
 
+    def test_scorer_cleans_only_given_groups(self):
+        c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'),
+                              param_dir=os.path.join(thisdir, 'data', 'cache'),
+                              file_format='phylip',
+                              show_progress=False)
+
+        raxml = treeCl.tasks.RaxmlTaskInterface()
+        sc = treeCl.Scorer(c, cache_dir=self.workingdir, task_interface=raxml)
+        p = treeCl.Partition([0,0,0,0,0,1,1,1,1,1,2,2,2,2,2])
+        sc.write_partition(p)
+        sc.clean_groups([p[0]])
+        self.assertEqual([sc.check_work_done(grp)[0] for grp in p], [False, True, True])
+
+    def test_optimiser_maximise_updates_only_changed_groups(self):
+        import numpy as np
+        from treeCl.collection import Optimiser
+        c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'),
+                              param_dir=os.path.join(thisdir, 'data', 'cache'),
+                              file_format='phylip',
+                              show_progress=False)
+        for rec in c:
+            rec.parameters.partitions.model = 'LG'
+            rec.parameters.partitions.alpha = 1.0
+
+        raxml = treeCl.tasks.RaxmlTaskInterface()
+        sc = treeCl.Scorer(c, cache_dir=self.workingdir, task_interface=raxml)
+        analysed = []
+
+        def analyse_groups(groups, **kwargs):
+            # Stands in for RAxML: stores a result for each group it is asked to analyse
+            for grp in groups:
+                analysed.append(grp)
+                sc.index.put(sc.get_id(grp), raxml.name,
+                             {'likelihood': -100.0 * len(grp), 'ml_tree': c[grp[0]].tree,
+                              'partitions': {'0': {'model': 'LG', 'alpha': 0.5 + 0.1 * len(grp),
+                                                   'frequencies': c[0].parameters.partitions.frequencies}}})
+        sc.analyse_groups = analyse_groups
+
+        p1 = treeCl.Partition([0,0,0,0,0,1,1,1,1,1,2,2,2,2,2])
+        o = Optimiser(sc, 3, partition=p1)
+        o.maximise()
+        self.assertEqual(sorted(analysed), sorted(p1.get_membership()))
+        models = list(o.locus_models)
+
+        # Locus 4 moves from the first group to the second; the third group is unchanged
+        del analysed[:]
+        p2 = treeCl.Partition([0,0,0,0,1,1,1,1,1,1,2,2,2,2,2])
+        o.set_partition(p2)
+        self.assertEqual(sorted(o.get_dirty_groups(p2, p1)), [(0, 1, 2, 3), (4, 5, 6, 7, 8, 9)])
+        _, _, locus_lnl = o.maximise()
+        self.assertEqual(sorted(analysed), [(0, 1, 2, 3), (4, 5, 6, 7, 8, 9)])
+        for i in range(10):
+            self.assertIsNot(o.locus_models[i][1], models[i][1])
+            self.assertEqual(o.locus_models[i][0], p2[0] if i < 4 else p2[1])
+        for i in range(10, 15):
+            self.assertIs(o.locus_models[i], models[i])
+        self.assertTrue(np.isclose(locus_lnl, sum(inst.get_likelihood() for inst in o.insts)))
+
+    def test_scorer_results_persist(self):
+        c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'),
+                              param_dir=os.path.join(thisdir, 'data', 'cache'),
+                              file_format='phylip',
+                              show_progress=False)
+
+        raxml = treeCl.tasks.RaxmlTaskInterface()
+        sc = treeCl.Scorer(c, cache_dir=self.workingdir, task_interface=raxml)
+        grp = (0, 3, 5)
+        sc.index.put(sc.get_id(grp), raxml.name, {'likelihood': -100.0})
+
+        # A new scorer on the same cache dir finds the result under the same content-addressed id
+        sc2 = treeCl.Scorer(c, cache_dir=self.workingdir, task_interface=raxml)
+        self.assertEqual(sc2.get_id(grp), sc.get_id(grp))
+        self.assertNotEqual(sc2.get_id((0, 3)), sc.get_id(grp))
+        self.assertEqual(sc2.get_group_result(grp), {'likelihood': -100.0})
+        sc2.discard_group_result(grp)
+        self.assertFalse(sc2.check_work_done(grp)[1])
+
+    def test_scorer_pickles_and_shares_index_between_threads(self):
+        import pickle
+        import threading
+        c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'),
+                              param_dir=os.path.join(thisdir, 'data', 'cache'),
+                              file_format='phylip',
+                              show_progress=False)
+
+        raxml = treeCl.tasks.RaxmlTaskInterface()
+        sc = treeCl.Scorer(c, cache_dir=self.workingdir, task_interface=raxml)
+        grp = (0, 3, 5)
+        sc.index.put(sc.get_id(grp), raxml.name, {'likelihood': -100.0})
+
+        # The index reconnects to its database after unpickling
+        sc2 = pickle.loads(pickle.dumps(sc))
+        self.assertEqual(sc2.get_group_result(grp), {'likelihood': -100.0})
+
+        # and can be used from threads other than the one that created it
+        results = []
+        t = threading.Thread(target=lambda: results.append(sc.get_group_result(grp)))
+        t.start()
+        t.join()
+        self.assertEqual(results, [{'likelihood': -100.0}])
+
 
 class TreeTests(unittest.TestCase):
     def test_random_tree_default_names(self):
@@ -293,6 +594,70 @@ class TreeDistanceTests(unittest.TestCase):
         dm = self.c.get_inter_tree_distances('geo', min_overlap=5, overlap_fail_value=-1, show_progress=False)
         self.assertEquals(dm.values[0, 1], -1)
 
+    def test_intertree_tiled(self):
+        import numpy as np
+        trees = [treeCl.Tree(t) for t in self.c.trees]
+        expected = treeCl.treedist.geodist_matrix(trees, False, show_progress=False, tile_size=len(trees))
+        for metric in ['geo', 'fastgeo']:
+            dm = self.c.get_inter_tree_distances(metric, show_progress=False, tile_size=3)
+            self.assertTrue(np.allclose(dm.values, expected))
+        handler = treeCl.parutils.ProcesspoolJobHandler(2)
+        dm = self.c.get_inter_tree_distances('geo', jobhandler=handler, show_progress=False, tile_size=4)
+        self.assertTrue(np.allclose(dm.values, expected))
+
+    def test_prune_cache(self):
+        tree3 = treeCl.Tree(self.c[2].tree).prune_to_subset(set(['Sp1', 'Sp2', 'Sp3', 'Sp4', 'Sp5', 'Sp6']))
+        treeCl.treedist.prune_cache.clear()
+        d1 = treeCl.treedist.geodist(self.tree1, tree3, False)
+        d2 = treeCl.treedist.geodist(self.tree2, tree3, False)
+        self.assertEqual(len(treeCl.treedist.prune_cache), 2)
+        hits = treeCl.treedist.prune_cache.hits
+        self.assertEqual(treeCl.treedist.geodist(self.tree1, tree3, False), d1)
+        self.assertEqual(treeCl.treedist.prune_cache.hits, hits + 1)
+        self.tree2.scale(2.0)
+        self.assertNotEqual(treeCl.treedist.geodist(self.tree2, tree3, False), d2)
+
+    def test_split_index(self):
+        import numpy as np
+        self.c[0].parameters.ml_tree = treeCl.Tree(self.c[0].parameters.ml_tree).prune_to_subset(
+            set(['Sp1', 'Sp2', 'Sp3', 'Sp4', 'Sp5', 'Sp6', 'Sp7'])).newick
+        self.c[1].parameters.ml_tree = treeCl.Tree(self.c[1].parameters.ml_tree).prune_to_subset(
+            set(['Sp4', 'Sp5', 'Sp6', 'Sp7', 'Sp8', 'Sp9', 'Sp10'])).newick
+        trees = [treeCl.Tree(t) for t in self.c.trees]
+        for metric, fn in [('rf', treeCl.treedist.rfdist_matrix), ('wrf', treeCl.treedist.wrfdist_matrix)]:
+            for normalise in [False, True]:
+                expected = fn(trees, normalise, min_overlap=5, overlap_fail_value=-1, show_progress=False)
+                dm = self.c.get_inter_tree_distances(metric, normalise=normalise, min_overlap=5,
+                                                     overlap_fail_value=-1, show_progress=False)
+                self.assertTrue(np.allclose(dm.values, expected))
+                # Tiles of the index give the same distances
+                dm = self.c.get_inter_tree_distances(metric, normalise=normalise, min_overlap=5,
+                                                     overlap_fail_value=-1, show_progress=False, tile_size=4)
+                self.assertTrue(np.allclose(dm.values, expected))
+
+    def test_split_index_tiled(self):
+        import numpy as np
+        import tempfile
+        from scipy.spatial.distance import squareform
+        trees = [treeCl.Tree(t) for t in self.c.trees]
+        expected = treeCl.treedist.rfdist_matrix(trees, False, show_progress=False)
+        dm = self.c.get_inter_tree_distances('rf', show_progress=False, tile_size=3, condensed=True)
+        self.assertTrue(dm.is_condensed)
+        self.assertTrue(np.allclose(dm.condensed, squareform(expected, checks=False)))
+        handler = treeCl.parutils.ProcesspoolJobHandler(2)
+        for metric in ['rf', 'fastrf']:
+            dm = self.c.get_inter_tree_distances(metric, jobhandler=handler, show_progress=False, tile_size=4)
+            self.assertTrue(np.allclose(dm.values, expected))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(tmpdir, 'rf.npy')
+            self.c.get_inter_tree_distances('wrf', show_progress=False, tile_size=4, checkpoint=checkpoint)
+            loaded = treeCl.DistanceMatrix.load(checkpoint)
+            expected = treeCl.treedist.wrfdist_matrix(trees, False, show_progress=False)
+            self.assertTrue(np.allclose(loaded.values, expected))
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 class DistanceMatrixTests(unittest.TestCase):
     def test_from_csv(self):
@@ -317,6 +682,29 @@ class DistanceMatrixTests(unittest.TestCase):
         dm.set_names(new_names)
         self.assertListEqual(dm.get_names(), new_names)
 
+    def test_condensed(self):
+        import numpy as np
+        import tempfile
+        dm = treeCl.DistanceMatrix.from_csv(os.path.join(thisdir, 'data', 'cache', 'geo_dm.csv'))
+        condensed = dm.to_condensed(np.float32)
+        self.assertTrue(condensed.is_condensed)
+        self.assertEqual(condensed.shape, (15, 15))
+        self.assertTrue(np.allclose(condensed.row(3), dm.values[3], atol=1e-5))
+        tmpd = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpd, 'dm.npy')
+            condensed.save(filename)
+            loaded = treeCl.DistanceMatrix.load(filename)
+            self.assertIsInstance(loaded.condensed, np.memmap)
+            self.assertListEqual(loaded.get_names(), dm.get_names())
+            self.assertTrue(np.allclose(loaded.values, dm.values, atol=1e-5))
+            order = dm.get_names()[::-1]
+            self.assertTrue(np.allclose(loaded.reorder(order).values, dm.reorder(order).values, atol=1e-5))
+            self.assertEqual(treeCl.Hierarchical(loaded).cluster(3), treeCl.Hierarchical(dm).cluster(3))
+            del loaded
+        finally:
+            shutil.rmtree(tmpd)
+
     def test_calculation(self):
         c = treeCl.Collection(input_dir=os.path.join(thisdir, 'data'),
                               param_dir=os.path.join(thisdir, 'data', 'cache'),
@@ -330,6 +718,24 @@ class DistanceMatrixTests(unittest.TestCase):
         embed = dm.embedding(3, 'cmds')
         self.assertEqual(embed.shape, (15, 3))
 
+    def test_embed_cmds_truncated(self):
+        import numpy as np
+        from treeCl.distance_matrix import eigen, double_centre, _estimate_additive_constant
+        dm = treeCl.DistanceMatrix.from_csv(os.path.join(thisdir, 'data', 'cache', 'geo_dm.csv'))
+        dbc = double_centre(dm.values)
+        full = eigen(dbc)
+        for solver in ('lapack', 'arpack'):
+            top = eigen(dbc, 3, solver=solver)
+            self.assertTrue(np.allclose(top.vals, full.vals[:3]))
+            self.assertTrue(np.allclose(np.abs(top.vecs), np.abs(full.vecs[:, :3])))
+            embed = dm.embedding(3, 'cmds', additive_correct=True, solver=solver)
+            self.assertEqual(embed.shape, (15, 3))
+        coords, varexp = top.coords_by_cutoff(0.9)
+        self.assertTupleEqual(full.coords_by_cutoff(0.9)[1:], (varexp,))
+        self.assertEqual(coords.shape, full.coords_by_cutoff(0.9)[0].shape)
+        self.assertAlmostEqual(_estimate_additive_constant(dm.values, 'arpack'),
+                               _estimate_additive_constant(dm.values, 'lapack'))
+
     def test_embed_kpca(self):
         dm = treeCl.DistanceMatrix.from_csv(os.path.join(thisdir, 'data', 'cache', 'geo_dm.csv'))
         embed = dm.embedding(3, 'kpca')
@@ -370,6 +776,51 @@ class ClusteringTests(unittest.TestCase):
         p = cl.cluster(3, method=treeCl.clustering.methods.GMM)
         self.assertEqual(len(p), 3)
 
+    def test_spectral_sparse(self):
+        import numpy as np
+        options = treeCl.clustering.options
+        dense = treeCl.Spectral(self.dm, pruning_option=options.PRUNING_ESTIMATE,
+                                scale_option=options.LOCAL_SCALE_ESTIMATE)
+        sparse = treeCl.Spectral(self.dm, pruning_option=options.PRUNING_ESTIMATE,
+                                 scale_option=options.LOCAL_SCALE_ESTIMATE, sparse=True)
+        self.assertTrue(np.allclose(dense.affinity, sparse.affinity.toarray()))
+        p = sparse.cluster(3, algo=treeCl.clustering.spectral.ZELNIKMANOR)
+        self.assertEqual(len(p), 3)
+
+class LikelihoodTests(unittest.TestCase):
+    def test_batched_loglikelihoods(self):
+        import numpy as np
+        from phylo_utils.models import GTR
+        from phylo_utils.markov import TransitionMatrix
+        from phylo_utils.likcalc import discrete_gamma
+        from treeCl.likelihood import LocusBlock, tree_loglikelihoods
+        tm = TransitionMatrix(GTR([1, 2, 1, 1, 2, 1], [.1, .2, .3, .4], True))
+        newick = '((a:0.1,b:0.2):0.05,c:0.3,d:0.15);'
+        np.random.seed(1)
+        loci = [dict((name, np.eye(4)[np.random.randint(4, size=n)]) for name in 'abcd') for n in (5, 8)]
+
+        def brute_force(partials):
+            rates = discrete_gamma(0.5, 4)
+            siteliks = 0
+            for r in rates:
+                p = lambda t: tm.get_p_matrix(t * r)
+                ab = partials['a'].dot(p(0.1).T) * partials['b'].dot(p(0.2).T)
+                root = ab.dot(p(0.05).T) * partials['c'].dot(p(0.3).T) * partials['d'].dot(p(0.15).T)
+                siteliks = siteliks + root.dot(tm.freqs) / 4
+            return np.log(siteliks).sum()
+
+        block = LocusBlock(loci, tm, 0.5)
+        result = tree_loglikelihoods(newick, [block, LocusBlock(loci[:1], tm, 0.5)])
+        expected = [brute_force(loci[0]), brute_force(loci[1]), brute_force(loci[0])]
+        self.assertTrue(np.allclose(result, expected))
+
+        # Site patterns with weights give the same result
+        al = Alignment([(name, ''.join('TCAG'[k] for k in loci[1][name].argmax(1))) for name in 'abcd'])
+        patterns, weights = al.get_site_patterns()
+        compressed = LocusBlock([treeCl.utils.alignment_to_partials(patterns)], tm, 0.5, weights=[weights])
+        self.assertTrue(np.allclose(tree_loglikelihoods(newick, [compressed]), expected[1]))
+
+
 class RaxmlParserTests(unittest.TestCase):
     def setUp(self):
         self.parser = treeCl.parsers.RaxmlParser()
@@ -456,6 +907,140 @@ class ParallelTests(unittest.TestCase):
         dm = self.c.get_inter_tree_distances('geo', jobhandler=handler, show_progress=False)
         self.assertAlmostEqual(dm.df.values.sum(), 412.70677069540181)
 
+    def test_shared_processpool(self):
+        handler = treeCl.parutils.SharedProcesspoolJobHandler(2)
+        dm = self.c.get_inter_tree_distances('geo', jobhandler=handler, show_progress=False, tile_size=4)
+        self.assertAlmostEqual(dm.df.values.sum(), 412.70677069540181)
+        self.assertEqual(treeCl.parutils._shared_store, {})
+
+    def test_checkpoint(self):
+        import json
+        import tempfile
+
+        class FailingHandler(treeCl.parutils.SequentialJobHandler):
+            def imap(self, *args, **kwargs):
+                for k, result in enumerate(super(FailingHandler, self).imap(*args, **kwargs)):
+                    if k == 3:
+                        raise RuntimeError('worker died')
+                    yield result
+
+        tmpd = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpd, 'geo.npy')
+            with self.assertRaises(RuntimeError):
+                self.c.get_inter_tree_distances('geo', jobhandler=FailingHandler(), show_progress=False,
+                                                tile_size=4, checkpoint=filename)
+            with open(filename + '.manifest.json') as handle:
+                self.assertEqual(len(json.load(handle)['done']), 3)
+            handler = treeCl.parutils.ProcesspoolJobHandler(2)
+            dm = self.c.get_inter_tree_distances('geo', jobhandler=handler, show_progress=False,
+                                                 tile_size=4, checkpoint=filename)
+            self.assertAlmostEqual(dm.df.values.sum(), 412.70677069540181)
+            loaded = treeCl.DistanceMatrix.load(filename)
+            self.assertAlmostEqual(loaded.values.sum(), 412.70677069540181)
+            with self.assertRaises(ValueError):
+                self.c.get_inter_tree_distances('geo', show_progress=False, normalise=True,
+                                                tile_size=4, checkpoint=filename)
+            # Not a checkpoint: left alone
+            other = os.path.join(tmpd, 'saved.npy')
+            loaded.save(other)
+            with self.assertRaises(ValueError):
+                self.c.get_inter_tree_distances('geo', show_progress=False, tile_size=4, checkpoint=other)
+            self.assertAlmostEqual(treeCl.DistanceMatrix.load(other).values.sum(), 412.70677069540181)
+            del dm, loaded
+        finally:
+            shutil.rmtree(tmpd)
+
+    def test_extend_distances(self):
+        import numpy as np
+        from treeCl.bootstrap import OutOfSampleMDS
+        full = self.c.get_inter_tree_distances('geo', show_progress=False)
+        old_names = self.c.names[::2]
+        old = treeCl.DistanceMatrix.from_array(full.reorder(old_names).values, old_names)
+        for dm in (old, old.to_condensed()):
+            extended = self.c.extend_inter_tree_distances(dm, 'geo', show_progress=False, tile_size=4)
+            self.assertEqual(extended.is_condensed, dm.is_condensed)
+            self.assertListEqual(extended.get_names()[:len(old_names)], old_names)
+            self.assertTrue(np.allclose(extended.reorder(self.c.names).values, full.values))
+        oos = OutOfSampleMDS(old)
+        placed = oos.add_points(old.values[:2])
+        self.assertTrue(np.allclose(placed, oos.coords[:2, :3]))
+        new_rows = extended.values[len(old_names):, :len(old_names)]
+        self.assertEqual(oos.add_points(new_rows).shape, (len(self.c) - len(old_names), 3))
+
+    def test_persistent_processpool(self):
+        with treeCl.parutils.ProcesspoolJobHandler(2, persistent=True) as handler:
+            dm = self.c.get_inter_tree_distances('geo', jobhandler=handler, show_progress=False)
+            self.assertAlmostEqual(dm.df.values.sum(), 412.70677069540181)
+            workers = list(handler._pool._workers)
+            workers[0].terminate()
+            workers[0].join()
+            dm = self.c.get_inter_tree_distances('geo', jobhandler=handler, show_progress=False)
+            self.assertAlmostEqual(dm.df.values.sum(), 412.70677069540181)
+            self.assertIs(handler._pool._workers[1], workers[1])
+        self.assertFalse(handler._pool.running)
+
+    def test_costs_keep_input_order(self):
+        args = [(-i,) for i in range(20)]
+        costs = [(i * 7) % 11 for i in range(20)]
+        for handler in [treeCl.parutils.ThreadpoolJobHandler(2),
+                        treeCl.parutils.ProcesspoolJobHandler(2),
+                        treeCl.parutils.ProcesspoolJobHandler(2, persistent=True)]:
+            with handler:
+                self.assertListEqual(handler(abs, args, '', 3, costs=costs), list(range(20)))
+
+    def test_persistent_pool_keeps_workers(self):
+        import operator
+        handler = treeCl.parutils.SharedProcesspoolJobHandler(2)
+        with handler:
+            for _ in range(2):
+                dm = self.c.get_inter_tree_distances('geo', jobhandler=handler, show_progress=False, tile_size=4)
+                self.assertAlmostEqual(dm.df.values.sum(), 412.70677069540181)
+                pids = [p.pid for p in handler._pool._workers]
+                if _ == 0:
+                    first_pids = pids
+            self.assertListEqual(pids, first_pids)
+            # Changed values reach the running workers
+            for value in (1, 10):
+                ref = treeCl.parutils.share('offset', value)
+                try:
+                    result = handler(operator.add, [(ref, i) for i in range(6)], '', 1)
+                finally:
+                    treeCl.parutils.unshare('offset')
+                self.assertListEqual(result, [value + i for i in range(6)])
+            self.assertListEqual([p.pid for p in handler._pool._workers], first_pids)
+
+    def test_pool_removes_scratch(self):
+        import signal
+        import time
+        from treeCl.utils import fileIO
+        pool = treeCl.parutils.WorkerPool(2)
+        with pool:
+            paths = pool.map(fileIO.scratch_dir, [() for _ in range(6)])
+            self.assertTrue(all(os.path.isdir(path) for path in set(paths)))
+            for p in pool._workers:
+                os.kill(p.pid, signal.SIGKILL)
+            time.sleep(0.2)
+        self.assertFalse(any(os.path.exists(path) for path in set(paths)))
+
+    def test_costs_many_jobs(self):
+        # More jobs than the ordered-mode buffer holds (4 x workers x batchsize), cheapest last
+        args = [(-i,) for i in range(100)]
+        with treeCl.parutils.ProcesspoolJobHandler(2, persistent=True) as handler:
+            self.assertListEqual(handler(abs, args, '', 1, costs=list(range(100))), list(range(100)))
+
+    def test_imap_streams_arguments(self):
+        import itertools
+        for handler in [treeCl.parutils.SequentialJobHandler(),
+                        treeCl.parutils.ThreadpoolJobHandler(2),
+                        treeCl.parutils.ProcesspoolJobHandler(2, persistent=True)]:
+            with handler:
+                # An endless argument generator only works if arguments are taken as needed
+                results = handler.imap(abs, ((-i,) for i in itertools.count()), '', 2)
+                self.assertListEqual([next(results) for _ in range(10)], list(range(10)))
+                unordered = handler.imap(abs, [(-i,) for i in range(10)], '', 3, ordered=False)
+                self.assertListEqual(sorted(unordered), [(i, i) for i in range(10)])
+
 
 class MiscTests(unittest.TestCase):
     def test_binom_coeff(self):
@@ -464,6 +1049,16 @@ class MiscTests(unittest.TestCase):
         testvals = [binom_coeff(n) for n in inputs]
         self.assertListEqual(testvals, outputs)
 
+    def test_wrapper_stdin(self):
+        from treeCl.wrappers.abstract_wrapper import AbstractWrapper
+        class Cat(AbstractWrapper):
+            _default_exe = 'cat'
+            def _set_help(self):
+                self._help = ''
+        cat = Cat(verbose=False)
+        cat(wait=True, stdin='line 1\nline 2\n')
+        self.assertEqual(cat.get_stdout(), 'line 1\nline 2')
+
 
 def main():
     unittest.main()
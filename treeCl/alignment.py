@@ -5,18 +5,21 @@ from builtins import str
 from builtins import zip
 from builtins import range
 from builtins import object
-import collections
+import hashlib
 import itertools
 import io, os, random
 
 import numpy as np
 import pandas as pd
-from six import string_types
+from six import string_types, StringIO
 
 from .parameters import Parameters
 from .constants import ISPY3
-from .utils import fileIO, alignment_to_partials, concatenate, sample_wr
+from .errors import optioncheck
+from .utils import fileIO, alignment_to_partials, concatenate, LRUCache
 from .distance_matrix import DistanceMatrix
+from .likelihood import _eigen
+from . import parutils
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Align import MultipleSeqAlignment
@@ -35,6 +38,56 @@ def set_alphabet(msa, alphabet):
         seqrec.seq.alphabet = alphabet
 
 
+# Character used to pad taxa that are missing from some alignments in a concatenation,
+# matching Bio.Seq.UnknownSeq
+UNKNOWN_CHARS = {'dna': b'N', 'protein': b'X'}
+
+
+def _guess_datatype(chars):
+    """ 'dna' if the set of characters looks like nucleotides, otherwise 'protein' """
+    probably_dna = (set(chars) - set('-?X')).issubset(set(IUPAC.ambiguous_dna.letters))
+    return 'dna' if probably_dna else 'protein'
+
+
+def _sequences_to_array(sequences):
+    """ 2D uint8 array (taxa x sites) of the (ASCII) character codes of a list of equal-length strings """
+    if not sequences:
+        return np.zeros((0, 0), dtype=np.uint8)
+    nsites = len(sequences[0])
+    if any(len(seq) != nsites for seq in sequences):
+        raise ValueError('Sequences are not all the same length')
+    data = ''.join(sequences).encode('ascii')
+    return np.frombuffer(data, dtype=np.uint8).reshape(len(sequences), nsites).copy()
+
+
+def sniff_phylip_layout(text):
+    """
+    Guess the layout of PHYLIP text: 'sequential' if the sequences are split over several lines,
+    one after the other, otherwise 'interleaved' (this includes files with one line per sequence,
+    which either parser can read).
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    try:
+        ntax, nchar = [int(x) for x in lines[0].split()[:2]]
+    except (ValueError, IndexError):
+        return 'interleaved'
+    data = lines[1:]
+    if not data:
+        return 'interleaved'
+    first = data[0].split(None, 1)
+    residues = len(''.join(first[1].split())) if len(first) > 1 else 0
+    if residues >= nchar:
+        return 'interleaved'
+    # In the sequential layout the first sequence carries on over the next lines, without a name
+    nlines = 1
+    while residues < nchar and nlines < len(data):
+        residues += len(''.join(data[nlines].split()))
+        nlines += 1
+    if residues == nchar and len(data) == ntax * nlines:
+        return 'sequential'
+    return 'interleaved'
+
+
 class Alignment(object):
     def __init__(self, *args, **kwargs):
         """
@@ -46,22 +99,38 @@ class Alignment(object):
                    ...])
         Alignment(file_path, (file_format))        - read an alignment from file
         Alignment(..., alphabet=<'dna'|'protein'>) - specify the alphabet, either dna or protein
+        Alignment(..., backend=<'biopython'|'array'>)
+                                                   - storage: Biopython records (default), or a compact
+                                                     uint8 array (taxa x sites) - see get_array
         """
         self.infile = None
         self.name = None
         self.parameters = Parameters()
+        self._store = None  # Bio.Align.MultipleSeqAlignment, for the biopython backend
+        self._array = None  # uint8 array (taxa x sites), for the array backend
+        self._names = None
+        self._datatype = None
+        self._digest = None
+        backend = optioncheck(kwargs.get('backend', 'biopython'), ['biopython', 'array'])
         if len(args) == 0:
             self._msa = None
         elif isinstance(args[0], list):
             # initialise from a list of sequences or Alignments
             if all(isinstance(element, self.__class__) for element in args[0]):
                 # initialise from list of Alignment objects
-                self._msa = concatenate([al._msa for al in args[0]])
+                if backend == 'array' or all(al._array is not None for al in args[0]):
+                    self._concatenate_arrays(args[0])
+                else:
+                    self._msa = concatenate([al._msa for al in args[0]])
             elif all(isinstance(element, tuple) for element in args[0]):
                 # initialise from list of (name, sequence) tuples
-                msa = MultipleSeqAlignment([SeqRecord(Seq(sequence), id=key, description=key, name=key) 
-                                            for (key, sequence) in args[0]])
-                self._msa = self._guess_alphabet(msa)
+                if backend == 'array':
+                    names, sequences = list(zip(*args[0])) if args[0] else ([], [])
+                    self._set_array(_sequences_to_array([str(seq) for seq in sequences]), list(names))
+                else:
+                    msa = MultipleSeqAlignment([SeqRecord(Seq(sequence), id=key, description=key, name=key)
+                                                for (key, sequence) in args[0]])
+                    self._msa = self._guess_alphabet(msa)
                 if 'name' in kwargs:
                     self.name = kwargs['name']
             else:
@@ -72,12 +141,7 @@ class Alignment(object):
             self.parameters.filename = args[0]
             self.name = os.path.splitext(os.path.basename(self.infile))[0]
             if args[1]=='phylip':
-                if len(args) >= 3:
-                    if args[2]:
-                        self.read_alignment(args[0], 'phylip-relaxed')
-                    else:
-                        self.read_alignment(args[0], 'phylip-sequential')
-                self.read_alignment(args[0], 'phylip-relaxed')
+                self.read_phylip(args[0], args[2] if len(args) >= 3 else None)
             else:
                 self.read_alignment(args[0], args[1])
 
@@ -85,15 +149,105 @@ class Alignment(object):
             logger.warning('Failed to initialise alignment - couldn\'t read args as a file or interpret as sequences')
             self._msa = None
 
-        if 'alphabet' in kwargs and self._msa is not None:
+        if backend == 'array' and self._store is not None:
+            self._to_array()
+
+        if 'alphabet' in kwargs and (self._store is not None or self._array is not None):
             alphabet = kwargs['alphabet']
             if alphabet in ('dna', 'DNA'):
-                set_alphabet(self._msa, IUPAC.ambiguous_dna)
+                self._set_datatype('dna')
             elif alphabet in ('protein', 'PROTEIN'):
-                set_alphabet(self._msa, IUPAC.extended_protein)
+                self._set_datatype('protein')
             else:
                 logger.warning('Set alphabet to "dna" or "protein", not {}'.format(alphabet))
 
+    @classmethod
+    def from_array(cls, array, names, alphabet=None, name=None):
+        """
+        Construct an array-backed alignment.
+        :param array: 2D uint8 array (taxa x sites) of ASCII character codes. Not copied.
+        :param names: list of sequence names, one per row
+        :param alphabet: 'dna' or 'protein' (guessed if not given)
+        :param name: name of the alignment
+        """
+        al = cls()
+        al._set_array(array, list(names), alphabet)
+        al.name = name
+        return al
+
+    @property
+    def _msa(self):
+        """
+        Biopython alignment. For the array backend this is built on demand (and not kept),
+        so it should only be needed for writing files.
+        """
+        if self._store is None and self._array is not None:
+            return self._array_to_msa()
+        return self._store
+
+    @_msa.setter
+    def _msa(self, msa):
+        self._store = msa
+        self._array = None
+        self._names = None
+        self._datatype = None
+        self._digest = None
+
+    @property
+    def backend(self):
+        return 'array' if self._array is not None else 'biopython'
+
+    def _set_array(self, array, names, datatype=None):
+        if array.ndim != 2 or array.shape[0] != len(names):
+            raise ValueError('Array shape {} doesn\'t match the number of names ({})'.format(array.shape, len(names)))
+        self._store = None
+        self._array = array
+        self._names = names
+        self._digest = None
+        self._datatype = datatype or _guess_datatype(np.unique(array).tobytes().decode('ascii').upper())
+
+    def _to_array(self):
+        """ Switch from the biopython backend to the array backend """
+        msa = self._store
+        self._set_array(_sequences_to_array([str(sr.seq) for sr in msa]), [sr.name for sr in msa],
+                        'dna' if self.is_dna() else 'protein')
+
+    def _array_to_msa(self):
+        alphabet = IUPAC.ambiguous_dna if self._datatype == 'dna' else IUPAC.extended_protein
+        msa = MultipleSeqAlignment([SeqRecord(Seq(seq, alphabet), id=name, description=name, name=name)
+                                    for (name, seq) in self.get_sequences()])
+        set_alphabet(msa, alphabet)
+        return msa
+
+    def _set_datatype(self, datatype):
+        if self._array is not None:
+            self._datatype = datatype
+        else:
+            set_alphabet(self._store, IUPAC.ambiguous_dna if datatype == 'dna' else IUPAC.extended_protein)
+
+    def _concatenate_arrays(self, alignments):
+        """
+        Join alignments end to end as one array. Taxa missing from an alignment are padded with unknown data.
+        """
+        arrays = [al.get_array() for al in alignments]
+        names = []
+        seen = set()
+        for al in alignments:
+            for name in al.get_names():
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+        datatype = 'dna' if all(al.is_dna() for al in alignments) else 'protein'
+        index = dict((name, i) for (i, name) in enumerate(names))
+        result = np.empty((len(names), sum(a.shape[1] for a in arrays)), dtype=np.uint8)
+        result.fill(ord(UNKNOWN_CHARS[datatype]))
+        start = 0
+        for al, array in zip(alignments, arrays):
+            rows = [index[name] for name in al.get_names()]
+            result[rows, start:start + array.shape[1]] = array
+            start += array.shape[1]
+        self._set_array(result, names, datatype)
+
     def __add__(self, other):
         return self.__class__([self, other])
 
@@ -106,8 +260,10 @@ class Alignment(object):
              contents])
 
     def __len__(self):
-        if self._msa:
-            return self._msa.get_alignment_length()
+        if self._array is not None:
+            return self._array.shape[1]
+        if self._store:
+            return self._store.get_alignment_length()
 
     @property
     def parameters(self):
@@ -127,10 +283,14 @@ class Alignment(object):
             raise AttributeError('No tree')
 
     def is_dna(self):
-        return isinstance(self._msa._alphabet, (type(IUPAC.ambiguous_dna), type(IUPAC.unambiguous_dna)))
+        if self._array is not None:
+            return self._datatype == 'dna'
+        return isinstance(self._store._alphabet, (type(IUPAC.ambiguous_dna), type(IUPAC.unambiguous_dna)))
 
     def is_protein(self):
-        return isinstance(self._msa._alphabet, (type(IUPAC.protein), type(IUPAC.extended_protein)))
+        if self._array is not None:
+            return self._datatype == 'protein'
+        return isinstance(self._store._alphabet, (type(IUPAC.protein), type(IUPAC.extended_protein)))
     
     def read_alignment(self, *args, **kwargs):
         filename = args[0]
@@ -145,6 +305,30 @@ class Alignment(object):
         # guess alphabet
         self._msa = self._guess_alphabet(msa)
 
+    def read_phylip(self, filename, interleaved=None):
+        """
+        Read a PHYLIP file, which may be gzip or bzip2 compressed. The file is decompressed and read into
+        memory once. If the layout isn't given it is sniffed from the text (see sniff_phylip_layout); if
+        parsing fails in one layout, the other is tried on the same text.
+        :param interleaved: True for interleaved (or one line per sequence), False for sequential, None to sniff
+        """
+        with fileIO.freader(filename) as fl:
+            text = fl.read()
+        if ISPY3:
+            text = text.decode()
+        if interleaved is None:
+            interleaved = sniff_phylip_layout(text) == 'interleaved'
+        formats = ['phylip-relaxed', 'phylip-sequential']
+        if not interleaved:
+            formats.reverse()
+        try:
+            msa = AlignIO.read(StringIO(text), formats[0])
+        except ValueError:
+            msa = AlignIO.read(StringIO(text), formats[1])
+        self.infile = filename
+        # guess alphabet
+        self._msa = self._guess_alphabet(msa)
+
     def _guess_alphabet(self, msa):
         if msa.get_alignment_length() > 1000:
             allchars = [char for sr in msa for char in random.sample(list(sr.seq.upper()), 1000)]
@@ -165,57 +349,160 @@ class Alignment(object):
 
     def write_alignment(self, filename, file_format, interleaved=None):
         """
-        Write the alignment to file using Bio.AlignIO
+        Write the alignment to file using Bio.AlignIO. PHYLIP is written
+        directly, by write_phylip.
         """
         if file_format == 'phylip':
-            file_format = 'phylip-relaxed'
+            self.write_phylip(filename)
+            return
         AlignIO.write(self._msa, filename, file_format)
 
+    def write_phylip(self, filename):
+        """
+        Write the alignment as relaxed PHYLIP, one line per sequence, streamed
+        straight from the sequence data without building Biopython records
+        """
+        with open(filename, 'w') as fl:
+            self._write_phylip(fl)
+
+    def to_phylip_string(self):
+        """
+        The alignment as relaxed PHYLIP text, in the layout written by write_phylip
+        """
+        buf = StringIO()
+        self._write_phylip(buf)
+        return buf.getvalue()
+
+    def _write_phylip(self, fl):
+        names = self.get_names() or []
+        width = max(len(name) for name in names) + 2 if names else 0
+        fl.write('{} {}\n'.format(len(names), len(self) or 0))
+        for name, seq in self._iter_sequences():
+            fl.write(name.ljust(width))
+            fl.write(seq)
+            fl.write('\n')
+
+    def _iter_sequences(self):
+        if self._array is not None:
+            for name, row in zip(self._names, self._array):
+                yield name, row.tobytes().decode('ascii')
+        elif self._store:
+            for sr in self._store:
+                yield sr.name, str(sr.seq)
+
     def get_alignment_file(self, as_phylip=True):
+        alignment = self.find_alignment_file(as_phylip)
+        if alignment is not None:
+            return alignment, False
+        with fileIO.TempFile(disable_delete=True) as tmpfile:
+            self.write_alignment(tmpfile, "phylip", interleaved=True)
+        return tmpfile, True
+
+    def find_alignment_file(self, as_phylip=True):
+        """
+        Absolute path of the file this alignment was read from, if it still exists (and, if
+        as_phylip, is PHYLIP), otherwise None
+        """
         try:
             with open(self.infile) as fl:
                 if as_phylip:
                     header = fl.readline().strip().split()
                     assert len(header) == 2 and header[0].isdigit() and header[1].isdigit()
-            alignment = self.infile
-            return os.path.abspath(alignment), False
+            return os.path.abspath(self.infile)
 
-        except (IOError, TypeError, AssertionError):
-            with fileIO.TempFile(disable_delete=True) as tmpfile:
-                self.write_alignment(tmpfile, "phylip", interleaved=True)
-            return tmpfile, True
+        except (IOError, TypeError, AssertionError, UnicodeDecodeError):
+            return None
 
     def get_unconstrained_likelihood(self):
-        weights = collections.Counter()
-        sites = self.get_sites()
-        n = len(sites)
-        ucl = 0
-
-        for site in sites:
-            weights[site] += 1
-
-        for v in weights.values():
-            if v > 1:
-                ucl += v * np.log(v)
+        _, weights = self.get_site_patterns()
+        n = weights.sum()
+        repeated = weights[weights > 1]
+        ucl = (repeated * np.log(repeated)).sum()
         return ucl - n * np.log(n)
 
+    def get_site_patterns(self):
+        """
+        Compress the alignment to its unique columns (site patterns).
+        :return: (patterns, weights): an array-backed Alignment of the unique columns (same sequence names,
+            in the same order), and an integer array with the number of times each pattern occurs
+        """
+        array = self.get_array()
+        patterns, weights = np.unique(array.T, axis=0, return_counts=True)
+        al = self.__class__.from_array(np.ascontiguousarray(patterns.T), self.get_names(),
+                                       'dna' if self.is_dna() else 'protein', self.name)
+        return al, weights
+
     def to_biopython_msa(self):
         return self._msa
-        
+
+    def get_array(self):
+        """
+        The alignment as a 2D uint8 array (taxa x sites) of ASCII character codes, in get_names() order.
+        For the array backend this is the underlying storage, not a copy.
+        """
+        if self._array is not None:
+            return self._array
+        if self._store is not None:
+            return _sequences_to_array([str(sr.seq) for sr in self._store])
+
+    def get_digest(self):
+        """
+        SHA-1 hex digest of the sequence names and data, independent of the order of the sequences
+        and of the backend. It is kept until the sequences are replaced (changes made in place to the
+        array returned by get_array are not noticed).
+        """
+        if self._digest is None:
+            if self._array is not None:
+                rows = [(name, row.tobytes()) for (name, row) in zip(self._names, self._array)]
+            else:
+                rows = [(name, seq.encode('utf-8')) for (name, seq) in (self.get_sequences() or [])]
+            h = hashlib.sha1()
+            for name, seq in sorted(rows):
+                h.update('>{}\n'.format(name).encode('utf-8'))
+                h.update(seq)
+                h.update(b'\n')
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def take(self, names=None, sites=None):
+        """
+        Return a new array-backed Alignment with a subset of the sequences and/or sites.
+        Slices of sites give a view of this alignment's array rather than a copy.
+        :param names: list of sequence names to keep (default all)
+        :param sites: slice, or array of site indices, to keep (default all)
+        """
+        array = self.get_array()
+        all_names = self.get_names()
+        if names is not None:
+            index = dict((name, i) for (i, name) in enumerate(all_names))
+            array = array[[index[name] for name in names]]
+        else:
+            names = all_names
+        if sites is not None:
+            array = array[:, sites]
+        return self.__class__.from_array(array, names, 'dna' if self.is_dna() else 'protein', self.name)
+
     def get_sequences(self):
-        if self._msa:
-            return [(sr.name, str(sr.seq)) for sr in self._msa]
+        if self._array is not None:
+            return [(name, row.tobytes().decode('ascii')) for (name, row) in zip(self._names, self._array)]
+        if self._store:
+            return [(sr.name, str(sr.seq)) for sr in self._store]
 
     def get_sites(self):
-        if self._msa:
-            seqs = [str(sr.seq) for sr in self._msa]
+        if self._array is not None:
+            columns = np.ascontiguousarray(self._array.T)
+            return [col.tobytes().decode('ascii') for col in columns]
+        if self._store:
+            seqs = [str(sr.seq) for sr in self._store]
             return [''.join(col) for col in zip(*seqs)]
 
     def get_names(self):
-        if self._msa:
-            return [sr.name for sr in self._msa]
+        if self._array is not None:
+            return list(self._names)
+        if self._store:
+            return [sr.name for sr in self._store]
 
-    def compute_distances(self, model, alpha=None, ncat=4, tolerance=1e-6):
+    def compute_distances(self, model, alpha=None, ncat=4, tolerance=1e-6, jobhandler=None):
         """
         Compute pairwise distances between all sequences according to
         a given substitution model, `model`, of type phylo_utils.models.Model
@@ -224,7 +511,7 @@ class Alignment(object):
         disable gamma rate variation. The gamma alpha parameter must be supplied
         to enable gamma rate variation.
         """
-        return pairdists(self, model, alpha, ncat, tolerance)
+        return pairdists(self, model, alpha, ncat, tolerance, jobhandler=jobhandler)
 
 
     def simulate(self, nsites, transition_matrix, tree, ncat=1, alpha=1):
@@ -236,28 +523,258 @@ class Alignment(object):
 
     def bootstrap(self):
         """
-        Return a new Alignment that is a bootstrap replicate of self
+        Return a new Alignment that is a bootstrap replicate of self (sites sorted lexicographically),
+        with the same backend. For many replicates, use ReplicateGenerator, which compresses the
+        alignment to site patterns only once.
         """
-        new_sites = sorted(sample_wr(self.get_sites()))
-        seqs = list(zip(self.get_names(), (''.join(seq) for seq in zip(*new_sites))))
-        return self.__class__(seqs)
+        replicate = ReplicateGenerator(self).bootstrap()
+        replicate.name = self.name
+        if self._array is not None:
+            return replicate
+        return self.__class__(replicate.get_sequences(), alphabet='dna' if self.is_dna() else 'protein', name=self.name)
 
     def to_data_frame(self):
-        return pd.DataFrame([list(sr.seq) for sr in self._msa], index=self.get_names())
+        if self._array is not None:
+            return pd.DataFrame(self._array.view('S1').astype(str), index=self.get_names())
+        return pd.DataFrame([list(sr.seq) for sr in self._store], index=self.get_names())
 
     @classmethod
     def from_data_frame(cls, df):
         return cls([(label, ''.join(row)) for (label, row) in df.iterrows()])
 
 
+# Default number of alignments a lazy Collection keeps in memory at once
+LAZY_CACHE_SIZE = 1000
+
+
+class LazyAlignment(Alignment):
+    """
+    An alignment that keeps only its file path and name (and parameters) until its sequences are
+    needed. The file is read on first use, and the parsed alignment is held in an LRUCache, normally
+    shared by all the records of a Collection, so only a bounded number are in memory at once; evicted
+    alignments are read again when next needed. The number of sequences, their names, the length and
+    the datatype are kept after the first read, so these don't need the sequences.
+    Changes to the sequence data pin the alignment in memory.
+    """
+
+    def __init__(self, filename, file_format='phylip', cache=None, backend='biopython', header_grep=None):
+        """
+        :param filename: path of the alignment file (may be gzip or bzip2 compressed)
+        :param file_format: 'phylip' or 'fasta'
+        :param cache: LRUCache to hold the parsed alignment (a private cache holding just this alignment
+            if not given)
+        :param backend: storage of the parsed alignment - see Alignment
+        :param header_grep: function applied to the sequence names when the file is read
+        """
+        self._pinned = None
+        self._meta = None
+        self._digest = None
+        self.infile = os.path.abspath(filename)
+        self.file_format = file_format
+        self.cache = cache if cache is not None else LRUCache(maxsize=1)
+        self.lazy_backend = optioncheck(backend, ['biopython', 'array'])
+        self.header_grep = header_grep
+        self.name = os.path.splitext(os.path.basename(self.infile))[0]
+        self.parameters = Parameters()
+        self.parameters.filename = filename
+
+    def __getstate__(self):
+        # Caches hold locks, and are per-process anyway: an unpickled copy reads its file again
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = LRUCache(maxsize=1)
+
+    def _load(self):
+        al = Alignment(self.infile, self.file_format, backend=self.lazy_backend)
+        if self.header_grep is not None:
+            try:
+                al = Alignment([(self.header_grep(x), y) for (x, y) in al.get_sequences()],
+                               'dna' if al.is_dna() else 'protein', backend=self.lazy_backend)
+            except TypeError:
+                raise TypeError("Couldn't apply header_grep to header\n"
+                                "alignment name={}\n"
+                                "header_grep={}".format(self.name, self.header_grep))
+        return al
+
+    def _loaded(self):
+        """
+        The parsed alignment, from the cache, or read from file
+        """
+        if self._pinned is not None:
+            return self._pinned
+        al = self.cache.get(self.infile)
+        if al is None:
+            al = self._load()
+            names = al.get_names() or []
+            self._meta = (names, len(al) or 0, al.is_dna())
+            self.cache.set(self.infile, al, size=len(names) * (len(al) or 0))
+        return al
+
+    def _pin(self, attr, value):
+        if self._pinned is None:
+            self._pinned = self._loaded()
+            self.cache.discard(self.infile)
+        setattr(self._pinned, attr, value)
+        self._meta = None
+        self._digest = None
+
+    def is_loaded(self):
+        """
+        True if the sequences are currently in memory
+        """
+        return self._pinned is not None or self.infile in self.cache
+
+    def unload(self):
+        """
+        Drop the sequences from memory (any changes to them are lost); they are read again when next needed
+        """
+        self._pinned = None
+        self.cache.discard(self.infile)
+
+    _store = property(lambda self: self._loaded()._store, lambda self, value: self._pin('_store', value))
+    _array = property(lambda self: self._loaded()._array, lambda self, value: self._pin('_array', value))
+    _names = property(lambda self: self._loaded()._names, lambda self, value: self._pin('_names', value))
+    _datatype = property(lambda self: self._loaded()._datatype,
+                         lambda self, value: self._pin('_datatype', value))
+
+    def __len__(self):
+        if self._meta is None or self.is_loaded():
+            return len(self._loaded())
+        return self._meta[1]
+
+    def get_names(self):
+        if self._meta is None or self.is_loaded():
+            return self._loaded().get_names()
+        return list(self._meta[0])
+
+    def is_dna(self):
+        if self._meta is None or self.is_loaded():
+            return self._loaded().is_dna()
+        return self._meta[2]
+
+    def is_protein(self):
+        if self._meta is None or self.is_loaded():
+            return self._loaded().is_protein()
+        return not self._meta[2]
+
+    # Alignments derived from a lazy alignment are ordinary in-memory alignments
+    @classmethod
+    def from_array(cls, array, names, alphabet=None, name=None):
+        return Alignment.from_array(array, names, alphabet, name)
+
+    @classmethod
+    def from_data_frame(cls, df):
+        return Alignment.from_data_frame(df)
+
+    def __add__(self, other):
+        return Alignment([self, other])
+
+    def bootstrap(self):
+        return self._loaded().bootstrap()
+
+
+class ReplicateGenerator(object):
+    """
+    Nonparametric bootstrap and permutation replicates of an alignment. The alignment is
+    compressed to its site patterns once; a bootstrap replicate is then a multinomial draw of
+    pattern counts, and a permutation replicate is a shuffle of the site-to-pattern index, both
+    done with numpy. Replicates are array-backed Alignments, made one at a time, or can be
+    written straight to PHYLIP files.
+    """
+
+    def __init__(self, alignment, random_state=None):
+        """
+        :param alignment: Alignment to resample
+        :param random_state: seed or numpy RandomState (default: numpy's global random state)
+        """
+        array = alignment.get_array()
+        patterns, self.index, self.counts = np.unique(array.T, axis=0, return_inverse=True,
+                                                      return_counts=True)
+        self.index = self.index.ravel()
+        self.patterns = np.ascontiguousarray(patterns.T)
+        self.names = alignment.get_names()
+        self.datatype = 'dna' if alignment.is_dna() else 'protein'
+        self.nsites = array.shape[1]
+        if random_state is None:
+            self.random = np.random
+        elif isinstance(random_state, np.random.RandomState):
+            self.random = random_state
+        else:
+            self.random = np.random.RandomState(random_state)
+
+    def bootstrap_counts(self):
+        """
+        Number of times each site pattern occurs in a bootstrap replicate
+        """
+        return self.random.multinomial(self.nsites, self.counts / self.counts.sum())
+
+    def permutation_index(self):
+        """
+        Site pattern at each site of a permutation replicate
+        """
+        return self.random.permutation(self.index)
+
+    def _draw(self, method):
+        optioncheck(method, ['bootstrap', 'permutation'])
+        if method == 'bootstrap':
+            # Patterns are in lexicographic order, so the sites come out sorted
+            return np.repeat(self.patterns, self.bootstrap_counts(), axis=1)
+        return self.patterns[:, self.permutation_index()]
+
+    def bootstrap(self):
+        """
+        :return: an array-backed bootstrap replicate
+        """
+        return Alignment.from_array(self._draw('bootstrap'), self.names, self.datatype)
+
+    def permutation(self):
+        """
+        :return: an array-backed replicate with the sites randomly reordered
+        """
+        return Alignment.from_array(self._draw('permutation'), self.names, self.datatype)
+
+    def replicates(self, n, method='bootstrap'):
+        """
+        Generate replicates lazily
+        :param n: number of replicates
+        :param method: 'bootstrap' or 'permutation'
+        """
+        for _ in range(n):
+            yield Alignment.from_array(self._draw(method), self.names, self.datatype)
+
+    def write_phylip(self, filenames, method='bootstrap'):
+        """
+        Write one replicate to each file, as relaxed PHYLIP, directly from the resampled array
+        :param filenames: iterable of paths
+        :param method: 'bootstrap' or 'permutation'
+        """
+        width = max(len(name) for name in self.names) + 2 if self.names else 0
+        labels = [name.ljust(width).encode('ascii') for name in self.names]
+        for filename in filenames:
+            array = self._draw(method)
+            with open(filename, 'wb') as fl:
+                fl.write('{} {}\n'.format(len(self.names), self.nsites).encode('ascii'))
+                for label, row in zip(labels, array):
+                    fl.write(label)
+                    fl.write(row.tobytes())
+                    fl.write(b'\n')
+
+
 class BranchLengthOptimiser(object):
     """
     Wrapper for use with scipy optimiser (e.g. brenth/brentq)
+    If site weights are given (see Alignment.get_site_patterns), each site's
+    contribution to the likelihood and its derivatives is multiplied by its weight.
     """
 
-    def __init__(self, node1, node2, initial_brlen=1.0):
+    def __init__(self, node1, node2, initial_brlen=1.0, weights=None):
         self.root = node1
         self.desc = node2
+        self.weights = weights
         self.updated = None
         self.__call__(initial_brlen)
 
@@ -268,9 +785,21 @@ class BranchLengthOptimiser(object):
             return self.lnl, self.dlnl, self.d2lnl
         if self.updated != brlen:
             self.updated = brlen
-            self.lnl, self.dlnl, self.d2lnl = self.root.compute_likelihood(self.desc, brlen, derivatives=True)
+            if self.weights is None:
+                self.lnl, self.dlnl, self.d2lnl = self.root.compute_likelihood(self.desc, brlen, derivatives=True)
+            else:
+                self.lnl, self.dlnl, self.d2lnl = self._weighted_likelihood(brlen)
         return self.lnl, self.dlnl, self.d2lnl
 
+    def _weighted_likelihood(self, brlen):
+        self.root.compute_edge_sitewise_likelihood(self.desc, brlen, derivatives=True)
+        f, fp, f2p = self.root.sitewise[:, 0], self.root.sitewise[:, 1], self.root.sitewise[:, 2]
+        w = self.weights
+        lnl = (w * np.log(f)).sum()
+        dlnl = (w * fp / f).sum()
+        d2lnl = (w * ((f * f2p) - (fp * fp)) / (f * f)).sum()
+        return lnl, dlnl, d2lnl
+
     def get_lnl(self, brlen):
         return self.__call__(brlen)[0]
 
@@ -294,27 +823,95 @@ class BranchLengthOptimiser(object):
                                                                                          self.lnl, self.dlnl,
                                                                                          self.d2lnl)
 
-def brent_optimise(node1, node2, min_brlen=0.001, max_brlen=10, verbose=False):
+def brent_optimise(node1, node2, min_brlen=0.001, max_brlen=10, verbose=False, weights=None):
     """
     Optimise ML distance between two partials. min and max set brackets
     """
     from scipy.optimize import minimize_scalar
-    wrapper = BranchLengthOptimiser(node1, node2, (min_brlen + max_brlen) / 2.)
+    wrapper = BranchLengthOptimiser(node1, node2, (min_brlen + max_brlen) / 2., weights)
     n = minimize_scalar(lambda x: -wrapper(x)[0], method='brent', bracket=(min_brlen, max_brlen))['x']
     if verbose:
         logger.info(wrapper)
     if n < min_brlen:
         n = min_brlen
         wrapper(n)
-    return n, -1 / wrapper.get_d2lnl(n)
+    return n, -1 / wrapper(n)[2]
+
+# Number of (pair x site pattern x state) elements worked on at once by pairdists_block
+PAIRDISTS_BLOCK_ELEMENTS = 2 ** 22
+
 
-def pairdists(alignment, subs_model, alpha=None, ncat=4, tolerance=1e-6, verbose=False):
+def pairdists_block(rows, cols, left, right, weights, evals, rates, min_brlen=0.001, max_brlen=10,
+                    tolerance=1e-6, maxiter=100):
+    """
+    Maximum likelihood distances (and their variances) for a block of sequence pairs, by Newton-Raphson
+    iteration on all the pairs at once.
+    With the transition matrix decomposed as P(t) = U.diag(exp(evals*t)).V, the likelihood of site s of
+    pair (a, b) is sum_k C[s, k] exp(evals[k] * r * t), averaged over rate categories r, where
+    C = (left[a] * right[b]) and left = (pi * partials).U, right = partials.V^T. C is computed once per pair,
+    after which each iteration is a matrix product.
+    :param rows, cols: arrays of sequence indices - the pairs are zip(rows, cols)
+    :param left, right: arrays (nseq x npatterns x nstates), as above
+    :param weights: site pattern weights
+    :param evals: eigenvalues of the rate matrix
+    :param rates: gamma category rates (equally weighted)
+    :return: (distances, variances) arrays, one entry per pair
+    """
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    npairs = len(rows)
+    c = left[rows] * right[cols]  # (npairs, npatterns, nstates)
+    lam = rates[:, np.newaxis] * evals[np.newaxis, :]  # (ncat, nstates)
+    ncat = len(rates)
+
+    def evaluate(index, t):
+        """ lnL and its first two derivatives, for the pairs in index at branch lengths t """
+        e = np.exp(lam[np.newaxis] * t[:, np.newaxis, np.newaxis]) / ncat  # (n, ncat, nstates)
+        g = np.stack([e.sum(1), (e * lam).sum(1), (e * lam * lam).sum(1)], axis=2)  # (n, nstates, 3)
+        f = np.matmul(c[index], g)  # (n, npatterns, 3)
+        f0 = np.maximum(f[..., 0], 1e-300)
+        f1 = f[..., 1] / f0
+        lnl = np.log(f0).dot(weights)
+        d1 = f1.dot(weights)
+        d2 = (f[..., 2] / f0 - f1 * f1).dot(weights)
+        return lnl, d1, d2
+
+    t = np.full(npairs, 0.1)
+    lnl, d1, d2 = evaluate(np.arange(npairs), t)
+    active = np.arange(npairs)
+    for _ in range(maxiter):
+        if len(active) == 0:
+            break
+        ta, la, g1, g2 = t[active], lnl[active], d1[active], d2[active]
+        # Newton step where the likelihood is concave, otherwise double or halve the length
+        concave = g2 < 0
+        step = np.where(concave, -g1 / np.where(concave, g2, -1), np.where(g1 > 0, ta, -ta / 2))
+        new = np.clip(ta + step, min_brlen, max_brlen)
+        # Backtrack any steps that reduce the likelihood
+        for _ in range(30):
+            lnl_new, d1_new, d2_new = evaluate(active, new)
+            worse = lnl_new < la - 1e-12 * np.abs(la)
+            if not worse.any():
+                break
+            new = np.where(worse, (ta + new) / 2, new)
+        t[active], lnl[active], d1[active], d2[active] = new, lnl_new, d1_new, d2_new
+        active = active[np.abs(new - ta) > tolerance]
+
+    with np.errstate(divide='ignore'):
+        variances = -1 / d2
+    return t, variances
+
+
+def pairdists(alignment, subs_model, alpha=None, ncat=4, tolerance=1e-6, verbose=False, jobhandler=None,
+              batchsize=1):
     """ Load an alignment, calculate all pairwise distances and variances
-        model parameter must be a Substitution model type from phylo_utils """
+        model parameter must be a Substitution model type from phylo_utils
+        All pairs are optimised together (see pairdists_block); the pairs are split
+        into blocks which can be spread over cores by passing a jobhandler. """
 
     # Check
     if not isinstance(subs_model, phylo_utils.models.Model):
-        raise ValueError("Can't handle this model: {}".format(model))
+        raise ValueError("Can't handle this model: {}".format(subs_model))
 
     if alpha is None:
         alpha = 1.0
@@ -322,9 +919,13 @@ def pairdists(alignment, subs_model, alpha=None, ncat=4, tolerance=1e-6, verbose
 
     # Set up markov model
     tm = TransitionMatrix(subs_model)
+    freqs = np.asarray(tm.freqs, dtype=np.double)
+    evecs, evals, ivecs = _eigen(np.asarray(tm.get_q_matrix()), freqs)
 
-    gamma_rates = discrete_gamma(alpha, ncat)
-    partials = alignment_to_partials(alignment)
+    gamma_rates = np.asarray(discrete_gamma(alpha, ncat), dtype=np.double)
+    # Work on the unique columns, weighted by their counts
+    patterns, weights = alignment.get_site_patterns()
+    partials = alignment_to_partials(patterns)
     seqnames = alignment.get_names()
     nseq = len(seqnames)
     distances = np.zeros((nseq, nseq))
@@ -332,18 +933,43 @@ def pairdists(alignment, subs_model, alpha=None, ncat=4, tolerance=1e-6, verbose
 
     # Check the model has the appropriate size
     if not subs_model.size == partials[seqnames[0]].shape[1]:
-        raise ValueError("Model {} expects {} states, but the alignment has {}".format(model.name,
-                                                                                       model.size,
+        raise ValueError("Model {} expects {} states, but the alignment has {}".format(subs_model.name,
+                                                                                       subs_model.size,
                                                                                        partials[seqnames[0]].shape[1]))
 
-    nodes = [phylo_utils.likelihood.LnlModel(tm) for seq in range(nseq)]
-    for node, header in zip(nodes, seqnames):
-        node.set_partials(partials[header])  # retrieve partial likelihoods from partials dictionary
+    stacked = np.array([partials[name] for name in seqnames])  # (nseq, npatterns, nstates)
+    left = np.matmul(stacked * freqs, evecs)
+    right = np.matmul(stacked, ivecs.T)
+    weights = weights.astype(np.double)
 
-    for i, j in itertools.combinations(range(nseq), 2):
-        brlen, var = brent_optimise(nodes[i], nodes[j], verbose=verbose)
-        distances[i, j] = distances[j, i] = brlen
-        variances[i, j] = variances[j, i] = var
+    rows, cols = np.triu_indices(nseq, 1)
+    blocksize = max(1, PAIRDISTS_BLOCK_ELEMENTS // max(1, stacked.shape[1] * stacked.shape[2]))
+    blocks = [(rows[k:k + blocksize], cols[k:k + blocksize]) for k in range(0, len(rows), blocksize)]
+    if jobhandler is None or len(blocks) < 2:
+        results = [pairdists_block(r, c, left, right, weights, evals, gamma_rates, tolerance=tolerance)
+                   for (r, c) in blocks]
+    else:
+        # Handlers whose workers can see the shared store are sent only the row and column indices
+        # of each block, not the partials arrays
+        shared_key = ('pairdists', id(left)) if jobhandler.shares_memory else None
+        try:
+            if shared_key is not None:
+                ref = parutils.share(shared_key, (left, right))
+                left_arg, right_arg = ref[0], ref[1]
+            else:
+                left_arg, right_arg = left, right
+            args = [(r, c, left_arg, right_arg, weights, evals, gamma_rates, 0.001, 10, tolerance)
+                    for (r, c) in blocks]
+            results = jobhandler(pairdists_block, args, 'Pairwise distances' if verbose else '', batchsize)
+        finally:
+            if shared_key is not None:
+                parutils.unshare(shared_key)
+
+    for (r, c), (brlen, var) in zip(blocks, results):
+        distances[r, c] = distances[c, r] = brlen
+        variances[r, c] = variances[c, r] = var
+    if verbose:
+        logger.info('Calculated {} pairwise distances in {} blocks'.format(len(rows), len(blocks)))
     dm = DistanceMatrix.from_array(distances, names=seqnames)
     vm = DistanceMatrix.from_array(variances, names=seqnames)
     return dm, vm
@@ -5,6 +5,7 @@ from scipy.spatial.distance import pdist, squareform
 
 from .tasks import _fast_geo
 from .constants import ISPY3
+from .distance_matrix import DistanceMatrix
 
 from tree_distance import PhyloTree
 
@@ -173,14 +174,20 @@ def optimise_gradient_descent(x, a, c, tolerance=0.001):
 
 ### Functions to add bootstraps to collections
 
+def _phylotrees(collection, rooted):
+    """
+    PhyloTrees of a collection's trees. A Collection parses each tree once and keeps the
+    PhyloTrees (see RecordsHandler.phylotrees), so repeated projections onto the same
+    reference collection don't rebuild them.
+    """
+    if hasattr(collection, 'phylotrees'):
+        return collection.phylotrees(rooted)
+    return [PhyloTree(tree.encode() if ISPY3 else tree, rooted) for tree in collection.trees]
+
 def run_optimise_bootstrap_coords(boot_collection, ref_collection, ref_coords, task=_fast_geo, rooted=False, **kwargs):
     fit = np.empty((len(boot_collection), ref_coords.shape[1]))
-    if ISPY3:
-        query_trees = [PhyloTree(tree.encode(), rooted) for tree in boot_collection.trees]
-        ref_trees = [PhyloTree(tree.encode(), rooted) for tree in ref_collection.trees]
-    else:
-        query_trees = [PhyloTree(tree, rooted) for tree in boot_collection.trees]
-        ref_trees = [PhyloTree(tree, rooted) for tree in ref_collection.trees]
+    query_trees = _phylotrees(boot_collection, rooted)
+    ref_trees = _phylotrees(ref_collection, rooted)
     for i, tree in enumerate(query_trees):
         ref_dists = np.array([task(tree, ref_tree, False) for ref_tree in ref_trees])
         opt = OptimiseDistanceFit(ref_coords.values, ref_dists)
@@ -193,12 +200,8 @@ def run_out_of_sample_mds(boot_collection, ref_collection, ref_distance_matrix,
             using recalc=True in kwargs
     """
     fit = np.empty((len(boot_collection), dimensions))
-    if ISPY3:
-        query_trees = [PhyloTree(tree.encode(), rooted) for tree in boot_collection.trees]
-        ref_trees = [PhyloTree(tree.encode(), rooted) for tree in ref_collection.trees]
-    else:
-        query_trees = [PhyloTree(tree, rooted) for tree in boot_collection.trees]
-        ref_trees = [PhyloTree(tree, rooted) for tree in ref_collection.trees]
+    query_trees = _phylotrees(boot_collection, rooted)
+    ref_trees = _phylotrees(ref_collection, rooted)
     for i, tree in enumerate(query_trees):
         distvec = np.array([task(tree, ref_tree, False) for ref_tree in ref_trees])
         oos = OutOfSampleMDS(ref_distance_matrix)
@@ -207,12 +210,8 @@ def run_out_of_sample_mds(boot_collection, ref_collection, ref_distance_matrix,
 
 def run_analytical_fit(boot_collection, ref_collection, ref_coords, task=_fast_geo, rooted=False, **kwargs):
     fit = np.empty((len(boot_collection), ref_coords.shape[1]))
-    if ISPY3:
-        query_trees = [PhyloTree(tree.encode(), rooted) for tree in boot_collection.trees]
-        ref_trees = [PhyloTree(tree.encode(), rooted) for tree in ref_collection.trees]
-    else:
-        query_trees = [PhyloTree(tree, rooted) for tree in boot_collection.trees]
-        ref_trees = [PhyloTree(tree, rooted) for tree in ref_collection.trees]
+    query_trees = _phylotrees(boot_collection, rooted)
+    ref_trees = _phylotrees(ref_collection, rooted)
     for i, tree in enumerate(query_trees):
         ref_dists = np.array([task(tree, ref_tree, False) for ref_tree in ref_trees])
         aft = AnalyticalFit(ref_coords.values, **kwargs)
@@ -328,6 +327,8 @@ class OutOfSampleMDS(object):
         Store quantities calculated from a distance matrix,
         including the CMDS coordinate matrix
         """
+        if isinstance(distance_matrix, DistanceMatrix):
+            distance_matrix = distance_matrix.values
         # Calculate all requirements once and store
         self.dmsq = distance_matrix**2
         self.rows, self.cols = distance_matrix.shape
@@ -377,6 +378,22 @@ class OutOfSampleMDS(object):
         brow = self.new_B_row(index, distvec**2, recalc)
         return self.new_coords(brow)[:dimensions]
 
+    def add_points(self, distvecs, dimensions=3):
+        """
+        Place new points, which weren't in the original distance matrix, into the existing
+        embedding, without recomputing the decomposition (Gower's add-a-point formula).
+        distvecs holds one row per new point, of plain distances to the original points,
+        e.g. the new-vs-old rows of a matrix extended by
+        Collection.extend_inter_tree_distances.
+        Returns an array of coordinates, one row per new point.
+        """
+        dsq = np.atleast_2d(distvecs)**2
+        b = -0.5 * (dsq
+                    - self.rowmean[np.newaxis]
+                    - dsq.mean(1)[:,np.newaxis]
+                    + self.mean)
+        return self.new_coords(b)[:, :dimensions]
+
 
 class AnalyticalFit(object):
     """
@@ -10,7 +10,6 @@ from builtins import object
 # third party
 import numpy as np
 from scipy.cluster.hierarchy import fcluster, dendrogram
-from scipy.spatial.distance import squareform
 import fastcluster
 import skbio
 
@@ -35,7 +34,7 @@ else:
 
 # treeCl
 from .distance_matrix import DistanceMatrix, rbf, binsearch_mask, kmask, kscale, affinity, laplace, eigen, \
-    double_centre, normalise_rows, CoordinateMatrix
+    double_centre, normalise_rows, CoordinateMatrix, knn, sparse_kmask, sparse_affinity, binsearch_sparse_mask
 from .partition import Partition
 from .utils import enum
 from .errors import OptionError, isnumbercheck, rangecheck
@@ -142,7 +141,16 @@ class Spectral(ClusteringManager, EMMixin):
                  scale_option=options.LOCAL_SCALE_MEDIAN, 
                  manual_pruning=None, 
                  manual_scale=None,
-                 verbosity=0):
+                 verbosity=0,
+                 sparse=False):
+        """
+        Parameters
+        ----------
+        sparse:     bool
+                    Keep the affinity matrix as a scipy.sparse matrix, built from the k
+                    nearest neighbours of each point, and only solve for the leading
+                    eigenvectors. Only useful together with pruning, which sets k.
+        """
         super(Spectral, self).__init__(dm)
         try:
             options.reverse[pruning_option]
@@ -154,16 +162,17 @@ class Spectral(ClusteringManager, EMMixin):
             raise OptionError(scale_option, list(options.reverse.values()))
 
         if pruning_option == options.PRUNING_MANUAL:
-            _check_val(manual_pruning, 2, self.dm.df.shape[0])
+            _check_val(manual_pruning, 2, len(self.dm))
 
         if scale_option == options.LOCAL_SCALE_MANUAL:
-            _check_val(manual_scale, 2, self.dm.df.shape[0])
+            _check_val(manual_scale, 2, len(self.dm))
 
         self._pruning_option = pruning_option
         self._scale_option = scale_option
         self._manual_pruning = manual_pruning
         self._manual_scale = manual_scale
         self._verbosity = verbosity
+        self._sparse = sparse
         self._affinity = self.decompose()
 
     def __str__(self):
@@ -186,6 +195,8 @@ class Spectral(ClusteringManager, EMMixin):
 
         """
         matrix = self.get_dm(noise)
+        if self._sparse:
+            return self._sparse_decompose(matrix, verbosity, logic)
 
         # get local scale estimate
         est_scale = None
@@ -231,6 +242,57 @@ class Spectral(ClusteringManager, EMMixin):
         aff.flat[::len(aff)+1] = 1.0
         return aff
 
+    def _sparse_decompose(self, matrix, verbosity=0, logic='or'):
+        """
+        Sparse version of decompose. The nearest neighbour table is computed once and used for
+        both the pruning mask and the local scale. Scales are kept as a vector - their outer
+        product is never formed.
+        """
+        n = len(matrix)
+        est_scale = None
+        table = None
+
+        # ADJUST MASK
+        if self._pruning_option == options.PRUNING_NONE:
+            kp = n - 1
+            table = knn(matrix, kp)
+            mask = sparse_kmask(table[0], kp, logic=logic)
+        elif self._pruning_option == options.PRUNING_MANUAL:
+            kp = self._manual_pruning
+            k = kp if self._scale_option != options.LOCAL_SCALE_MANUAL else max(kp, self._manual_scale)
+            table = knn(matrix, k)
+            mask = sparse_kmask(table[0], kp, logic=logic)
+        elif self._pruning_option == options.PRUNING_ESTIMATE:
+            kp, mask, est_scale = binsearch_sparse_mask(matrix, logic=logic)
+        else:
+            raise ValueError("Unexpected error: 'kp' not set")
+
+        # ADJUST SCALE
+        if self._scale_option == options.LOCAL_SCALE_MEDIAN:
+            scale = np.median(matrix, axis=1)
+        elif self._scale_option == options.LOCAL_SCALE_MANUAL:
+            if table is None or table[1].shape[1] <= self._manual_scale:
+                table = knn(matrix, self._manual_scale)
+            scale = table[1][:, self._manual_scale]
+        elif self._scale_option == options.LOCAL_SCALE_ESTIMATE:
+            if est_scale is None:
+                _, _, scale = binsearch_sparse_mask(matrix, logic=logic)
+            else:
+                scale = est_scale
+        else:
+            raise ValueError("Unexpected error: 'scale' not set")
+
+        # ZeroDivisionError safety check (the smallest entry of the outer product is min(scale)**2)
+        if not scale.min() ** 2 > 1e-5:
+            if verbosity > 0:
+                print('Rescaling to avoid zero-div error')
+            _, _, scale = binsearch_sparse_mask(matrix, logic=logic)
+            assert scale.min() ** 2 > 1e-5
+
+        aff = sparse_affinity(matrix, mask, scale)
+        aff.setdiag(1.0)
+        return aff
+
     def cluster(self, n, embed_dim=None, algo=spectral.SPECTRAL, method=methods.KMEANS):
         """
         Cluster the embedded coordinates using spectral clustering
@@ -288,7 +350,7 @@ class Spectral(ClusteringManager, EMMixin):
         n:      int
                 The number of dimensions
         """
-        coords = spectral_embedding(self._affinity, n)
+        coords = spectral_embedding(self._affinity, n_components=n)
         return CoordinateMatrix(normalise_rows(coords))
 
     def spectral_embedding_(self, n):
@@ -301,9 +363,14 @@ class Spectral(ClusteringManager, EMMixin):
         better plotted). Uses a different Laplacian matrix.
         """
         aff = self._affinity.copy()
-        aff.flat[::aff.shape[0]+1] = 0
-        laplacian = laplace(aff)
-        decomp = eigen(laplacian)
+        if self._sparse:
+            aff.setdiag(0)
+            aff.eliminate_zeros()
+            decomp = eigen(laplace(aff), n)
+        else:
+            aff.flat[::aff.shape[0]+1] = 0
+            laplacian = laplace(aff)
+            decomp = eigen(laplacian)
         return CoordinateMatrix(normalise_rows(decomp.vecs[:,:n]))
 
     def kpca_embedding(self, n):
@@ -315,7 +382,8 @@ class Spectral(ClusteringManager, EMMixin):
         n:      int
                 The number of dimensions
         """
-        return self.dm.embedding(n, 'kpca', affinity_matrix=self._affinity)
+        affinity_matrix = self._affinity.toarray() if self._sparse else self._affinity
+        return self.dm.embedding(n, 'kpca', affinity_matrix=affinity_matrix)
 
     @property
     def affinity(self):
@@ -424,9 +492,9 @@ class Hierarchical(ClusteringManager):
         :param noise: Add Gaussian noise to the distance matrix prior to clustering (bool, default=False)
         :return: Partition object describing clustering
         """
-        matrix = self.get_dm(noise)
-
-        linkmat = fastcluster.linkage(squareform(matrix), method)
+        # Works on the condensed distances, so a condensed DistanceMatrix is never squared
+        dm = self.dm.add_noise() if noise else self.dm
+        linkmat = fastcluster.linkage(dm.condensed, method)
         self.nclusters = nclusters  # Store these in case we want to plot
         self.linkmat = linkmat      #
         return _hclust(linkmat, nclusters)
@@ -15,9 +15,7 @@ import hashlib
 import itertools
 import json
 import os
-import random
 import sys
-import tempfile
 from functools import reduce
 
 # third party
@@ -27,16 +25,23 @@ from scipy.spatial.distance import squareform
 from tree_distance import PhyloTree
 
 # treeCl
-from .alignment import Alignment
+from .alignment import Alignment, LazyAlignment, ReplicateGenerator, LAZY_CACHE_SIZE
 from .concatenation import Concatenation
 from .constants import SORT_KEY, ISPY3
 from .distance_matrix import DistanceMatrix
 from .errors import optioncheck, directorycheck
 from . import tasks
+from . import treedist
+from .likelihood import LocusBlock, tree_loglikelihoods
+from .tree import Tree
+from .parameters import ParameterStore
 from .partition import Partition
+from . import parutils
 from .parutils import SequentialJobHandler
-from .utils import fileIO, setup_progressbar, model_translate, smooth_freqs, create_gamma_model, flatten_list
+from .utils import fileIO, setup_progressbar, model_translate, smooth_freqs, create_gamma_model, flatten_list, \
+    alignment_to_partials, LRUCache
 from .utils.decorators import lazyprop
+from .utils.resultindex import ResultIndex
 from .utils.misc import binom_coeff
 
 # set up logging
@@ -45,6 +50,15 @@ logger = logging.getLogger(__name__)
 
 default_jobhandler = SequentialJobHandler()
 
+TREE_DISTANCE_TASKS = {'euc': tasks.EuclideanTreeDistance,
+                       'geo': tasks.GeodesicTreeDistance,
+                       'rf': tasks.RobinsonFouldsTreeDistance,
+                       'wrf': tasks.WeightedRobinsonFouldsTreeDistance,
+                       'fasteuc': tasks.EqualLeafSetEuclideanTreeDistance,
+                       'fastgeo': tasks.EqualLeafSetGeodesicTreeDistance,
+                       'fastrf': tasks.EqualLeafSetRobinsonFouldsTreeDistance,
+                       'fastwrf': tasks.EqualLeafSetWeightedRobinsonFouldsTreeDistance}
+
 
 def gapmask(simseqs, origseqs):
     """
@@ -64,6 +78,14 @@ def gapmask(simseqs, origseqs):
     return list(simdict.items())
 
 
+def job_costs(records):
+    """
+    Rough estimate of the cost of tree inference for each alignment in records
+    (number of sites x number of taxa), for scheduling
+    """
+    return [(len(rec) or 0) * len(rec.get_names()) for rec in records]
+
+
 def transform_fn(table, amount=2.0):
     tmp = table**(1.0/amount)
     return tmp / tmp.sum(1)[:,np.newaxis]
@@ -92,11 +114,25 @@ class RecordsHandler(object):
             file_format='phylip',
             header_grep=None,
             show_progress=True,
+            backend='biopython',
+            jobhandler=None,
+            batchsize=1,
+            lazy=False,
+            cache_size=LAZY_CACHE_SIZE,
     ):
+        """
+        :param lazy: if True, alignment files are only read when their sequences are needed, and at
+            most cache_size parsed alignments are kept in memory (see LazyAlignment). Trees and
+            parameters are always kept.
+        """
 
         self._records = None
+        self._tree_cache = {}
         self._input_files = None
         self.show_progress=show_progress
+        self.backend = optioncheck(backend, ['biopython', 'array'])
+        self.lazy = lazy
+        self.alignment_cache = LRUCache(maxsize=cache_size) if lazy else None
 
         if records is not None:
             self.records = records
@@ -107,7 +143,9 @@ class RecordsHandler(object):
             optioncheck(file_format, ['fasta', 'phylip'])
             self.records = self.read_alignments(input_dir,
                                                 file_format,
-                                                header_grep)
+                                                header_grep,
+                                                jobhandler,
+                                                batchsize)
             self.input_dir = input_dir
 
         else:
@@ -142,15 +180,51 @@ class RecordsHandler(object):
     def records(self, records):
         """ Sets a dictionary of records keyed by SORT_KEY order """
         self._records = dict(enumerate(records))
+        self._tree_cache = {}
 
-    @lazyprop
+    @property
     def trees(self):
-        """ Returns a list of trees in SORT_KEY order """
+        """ Returns a list of trees (newick strings) in SORT_KEY order. Not cached,
+        so it reflects any changes to the records' parameters """
         try:
             return [rec.tree for rec in self]
         except ValueError:
             return []
 
+    def _cached_tree(self, rec):
+        """
+        The tree cache entry for a record, [newick, Tree, {rooted: PhyloTree}], (re)made if
+        the record's tree has changed since it was last parsed
+        """
+        newick = rec.tree
+        entry = self._tree_cache.get(rec.name)
+        if entry is None or entry[0] != newick:
+            entry = [newick, Tree(newick), {}]
+            self._tree_cache[rec.name] = entry
+        return entry
+
+    def parsed_trees(self):
+        """
+        The records' trees as treeCl.Tree objects, in SORT_KEY order. Each newick string is parsed
+        once, and the Tree reused until the record's tree (parameters.ml_tree, or nj_tree) changes.
+        The Trees are shared by every caller, so copy one before modifying it.
+        """
+        return [self._cached_tree(rec)[1] for rec in self]
+
+    def phylotrees(self, rooted=False):
+        """
+        The records' trees as tree_distance.PhyloTree objects, in SORT_KEY order, cached in the same
+        way as parsed_trees.
+        :param rooted: bool. Passed to the PhyloTree constructor
+        """
+        trees = []
+        for rec in self:
+            entry = self._cached_tree(rec)
+            if rooted not in entry[2]:
+                entry[2][rooted] = PhyloTree(entry[0].encode() if ISPY3 else entry[0], rooted)
+            trees.append(entry[2][rooted])
+        return trees
+
     @lazyprop
     def names(self):
         """
@@ -215,9 +289,10 @@ class RecordsHandler(object):
         trees = [tree.newick if hasattr('newick', tree) else tree for tree in self.trees]
         return Alignment().get_mrp_supertree(trees)
 
-    def read_alignments(self, input_dir, file_format, header_grep=None):
+    def read_alignments(self, input_dir, file_format, header_grep=None, jobhandler=None, batchsize=1):
         """ Get list of alignment files from an input directory *.fa, *.fas and
-        *.phy files only
+        *.phy files only (optionally gzip or bzip2 compressed).
+        Files are parsed in parallel by jobhandler, or not at all in lazy mode.
 
         Stores in self.files """
 
@@ -237,40 +312,28 @@ class RecordsHandler(object):
         files = fileIO.glob_by_extensions(input_dir, extensions)
         files.sort(key=SORT_KEY)
         self._input_files = files
-        records = []
-
-        if self.show_progress:
-            pbar = setup_progressbar("Loading files", len(files), simple_progress=True)
-            pbar.start()
 
-        for i, f in enumerate(files):
-            if f.endswith('.gz') or f.endswith('.bz2'):
-                fd, tmpfile = tempfile.mkstemp()
-                with fileIO.freader(f, f.endswith('.gz'), f.endswith('.bz2')) as reader,\
-                     fileIO.fwriter(tmpfile) as writer:
-                    for line in reader:
-                        if ISPY3:
-                            line = line.decode()
-                        writer.write(line)
-                try:
-                    record = Alignment(tmpfile, file_format, True)
-                except ValueError:
-                    record = Alignment(tmpfile, file_format, False)
-                finally:
-                    os.close(fd)
-                    os.unlink(tmpfile)
+        if self.lazy:
+            records = [LazyAlignment(f, file_format, cache=self.alignment_cache, backend=self.backend,
+                                     header_grep=header_grep) for f in files]
+            for f, record in zip(files, records):
+                record.name = (fileIO.strip_extensions(f))
+            return records
 
-            else:
-                try:
-                    record = Alignment(f, file_format, True)
-                except RuntimeError:
-                    record = Alignment(f, file_format, False)
+        # Compressed files are decompressed in memory by the parser, so there are no temporary files
+        if jobhandler is None:
+            jobhandler = SequentialJobHandler()
+        msg = 'Loading files' if self.show_progress else ''
+        args = [(f, file_format, self.backend) for f in files]
+        records = list(jobhandler(tasks.load_alignment_task, args, msg, batchsize))
 
+        for i, (f, record) in enumerate(zip(files, records)):
             if header_grep:
                 try:
                     datatype = 'dna' if record.is_dna() else 'protein'
 
-                    record = Alignment([(header_grep(x), y) for (x, y) in record.get_sequences()], datatype)
+                    record = Alignment([(header_grep(x), y) for (x, y) in record.get_sequences()], datatype,
+                                       backend=self.backend)
 
                 except TypeError:
                     raise TypeError("Couldn't apply header_grep to header\n"
@@ -282,11 +345,7 @@ class RecordsHandler(object):
                     raise
 
             record.name = (fileIO.strip_extensions(f))
-            records.append(record)
-            if self.show_progress:
-                pbar.update(i)
-        if self.show_progress:
-            pbar.finish()
+            records[i] = record
         return records
 
     def read_trees(self, input_dir):
@@ -320,21 +379,30 @@ class RecordsHandler(object):
 
     def read_parameters(self, input_dir):
         """ Read a directory full of json parameter files, matching them up to the
-        already loaded alignments """
+        already loaded alignments. If input_dir is a ParameterStore file, read that
+        instead (see read_parameter_store) """
+
+        if ParameterStore.is_store(input_dir):
+            self.read_parameter_store(input_dir)
+            return
+
+        # One directory listing, rather than a glob per record
+        found = {}
+        for filename in sorted(glob.glob(os.path.join(input_dir, '*.json*'))):
+            name = os.path.basename(filename)
+            found.setdefault(name[:name.index('.json')], filename)
 
         if self.show_progress:
             pbar = setup_progressbar("Loading parameters", len(self.records))
             pbar.start()
         for i, rec in enumerate(self.records):
-            hook = os.path.join(input_dir, '{}.json*'.format(rec.name))
-            filename = glob.glob(hook)
             try:
-                with fileIO.freader(filename[0]) as infile:
+                with fileIO.freader(found[rec.name]) as infile:
                     d = json.loads(infile.read().decode('utf-8'), parse_int=True)
 
                 rec.parameters.construct_from_dict(d)
 
-            except (IOError, IndexError):
+            except (IOError, KeyError):
                 continue
 
             finally:
@@ -355,6 +423,25 @@ class RecordsHandler(object):
             with fileIO.fwriter(os.path.join(output_dir, '{}.json'.format(rec.name)), gz=gz) as outfile:
                 rec.parameters.write(outfile, indent=4)
 
+    def read_parameter_store(self, filename, mmap=True):
+        """ Read the parameters of the loaded alignments from a single ParameterStore file.
+        :param filename: path of the store, written by write_parameter_store
+        :param mmap: if True, distance and variance matrices are read-only views of
+            a memory map of the store, rather than being read into memory
+        """
+        store = ParameterStore(filename, mmap=mmap)
+        for rec in self.records:
+            d = store.get(rec.name)
+            if d is not None:
+                rec.parameters.construct_from_dict(d)
+
+    def write_parameter_store(self, filename):
+        """ Write the parameters of all records to a single ParameterStore file.
+        JSON (write_parameters) remains available for export.
+        :param filename: path of the store
+        """
+        ParameterStore.write(filename, ((rec.name, rec.parameters.dict) for rec in self.records))
+
 
 class RecordsCalculatorMixin(object):
 
@@ -417,9 +504,9 @@ class RecordsCalculatorMixin(object):
         # Scrape args from records
         args, to_delete = task_interface.scrape_args(records, **kwargs)
 
-        # Dispatch work
+        # Dispatch work - biggest alignments first
         msg = '{} Tree estimation'.format(task_interface.name) if show_progress else ''
-        map_result = jobhandler(task_interface.get_task(), args, msg, batchsize)
+        map_result = jobhandler(task_interface.get_task(), args, msg, batchsize, costs=job_costs(records))
 
         # Process results
         with fileIO.TempFileList(to_delete):
@@ -429,12 +516,14 @@ class RecordsCalculatorMixin(object):
 
     def get_inter_tree_distances(self, metric, jobhandler=default_jobhandler,
                                  normalise=False, min_overlap=4, overlap_fail_value=0,
-                                 batchsize=1, show_progress=True):
+                                 batchsize=1, show_progress=True, tile_size=treedist.DEFAULT_TILE_SIZE,
+                                 condensed=False, checkpoint=None):
         """ Generate a distance matrix from a fully-populated Collection.
             Can silence progressbars with show_progress=False option
         :param metric: str. Tree distance metric to use. Choice of 'euc', 'geo', 'rf', 'wrf'.
-        :param jobhandler: treeCl.Jobhandler. Choice of SequentialJobHandler, ThreadpoolJobHandler, or
-            ProcesspoolJobHandler.
+        :param jobhandler: treeCl.Jobhandler. Choice of SequentialJobHandler, ThreadpoolJobHandler,
+            ProcesspoolJobHandler, or SharedProcesspoolJobHandler (workers inherit the parsed trees
+            instead of receiving newick strings).
         :param normalise:  Bool. Whether to normalise the tree distance to the size of the leaf set.
         :param min_overlap: int. Trees with fewer leaves in common than this threshold will not have their distance
             calculated, but instead the distance returned will be the value in `overlap_fail_value`.
@@ -442,27 +531,133 @@ class RecordsCalculatorMixin(object):
             is set to this value.
         :param batchsize: int. Number of jobs to process in a batch when using a ProcesspoolJobHandler or a
             ThreadpoolJobHandler.
+        :param tile_size: int. The distance matrix is calculated in square blocks of this many trees per side.
+            Each job calculates one block.
+        :param condensed: Bool. Return a DistanceMatrix that holds only the condensed upper triangle of
+            distances, without ever building the square matrix.
+        :param checkpoint: str. Path of a .npy file. Finished blocks are written straight into this file,
+            through a memory map, and recorded in a manifest alongside it (see treedist.TileCheckpoint), so an
+            interrupted calculation picks up where it left off when called again with the same arguments.
+            The finished file can be read with DistanceMatrix.load.
         :return: treeCl.DistanceMatrix.
+
+        The blocks of the RF and weighted RF metrics ('rf', 'wrf', 'fastrf', 'fastwrf') are each calculated in
+        bulk from a treeCl.splits.SplitIndex (see tasks.split_distance_block_task).
         """
-        metrics = {'euc': tasks.EuclideanTreeDistance,
-                   'geo': tasks.GeodesicTreeDistance,
-                   'rf': tasks.RobinsonFouldsTreeDistance,
-                   'wrf': tasks.WeightedRobinsonFouldsTreeDistance,
-                   'fasteuc': tasks.EqualLeafSetEuclideanTreeDistance,
-                   'fastgeo': tasks.EqualLeafSetGeodesicTreeDistance,
-                   'fastrf': tasks.EqualLeafSetRobinsonFouldsTreeDistance,
-                   'fastwrf': tasks.EqualLeafSetWeightedRobinsonFouldsTreeDistance}
-        optioncheck(metric, list(metrics.keys()))
-        task_interface = metrics[metric]()
-        if metric.startswith('fast'):
-            trees = (PhyloTree(newick, False) for newick in self.trees)
+        optioncheck(metric, list(TREE_DISTANCE_TASKS.keys()))
+        trees = list(self.trees)
+        n = len(trees)
+        tiles = treedist.tile_ranges(n, tile_size)
+        todo = list(range(len(tiles)))
+        progress = None
+        if checkpoint is not None:
+            settings = dict(metric=metric, normalise=normalise, min_overlap=min_overlap,
+                            overlap_fail_value=overlap_fail_value,
+                            trees=hashlib.md5('\n'.join(trees).encode()).hexdigest())
+            progress = treedist.TileCheckpoint(checkpoint, self.names, settings, tile_size)
+            todo = progress.remaining
+            # Blocks go straight to the file
+            distances = progress.array
         else:
-            trees = self.trees
-        args = task_interface.scrape_args(trees, normalise, min_overlap, overlap_fail_value)
-        logger.debug('{}'.format(args))
+            # Blocks are written into the condensed vector as they arrive, so only the blocks in flight
+            # are ever held in memory, as well as the result
+            distances = np.zeros(binom_coeff(n))
+        blocks = self._tree_distance_blocks(metric, list(range(n)), [tiles[t] for t in todo], jobhandler,
+                                            normalise, min_overlap, overlap_fail_value, batchsize, show_progress)
+        try:
+            for i, block in blocks:
+                if progress is not None:
+                    progress.update(todo[i], block)
+                else:
+                    treedist.fill_condensed(distances, n, tiles[todo[i]], block)
+        finally:
+            blocks.close()
+            if progress is not None:
+                progress.save()
+        if condensed:
+            return DistanceMatrix.from_condensed(distances, self.names)
+        return DistanceMatrix.from_array(squareform(distances), self.names)
+
+    def extend_inter_tree_distances(self, dm, metric, jobhandler=default_jobhandler,
+                                    normalise=False, min_overlap=4, overlap_fail_value=0,
+                                    batchsize=1, show_progress=True, tile_size=treedist.DEFAULT_TILE_SIZE):
+        """ Extend a distance matrix, calculated by get_inter_tree_distances on some of the records of this
+        Collection, to cover all of them. Only the distances involving the records missing from `dm` are
+        calculated, in blocks, as in get_inter_tree_distances.
+        :param dm: treeCl.DistanceMatrix. Its names must all be names of records in this Collection.
+        :param metric: str. The tree distance metric that `dm` was calculated with.
+        The other parameters are as for get_inter_tree_distances, and should match the ones used for `dm`.
+        :return: treeCl.DistanceMatrix, with the names of `dm` first, in the same order, followed by the new
+            names, in Collection order. It is condensed if `dm` is.
+        """
+        optioncheck(metric, list(TREE_DISTANCE_TASKS.keys()))
+        old_names = dm.get_names()
+        lookup = {name: i for (i, name) in enumerate(self.names)}
+        missing = [name for name in old_names if name not in lookup]
+        if missing:
+            raise ValueError('Names in the distance matrix are not in the Collection: {}'.format(missing[:10]))
+        old = set(old_names)
+        new_names = [name for name in self.names if name not in old]
+        if not new_names:
+            return dm
+        n_old = len(old_names)
+        names = old_names + new_names
+        n = len(names)
+        order = [lookup[name] for name in names]
+
+        # Tiles covering only the columns of the new trees: new-vs-old blocks, and the
+        # upper triangle of new-vs-new
+        row_starts = list(range(0, n_old, tile_size)) + list(range(n_old, n, tile_size))
+        tiles = [(r, min(r + tile_size, n_old if r < n_old else n), c, min(c + tile_size, n))
+                 for r in row_starts for c in range(n_old, n, tile_size) if c >= r]
+
+        distances = np.zeros(binom_coeff(n), dtype=dm.condensed.dtype)
+        previous = dm.condensed
+        for i in range(n_old - 1):
+            start = treedist.condensed_index(n, i, i + 1)
+            old_start = treedist.condensed_index(n_old, i, i + 1)
+            distances[start:start + n_old - i - 1] = previous[old_start:old_start + n_old - i - 1]
+
+        blocks = self._tree_distance_blocks(metric, order, tiles, jobhandler, normalise, min_overlap,
+                                            overlap_fail_value, batchsize, show_progress)
+        try:
+            for i, block in blocks:
+                treedist.fill_condensed(distances, n, tiles[i], block)
+        finally:
+            blocks.close()
+        if dm.is_condensed:
+            return DistanceMatrix.from_condensed(distances, names)
+        return DistanceMatrix.from_array(squareform(distances), names)
+
+    def _tree_distance_blocks(self, metric, order, tiles, jobhandler, normalise, min_overlap,
+                              overlap_fail_value, batchsize, show_progress):
+        """
+        Generator of (i, block) pairs, in order of completion, where block is the block of tree distances
+        for tiles[i]. Tiles index into `order`, a list of record indices.
+        """
+        if not tiles:
+            return
+        task_interface = TREE_DISTANCE_TASKS[metric]()
+        all_trees = self.trees
+        trees = [all_trees[k] for k in order]
+        shared_key = None
+        if jobhandler.shares_memory:
+            # Use the collection's parsed trees - they are shared by all the blocks,
+            # and jobs refer to them by index
+            shared_key = ('inter_tree_distances', id(self), metric)
+            # The fast metrics take PhyloTrees, except those calculated from a SplitIndex, which reads Trees
+            from_splits = task_interface.get_block_task() is tasks.split_distance_block_task
+            parsed = self.phylotrees() if metric.startswith('fast') and not from_splits else self.parsed_trees()
+            trees = parutils.share(shared_key, [parsed[k] for k in order])
+        args = task_interface.scrape_block_args(trees, normalise, min_overlap, overlap_fail_value, tiles)
         msg = task_interface.name if show_progress else ''
-        array = jobhandler(task_interface.get_task(), args, msg, batchsize, nargs=binom_coeff(len(trees)))
-        return DistanceMatrix.from_array(squareform(array), self.names)
+        try:
+            for result in jobhandler.imap(task_interface.get_block_task(), args, msg, batchsize,
+                                          nargs=len(tiles), ordered=False):
+                yield result
+        finally:
+            if shared_key is not None:
+                parutils.unshare(shared_key)
 
 
 class Collection(RecordsHandler, RecordsCalculatorMixin):
@@ -486,29 +681,30 @@ class Collection(RecordsHandler, RecordsCalculatorMixin):
                              (rec.get_names() for rec in self.records))
         return len(all_headers)
 
-    def permuted_copy(self, partition=None):
-        """ Return a copy of the collection with all alignment columns permuted
+    def permuted_copy(self, partition=None, random_state=None):
+        """ Return a copy of the collection with all alignment columns permuted.
+        Columns are shuffled across all the loci in each group of the partition (one group
+        by default), and the loci keep their original lengths.
+        :param random_state: seed or numpy RandomState passed to ReplicateGenerator
         """
-        def take(n, iterable):
-            return [next(iterable) for _ in range(n)]
-
         if partition is None:
             partition = Partition([1] * len(self))
 
         index_tuples = partition.get_membership()
+        if random_state is not None and not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
 
         alignments = []
         for ix in index_tuples:
             concat = Concatenation(self, ix)
-            sites = concat.alignment.get_sites()
-            random.shuffle(sites)
-            d = dict(zip(concat.alignment.get_names(), [iter(x) for x in zip(*sites)]))
-            new_seqs = [[(k, ''.join(take(l, d[k]))) for k in d] for l in concat.lengths]
-
-            for seqs, datatype, name in zip(new_seqs, concat.datatypes, concat.names):
-                alignment = Alignment(seqs, datatype)
-                alignment.name = name
+            replicate = ReplicateGenerator(concat.alignment, random_state).permutation()
+            array, names = replicate.get_array(), replicate.get_names()
+            start = 0
+            for length, datatype, name in zip(concat.lengths, concat.datatypes, concat.names):
+                alignment = Alignment.from_array(np.ascontiguousarray(array[:, start:start + length]), names,
+                                                 datatype, name)
                 alignments.append(alignment)
+                start += length
 
         return self.__class__(records=sorted(alignments, key=lambda x: SORT_KEY(x.name)))
 
@@ -530,24 +726,30 @@ class Scorer(object):
             os.makedirs(cache_dir)
         if not os.path.exists(cache_dir):
             raise IOError('\'{}\' does not exist'.format(cache_dir))
+        self.index = ResultIndex(os.path.join(cache_dir, 'results.sqlite'))
 
     def get_id(self, grp):
         """
-        Return a hash of the tuple of indices that specify the group
+        Return a content address for the group: a hash of the task name, and the names
+        and alignment data of the loci in the group. Ids are stable between runs, so
+        results already in the cache directory are reused.
         """
-        thehash = hex(hash(grp))
-        if ISPY3:  # use default encoding to get bytes
-            thehash = thehash.encode()
-        return self.cache.get(grp, hashlib.sha1(thehash).hexdigest())
+        if grp in self.cache:
+            return self.cache[grp]
+        h = hashlib.sha1(self.task_interface.name.encode('utf-8') if self.task_interface.name else b'')
+        for i in grp:
+            h.update(self.collection[i].name.encode('utf-8'))
+            h.update(self.collection[i].get_digest().encode('utf-8'))
+        id_ = self.cache[grp] = h.hexdigest()
+        return id_
 
     def check_work_done(self, grp):
         """
-        Check for the existence of alignment and result files.
+        Check for the existence of the alignment file and the result.
         """
         id_ = self.get_id(grp)
         concat_file = os.path.join(self.cache_dir, '{}.phy'.format(id_))
-        result_file = os.path.join(self.cache_dir, '{}.{}.json'.format(id_, self.task_interface.name))
-        return os.path.exists(concat_file), os.path.exists(result_file)
+        return os.path.exists(concat_file), id_ in self.index
 
     def write_group(self, grp, overwrite=False, **kwargs):
         """
@@ -556,7 +758,6 @@ class Scorer(object):
         """
         id_ = self.get_id(grp)
         alignment_done, result_done = self.check_work_done(grp)
-        self.cache[grp] = id_
         al_filename = os.path.join(self.cache_dir, '{}.phy'.format(id_))
         qfile_filename = os.path.join(self.cache_dir, '{}.partitions.txt'.format(id_))
         if overwrite or not (alignment_done or result_done):
@@ -573,24 +774,49 @@ class Scorer(object):
         errors out if result not available.
         """
         id_ = self.get_id(grp)
-        self.cache[grp] = id_
-
-        # Check if this file is already processed
-        alignment_written, results_written = self.check_work_done(grp)
-
-        if not results_written:
-            if not alignment_written:
+        result = self.index.get(id_)
+        if result is None:
+            if not self.check_work_done(grp)[0]:
                 self.write_group(grp, **kwargs)
             logger.error('Alignment {} has not been analysed - run analyse_cache_dir'.format(id_))
             raise ValueError('Missing result')
-        else:
-            with open(self.get_result_file(id_)) as fl:
-                return json.load(fl)
+        return result
+
+    def discard_group_result(self, grp):
+        """
+        Delete the stored result for a group, so that it is analysed again
+        """
+        id_ = self.get_id(grp)
+        self.index.discard(id_)
+        result_file = self.get_result_file(id_)
+        if os.path.exists(result_file):
+            os.remove(result_file)
 
     def get_result_file(self, id_):
+        """
+        Location the task may write its result to while it runs. Results are moved into
+        the index once they are collected.
+        """
         f = os.path.join(self.cache_dir, id_ + '.phy')
         return f.replace('.phy', '.{}.json'.format(self.task_interface.name))
 
+    def _index_result_file(self, id_):
+        """
+        Move a result that was written to disk by a task (e.g. in an interrupted run) into the index
+        """
+        outfile = self.get_result_file(id_)
+        if not os.path.exists(outfile):
+            return False
+        try:
+            with open(outfile) as fl:
+                result = json.load(fl)
+        except ValueError:
+            logger.warning('Ignoring unreadable result file {}'.format(outfile))
+            return False
+        self.index.put(id_, self.task_interface.name, result)
+        os.remove(outfile)
+        return True
+
     def write_partition(self, p, overwrite=False, **kwargs):
         for grp in p.get_membership():
             self.write_group(grp, overwrite, **kwargs)
@@ -606,21 +832,33 @@ class Scorer(object):
           RaxmlTaskInterface: -------- partition_files=None, model=None, threads=1
           FastTreeTaskInterface: ----- No kwargs
         """
+        files = glob.glob(os.path.join(self.cache_dir, '*.phy'))
+        return self._analyse_files(files, jobhandler, batchsize, **kwargs)
+
+    def analyse_groups(self, groups, jobhandler=None, batchsize=1, **kwargs):
+        """
+        Launch analysis for the unscored alignments of the given groups only, rather than
+        everything in the cache directory. The alignments must already have been written
+        with write_group. KWargs are as for analyse_cache_dir.
+        """
+        files = [os.path.join(self.cache_dir, '{}.phy'.format(self.get_id(grp))) for grp in groups]
+        return self._analyse_files([f for f in files if os.path.exists(f)], jobhandler, batchsize, **kwargs)
+
+    def _analyse_files(self, files, jobhandler=None, batchsize=1, **kwargs):
         if jobhandler is None:
             jobhandler = SequentialJobHandler()
-        files = glob.glob(os.path.join(self.cache_dir, '*.phy'))
         #logger.debug('Files - {}'.format(files))
         records = []
+        ids = []
         outfiles = []
-        dna = self.collection[0].is_dna() # THIS IS ONLY A GUESS AT SEQ TYPE!!
         for infile in files:
             id_ = fileIO.strip_extensions(infile)
-            outfile = self.get_result_file(id_)
-            #logger.debug('Looking for {}: {}'.format(outfile, os.path.exists(outfile)))
-            if not os.path.exists(outfile):
-                record = Alignment(infile, 'phylip', True)
-                records.append(record)
-                outfiles.append(outfile)
+            if id_ in self.index or self._index_result_file(id_):
+                continue
+            record = Alignment(infile, 'phylip', True)
+            records.append(record)
+            ids.append(id_)
+            outfiles.append(self.get_result_file(id_))
 
         if len(records) == 0:
             return []
@@ -629,17 +867,22 @@ class Scorer(object):
         # logger.debug('Args - {}'.format(args))
 
         with fileIO.TempFileList(to_delete):
-            result = jobhandler(self.task_interface.get_task(), args, 'Cache dir analysis', batchsize)
-            for (out, res) in zip(outfiles, result):
-                if not os.path.exists(out) and res:
-                    with open(out, 'w') as outfl:
-                        json.dump(res, outfl)
+            result = jobhandler(self.task_interface.get_task(), args, 'Cache dir analysis', batchsize,
+                                costs=job_costs(records))
+            for (id_, res) in zip(ids, result):
+                if res:
+                    self.index.put(id_, self.task_interface.name, res)
+                    outfile = self.get_result_file(id_)
+                    if os.path.exists(outfile):
+                        os.remove(outfile)
+                else:
+                    self._index_result_file(id_)
 
         return result
 
     def get_partition_score(self, p):
         """
-        Assumes analysis is done and written to id.json!
+        Assumes analysis is done and stored in the result index!
         """
         scores = []
         for grp in p.get_membership():
@@ -683,17 +926,28 @@ class Scorer(object):
         return results
 
     def clean_cache(self):
-        files = glob.glob(os.path.join(self.cache_dir, '*.json'))
-        for f in files:
-            id_ = fileIO.strip_extensions(f)
-            alfile = os.path.join(self.cache_dir, '{}.phy'.format(id_))
-            qfile = os.path.join(self.cache_dir, '{}.partitions.txt'.format(id_))
-            if os.path.exists(alfile): os.remove(alfile)
-            if os.path.exists(qfile): os.remove(qfile)
-            alfile = os.path.join(self.cache_dir, '{}.phy.reduced'.format(id_))
-            qfile = os.path.join(self.cache_dir, '{}.partitions.txt.reduced'.format(id_))
-            if os.path.exists(alfile): os.remove(alfile)
-            if os.path.exists(qfile): os.remove(qfile)
+        """
+        Remove the alignment files of all the groups that have results
+        """
+        for id_ in self.index.ids():
+            self._remove_alignment_files(id_)
+
+    def clean_groups(self, groups):
+        """
+        Remove the alignment files of the given groups, keeping the results
+        """
+        for grp in groups:
+            self._remove_alignment_files(self.get_id(grp))
+
+    def _remove_alignment_files(self, id_):
+        alfile = os.path.join(self.cache_dir, '{}.phy'.format(id_))
+        qfile = os.path.join(self.cache_dir, '{}.partitions.txt'.format(id_))
+        if os.path.exists(alfile): os.remove(alfile)
+        if os.path.exists(qfile): os.remove(qfile)
+        alfile = os.path.join(self.cache_dir, '{}.phy.reduced'.format(id_))
+        qfile = os.path.join(self.cache_dir, '{}.partitions.txt.reduced'.format(id_))
+        if os.path.exists(alfile): os.remove(alfile)
+        if os.path.exists(qfile): os.remove(qfile)
 
     def simulate(self, partition, outdir, jobhandler=default_jobhandler, batchsize=1, **kwargs):
         """
@@ -781,17 +1035,23 @@ class Optimiser(object):
         self.prev_partition = None
         if partition is not None:
             self.set_partition(partition)
+        self.ncat = kwargs.get('ncat', 4)
         self.insts = self.init_perlocus_likelihood_objects(**kwargs)
+        self.locus_models = self.init_locus_models()
+        self._partials = {}
         self.names_to_indices = dict((rec.name, i) for (i, rec) in enumerate(scorer.collection))
         self.iterations = 0
         self.log = []
         self.lktable = None
         self.table = None
+        self._transition_matrices = {}
+        self._locus_likelihoods = None
 
-    def expect(self, use_proportions=True):
+    def expect(self, use_proportions=True, jobhandler=None, batchsize=1, show_progress=True):
         """ The Expectation step of the CEM algorithm """
         changed = self.get_changed(self.partition, self.prev_partition)
-        lk_table = self.generate_lktable(self.partition, changed, use_proportions)
+        lk_table = self.generate_lktable(self.partition, changed, use_proportions, jobhandler, batchsize,
+                                         show_progress)
         self.table = self.likelihood_table_to_probs(lk_table)
 
     def classify(self, table, weighted_choice=False, transform=None):
@@ -816,17 +1076,29 @@ class Optimiser(object):
         self.set_partition(new_partition)
 
     def maximise(self, **kwargs):
-        """ The Maximisation step of the CEM algorithm """
-        self.scorer.write_partition(self.partition)
-        self.scorer.analyse_cache_dir(**kwargs)
+        """ The Maximisation step of the CEM algorithm.
+        Only the groups whose membership changed since the previous partition (or that have no
+        result yet) are written out and re-analysed; the results of the others are reused. """
+        dirty = self.get_dirty_groups(self.partition, self.prev_partition)
+        for grp in dirty:
+            self.scorer.write_group(grp)
+        self.scorer.analyse_groups(dirty, **kwargs)
         self.likelihood = self.scorer.get_partition_score(self.partition)
-        self.scorer.clean_cache()
-        changed = self.get_changed(self.partition, self.prev_partition)
+        self.scorer.clean_groups(dirty)
+        # Loci in re-analysed groups get new parameters; the others keep their models and likelihoods
+        changed = set(self.get_changed(self.partition, self.prev_partition)).union(*dirty)
+        for grp in dirty:
+            self._transition_matrices.pop(grp, None)
         self.update_perlocus_likelihood_objects(self.partition, changed)
-        return self.partition, self.likelihood, sum(inst.get_likelihood() for inst in self.insts)
-
-    def iterate(self, use_proportions=True, weighted_choice=False, transform=None, **kwargs):
-        self.expect(use_proportions)
+        if self._locus_likelihoods is None:
+            self._locus_likelihoods = np.zeros(len(self.insts))
+            changed = range(len(self.insts))
+        for i in changed:
+            self._locus_likelihoods[i] = self.insts[i].get_likelihood()
+        return self.partition, self.likelihood, self._locus_likelihoods.sum()
+
+    def iterate(self, use_proportions=True, weighted_choice=False, transform=None, show_progress=True, **kwargs):
+        self.expect(use_proportions, kwargs.get('jobhandler'), kwargs.get('batchsize', 1), show_progress)
         self.classify(self.table, weighted_choice, transform)
         self.iterations += 1
         result = self.maximise(**kwargs)
@@ -858,6 +1130,18 @@ class Optimiser(object):
             insts.append(gamma)
         return insts
 
+    def init_locus_models(self):
+        """
+        The substitution model of each locus, as (key, transition matrix, alpha). Loci with the same
+        key share a model, and are evaluated together in generate_lktable.
+        """
+        models = []
+        for i, rec in enumerate(self.scorer.collection):
+            p = rec.parameters.partitions
+            tm = self._build_transition_matrix({'model': p.model, 'frequencies': p.frequencies, 'rates': p.rates})
+            models.append((('locus', i), tm, p.alpha))
+        return models
+
     def get_cluster_at_index(self, i):
         """ 
         Return the cluster membership of locus i, according to current
@@ -874,6 +1158,14 @@ class Optimiser(object):
             return list(range(len(self.insts)))
         return set(flatten_list(set(p1) - set(p2)))
 
+    def get_dirty_groups(self, p1, p2):
+        """
+        Return the groups of partition p1 that need to be analysed: those that
+        are not in partition p2, and those that have no result yet
+        """
+        previous = set() if p2 is None else set(p2)
+        return [grp for grp in p1 if grp not in previous or not self.scorer.check_work_done(grp)[1]]
+
     def update_perlocus_likelihood_objects_old(self, partition, changed):
         results = self.scorer.get_partition_results(partition)
         UNPARTITIONED=False
@@ -900,21 +1192,34 @@ class Optimiser(object):
                 self._update_likelihood_model(inst, p, result['ml_tree'])
 
     def update_perlocus_likelihood_objects(self, partition, changed):
+        """
+        Update the likelihood models of the loci in `changed` with the parameters inferred
+        for their new group. The other loci are in groups that were not re-analysed, so
+        their models are left as they are.
+        Transition matrices are built once per group, and shared by its members.
+        """
+        changed = set(changed)
+        groups = set(partition)
+        for grp in list(self._transition_matrices):
+            if grp not in groups:
+                del self._transition_matrices[grp]
+
         for grp in partition:
+            members = [i for i in grp if i in changed]
+            if not members:
+                continue
             result = self.scorer.get_group_result(grp)
             tree = result['ml_tree']
-            for i in grp:
-                self._update_likelihood_model(self.insts[i], result['partitions']['0'], tree)
-                # self.insts[i].set_tree(tree)
-                # self.insts[i].update_alpha(result['partitions']['0']['alpha'])
-
-    def _update_likelihood_model(self, inst, partition_parameters, tree):
-        """ 
-        Set parameters of likelihood model - inst -
-        using values in dictionary - partition_parameters -,
-        and - tree -
-        """
-        # Build transition matrix from dict
+            partition_parameters = result['partitions']['0']
+            tm = self._transition_matrices.get(grp)
+            if tm is None:
+                tm = self._transition_matrices[grp] = self._build_transition_matrix(partition_parameters)
+            for i in members:
+                self._update_likelihood_model(self.insts[i], partition_parameters, tree, tm)
+                self.locus_models[i] = (grp, tm, partition_parameters['alpha'])
+
+    def _build_transition_matrix(self, partition_parameters):
+        """ Build transition matrix from dict """
         model = partition_parameters['model']
         freqs = partition_parameters.get('frequencies')
         if model == 'LG':
@@ -926,15 +1231,32 @@ class Optimiser(object):
             subs_model = phylo_utils.models.GTR(rates, freqs, True)
         else:
             raise ValueError("Can't handle this model: {}".format(model))
-        tm = phylo_utils.markov.TransitionMatrix(subs_model)
-        
+        return phylo_utils.markov.TransitionMatrix(subs_model)
+
+    def _update_likelihood_model(self, inst, partition_parameters, tree, tm=None):
+        """ 
+        Set parameters of likelihood model - inst -
+        using values in dictionary - partition_parameters -,
+        and - tree -. The transition matrix is built from
+        partition_parameters unless one is given.
+        """
+        if tm is None:
+            tm = self._build_transition_matrix(partition_parameters)
+
         # Read alpha value
         alpha = partition_parameters['alpha']
         inst.set_tree(tree)
         inst.update_alpha(alpha)
         inst.update_transition_matrix(tm)
 
-    def generate_lktable(self, partition, changed, use_proportions=True):
+    def generate_lktable(self, partition, changed, use_proportions=True, jobhandler=None, batchsize=1,
+                         show_progress=True):
+        """
+        Log likelihood of each locus (rows) on the tree of each group (columns), plus the
+        log proportion of loci in the group. Only the rows of the loci in `changed` are
+        recalculated. Each tree is parsed once, and loci that share a model are evaluated on it
+        together (see likelihood.LocusBlock). The trees are evaluated in parallel by jobhandler.
+        """
         trees = self.scorer.get_partition_trees(partition)
 
         # Try to call up table from previous step
@@ -945,19 +1267,72 @@ class Optimiser(object):
             total = partition.num_elements()
             logproportions = np.log(sizes/total)
         else:
-            logproportions = np.zeros(partition.num_elements())
+            logproportions = np.zeros(len(trees))
 
-        lktable = np.zeros((len(self.insts), self.numgrp))
-        for i, gamma in enumerate(self.insts):
-            if i in changed or prev_lktable is None:
-                for j, t in enumerate(trees):
-                    gamma.set_tree(t)
-                    lktable[i, j] = logproportions[j] + gamma.get_likelihood()
-            else:
-                lktable[i] = prev_lktable[i]
+        if prev_lktable is None:
+            todo = list(range(len(self.insts)))
+            lktable = np.zeros((len(self.insts), self.numgrp))
+        else:
+            changed = set(changed)
+            todo = [i for i in range(len(self.insts)) if i in changed]
+            lktable = prev_lktable.copy()
+
+        if todo:
+            order, blocks = self._locus_blocks(todo)
+            loglks = self._tree_loglikelihoods(trees, blocks, jobhandler, batchsize, show_progress)
+            lktable[order] = loglks.T + logproportions
         self.lktable = lktable
         return lktable
 
+    def _get_partials(self, i):
+        """ Partials and weights of the site patterns of locus i """
+        if i not in self._partials:
+            c = self.scorer.collection
+            rec = c[i]
+            patterns, weights = rec.get_site_patterns()
+            self._partials[i] = (alignment_to_partials(patterns, list(c.species_set() - set(rec.get_names()))),
+                                 weights)
+        return self._partials[i]
+
+    def _locus_blocks(self, indices):
+        """
+        Group the loci by model into LocusBlocks.
+        Returns the locus indices in block order, and the blocks.
+        """
+        grouped = {}
+        keys = []
+        for i in indices:
+            key = self.locus_models[i][0]
+            if key not in grouped:
+                grouped[key] = []
+                keys.append(key)
+            grouped[key].append(i)
+        order = []
+        blocks = []
+        for key in keys:
+            members = grouped[key]
+            _, tm, alpha = self.locus_models[members[0]]
+            partials, weights = list(zip(*[self._get_partials(i) for i in members]))
+            blocks.append(LocusBlock(list(partials), tm, alpha, self.ncat, list(weights)))
+            order.extend(members)
+        return order, blocks
+
+    def _tree_loglikelihoods(self, trees, blocks, jobhandler=None, batchsize=1, show_progress=True):
+        """ Array (trees x loci) of log likelihoods, with one job per tree """
+        if jobhandler is None:
+            jobhandler = SequentialJobHandler()
+        key = ('lktable', id(self))
+        shared = getattr(jobhandler, 'shares_memory', False)
+        try:
+            blocks_arg = parutils.share(key, blocks) if shared else blocks
+            args = [(tree, blocks_arg) for tree in trees]
+            msg = 'Likelihood table' if show_progress else ''
+            result = jobhandler(tree_loglikelihoods, args, msg, batchsize)
+        finally:
+            if shared:
+                parutils.unshare(key)
+        return np.array(result)
+
     def likelihood_table_to_probs(self, lktable):
         """
         Calculates this formula (1), given the log of the numerator as input
@@ -1020,12 +1395,7 @@ class Optimiser(object):
         optimisation of the same partition can be done with a
         different model """
         for grp in partition.get_membership():
-            grpid = self.scorer.get_id(grp)
-            cache_dir = self.scorer.cache_dir
-            prog = self.scorer.task_interface.name
-            filename = os.path.join(cache_dir, '{}.{}.json'.format(grpid, prog))
-            if os.path.exists(filename):
-                os.unlink(filename)
+            self.scorer.discard_group_result(grp)
 
     def likelihood_distance_matrix(self):
         # Assume all parameters are already updated
@@ -7,8 +7,6 @@ import numpy as np
 from .alignment import Alignment
 from .tasks import TreeCollectionTaskInterface
 from .utils.decorators import lazyprop
-from .utils import concatenate, fileIO
-from Bio import AlignIO
 
 __author__ = 'kgori'
 
@@ -53,13 +51,11 @@ class Concatenation(object):
 
     @lazyprop
     def alignment(self):
-        msas = [self.collection[i].to_biopython_msa() for i in self.indices]
-        conc = concatenate(msas)
-        for seq in conc: seq.description=''
-        with fileIO.TempFile() as tmp:
-            AlignIO.write(conc, tmp, 'fasta')
-            al = Alignment(tmp, 'fasta', True)
-        return al
+        """
+        The concatenated alignment, built in memory. Taxa missing from a locus are padded with
+        unknown data.
+        """
+        return Alignment([self.collection[i] for i in self.indices], backend='array')
 
     @lazyprop
     def names(self):
@@ -7,11 +7,17 @@ from builtins import object
 from past.utils import old_div
 
 # standard lib
+import json
 import sys
 
 # third party
 import numpy as np
 import pandas as pd
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import squareform
 import sklearn
 
 # treeCl
@@ -21,18 +27,9 @@ from .utils import fileIO
 # Utilities
 def isconnected(mask):
     """ Checks that all nodes are reachable from the first node - i.e. that the
-    graph is fully connected. """
+    graph is fully connected. The mask can be a dense array or a scipy.sparse matrix. """
 
-    nodes_to_check = list((np.where(mask[0, :])[0])[1:])
-    seen = [True] + [False] * (len(mask) - 1)
-    while nodes_to_check and not all(seen):
-        node = nodes_to_check.pop()
-        reachable = np.where(mask[node, :])[0]
-        for i in reachable:
-            if not seen[i]:
-                nodes_to_check.append(i)
-                seen[i] = True
-    return all(seen)
+    return connected_components(mask, directed=False)[0] == 1
 
 
 def affinity(
@@ -61,6 +58,27 @@ def affinity(
     return affinity_matrix
 
 
+def sparse_affinity(matrix, mask, scale=None):
+    """
+    Sparse version of affinity(), evaluated only at the nonzero entries of a sparse mask
+    (e.g. from sparse_kmask). Scale is a vector of local scales (e.g. kth nearest neighbour
+    distances), whose outer product is the scale matrix used by affinity().
+    Returns a scipy.sparse CSR matrix, with a zero diagonal.
+    """
+    assert isconnected(mask)
+    mask = scipy.sparse.coo_matrix(mask)
+    rows, cols = mask.row, mask.col
+    keep = rows != cols
+    rows, cols = rows[keep], cols[keep]
+    scale = (scale[rows] * scale[cols]) if scale is not None else 1.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = -matrix[rows, cols] ** 2 / scale
+    # inputs where distance = 0 and scale = 0 result in NaN:
+    # the next line replaces NaNs with -1.0
+    scaled[np.isnan(scaled)] = -1.0
+    return scipy.sparse.csr_matrix((np.exp(scaled), (rows, cols)), shape=mask.shape)
+
+
 def double_centre(matrix, square_input=True):
     """ Double-centres the input matrix: From each element: Subtract the row
     mean Subtract the column mean Add the grand mean Divide by -2 Method
@@ -79,7 +97,7 @@ def double_centre(matrix, square_input=True):
     m /= -2
     return m
 
-def _estimate_additive_constant(matrix):
+def _estimate_additive_constant(matrix, solver='auto'):
     """
     CMDS Additive Constant: correction for non-Euclidean distances.
     Procedure taken from R function cmdscale.
@@ -97,7 +115,35 @@ def _estimate_additive_constant(matrix):
     \-------+-------/
 
     corrected matrix = matrix + additive constant (diagonal kept as 0)
+
+    The block matrix is never built: ARPACK (scipy.sparse.linalg.eigs) finds the
+    eigenvalue with largest real part using only products with it, which cost two
+    n x n matrix-vector products each. With solver='auto', small matrices (block matrix
+    smaller than ARPACK_MIN_SIZE), or an ARPACK failure to converge, use the dense
+    calculation.
     """
+    errors.optioncheck(solver, ['auto', 'lapack', 'arpack'])
+    n = matrix.shape[0]
+    if solver == 'arpack' or (solver == 'auto' and 2 * n >= ARPACK_MIN_SIZE):
+        topright = 2 * double_centre(matrix)
+        bottomright = -4 * double_centre(matrix, square_input=False)
+
+        def matvec(v):
+            v = np.ravel(v)
+            x, y = v[:n], v[n:]
+            return np.concatenate([topright.dot(y), bottomright.dot(y) - x])
+
+        op = scipy.sparse.linalg.LinearOperator((2 * n, 2 * n), matvec=matvec, dtype=float)
+        try:
+            vals = scipy.sparse.linalg.eigs(op, k=1, which='LR', return_eigenvectors=False)
+            return max(np.real(vals))
+        except scipy.sparse.linalg.ArpackNoConvergence:
+            pass
+    return _dense_additive_constant(matrix)
+
+
+def _dense_additive_constant(matrix):
+    """ Dense version of _estimate_additive_constant, building the full block matrix """
     topleft = np.zeros(matrix.shape)
     topright = 2*double_centre(matrix)
     bottomleft = -np.eye(matrix.shape[0])
@@ -107,8 +153,8 @@ def _estimate_additive_constant(matrix):
     return max(np.real(np.linalg.eigvals(Z)))
 
 
-def _additive_correct(matrix):
-    addc = _estimate_additive_constant(matrix)
+def _additive_correct(matrix, solver='auto'):
+    addc = _estimate_additive_constant(matrix, solver)
     tmp = matrix + addc
     np.fill_diagonal(tmp, 0)
     return tmp
@@ -156,6 +202,10 @@ def normalise_rows(matrix):
     return matrix / lengths[:, np.newaxis]
 
 
+# Rows of the distance matrix partially sorted at a time by knn, to bound the memory used
+KNN_CHUNK_ELEMENTS = 2 ** 22
+
+
 def kdists(matrix, k=7, ix=None):
     """ Returns the k-th nearest distances, row-wise, as a column vector """
 
@@ -166,10 +216,50 @@ def kdists(matrix, k=7, ix=None):
 def kindex(matrix, k):
     """ Returns indices to select the kth nearest neighbour"""
 
-    ix = (np.arange(len(matrix)), matrix.argsort(axis=0)[k])
+    ix = (np.arange(len(matrix)), np.argpartition(matrix, k, axis=0)[k])
     return ix
 
 
+def knn(matrix, k):
+    """
+    Nearest neighbours of each point (row), nearest first, found by partial sorting a block of
+    rows at a time. As in kdists, each point is its own 0th nearest neighbour, so
+    dists[:, k] is the same as kdists(matrix, k).
+    :param matrix: symmetric distance array
+    :param k: int. Number of neighbours (capped at n - 1)
+    :return: (index, dists), int and float arrays of shape (n, k+1)
+    """
+    n = len(matrix)
+    k = min(k, n - 1)
+    index = np.empty((n, k + 1), dtype=np.intp)
+    dists = np.empty((n, k + 1), dtype=matrix.dtype)
+    step = max(1, KNN_CHUNK_ELEMENTS // max(n, 1))
+    for start in range(0, n, step):
+        block = matrix[start:start + step]
+        part = np.argpartition(block, k, axis=1)[:, :k + 1]
+        d = np.take_along_axis(block, part, 1)
+        order = np.argsort(d, axis=1, kind='mergesort')
+        index[start:start + step] = np.take_along_axis(part, order, 1)
+        dists[start:start + step] = np.take_along_axis(d, order, 1)
+    return index, dists
+
+
+def sparse_kmask(index, k, logic='or'):
+    """ Sparse version of kmask, built from the neighbour index returned by knn.
+    Points tied with the kth nearest neighbour are not included, unlike kmask.
+    Returns a boolean scipy.sparse CSR matrix. """
+
+    n = len(index)
+    rows = np.repeat(np.arange(n), k + 1)
+    mask = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, index[:, :k + 1].ravel())),
+                                   shape=(n, n))
+    if logic == 'or' or logic == '|':
+        return mask.maximum(mask.T).tocsr()
+    elif logic == 'and' or logic == '&':
+        return mask.multiply(mask.T).tocsr()
+    return mask
+
+
 def kmask(matrix, k=7, dists=None, logic='or'):
     """ Creates a boolean mask to include points within k nearest
     neighbours, and exclude the rest.
@@ -201,11 +291,16 @@ def laplace(affinity_matrix, shi_malik_type=False):
 
     L = (D^-1).A - `Shi-Malik` type, from Shi Malik paper"""
 
-    diagonal = affinity_matrix.sum(axis=1) - affinity_matrix.diagonal()
+    diagonal = np.asarray(affinity_matrix.sum(axis=1)).ravel() - affinity_matrix.diagonal()
     zeros = diagonal <= 1e-10
     diagonal[zeros] = 1
     if (diagonal <= 1e-10).any():  # arbitrarily small value
         raise ZeroDivisionError
+    if scipy.sparse.issparse(affinity_matrix):
+        if shi_malik_type:
+            return scipy.sparse.diags(1 / diagonal).dot(affinity_matrix).tocsr()
+        inv_root = scipy.sparse.diags(1 / np.sqrt(diagonal))
+        return inv_root.dot(affinity_matrix).dot(inv_root).tocsr()
     if shi_malik_type:
         inv_d = np.diag(1 / diagonal)
         return inv_d.dot(affinity_matrix)
@@ -288,12 +383,88 @@ def binsearch_mask(matrix, logic='or'):
     return k, mask, scale
 
 
-def eigen(matrix):
+def binsearch_sparse_mask(matrix, logic='or'):
+    """
+    Sparse version of binsearch_mask. The nearest neighbours are found once, by knn (and
+    again, for more neighbours, only if the search goes beyond them), instead of sorting the
+    matrix at every step, and connectivity is checked on the sparse graph.
+    :return: k, sparse mask, vector of kth nearest neighbour distances (the local scales -
+        their outer product is the scale matrix returned by binsearch_mask)
+    """
+    n = len(matrix)
+    mink = 1
+    maxk = n
+    guessk = int(np.log(maxk).round())
+    table = []
+
+    def neighbours(k):
+        if not table or table[0].shape[1] <= min(k, n - 1):
+            table[:] = knn(matrix, 2 * k)
+        return table
+
+    result = (guessk, None)
+    while maxk - mink != 1:
+        index, dists = neighbours(guessk)
+        test_mask = sparse_kmask(index, guessk, logic=logic)
+        if isconnected(test_mask) and (dists[:, guessk] > 1e-6).all():
+            maxk = guessk  # either correct or too high
+            result = (guessk, test_mask)
+            guessk = mink + (guessk - mink) // 2  # try a lower number
+        else:
+            mink = guessk  # too low
+            guessk += (maxk - guessk) // 2
+
+    if result[0] == guessk + 1:
+        k, mask = result
+    else:
+        k = guessk + 1
+        mask = sparse_kmask(neighbours(k)[0], k, logic=logic)
+    return k, mask, neighbours(k)[1][:, k]
+
+
+# Dense matrices at least this large are truncated-eigensolved by ARPACK, rather than LAPACK
+ARPACK_MIN_SIZE = 1000
+
+
+def eigen(matrix, n=None, solver='auto'):
     """ Calculates the eigenvalues and eigenvectors of the input matrix.
     Returns a tuple of (eigenvalues, eigenvectors, cumulative percentage of
     variance explained). Eigenvalues and eigenvectors are sorted in order of
-    eigenvalue magnitude, high to low """
-
+    eigenvalue magnitude, high to low.
+    If n is given (and smaller than the matrix), only the n largest eigenpairs are found,
+    either by LAPACK (scipy.linalg.eigh with subset_by_index) or by Lanczos iteration
+    (ARPACK, via scipy.sparse.linalg.eigsh, which also accepts scipy.sparse matrices and
+    costs about O(N^2 n) on a dense N x N matrix). The variance explained can't then be
+    relative to the sum of all the positive eigenvalues, as it is for the full decomposition,
+    so it is relative to the trace of the matrix, or to the sum of the eigenvalues found, if
+    that is larger. This is never less than the full decomposition's value, and depends on n,
+    so Decomp.coords_by_cutoff redoes the full decomposition for a truncated result.
+    :param solver: 'auto', 'lapack' or 'arpack'. 'auto' uses ARPACK for sparse or large
+        (>= ARPACK_MIN_SIZE) matrices.
+    """
+    errors.optioncheck(solver, ['auto', 'lapack', 'arpack'])
+    size = matrix.shape[0]
+    if n is not None and n < size - 1:
+        if solver == 'auto':
+            solver = ('arpack' if scipy.sparse.issparse(matrix) or size >= ARPACK_MIN_SIZE
+                      else 'lapack')
+        if solver == 'arpack':
+            vals, vecs = scipy.sparse.linalg.eigsh(matrix, k=n, which='LA')
+        else:
+            if scipy.sparse.issparse(matrix):
+                matrix = matrix.toarray()
+            vals, vecs = scipy.linalg.eigh(matrix, subset_by_index=[size - n, size - 1])
+        ind = vals.argsort()[::-1]
+        vals = vals[ind]
+        vecs = vecs[:, ind]
+        vals_ = vals.copy()
+        vals_[vals_ < 0] = 0.
+        total = max(matrix.diagonal().sum(), vals_.sum())
+        cum_var_exp = np.cumsum(vals_ / total) if total > 0 else np.zeros(n)
+        return Decomp(matrix.copy(), vals, vecs, cum_var_exp, truncated=True)
+
+    if scipy.sparse.issparse(matrix):
+        matrix = matrix.toarray()
     (vals, vecs) = np.linalg.eigh(matrix)
     ind = vals.argsort()[::-1]
     vals = vals[ind]
@@ -304,17 +475,19 @@ def eigen(matrix):
     return Decomp(matrix.copy(), vals, vecs, cum_var_exp)
 
 
-def _embedding_classical_mds(matrix, dimensions=3, additive_correct=False):
+def _embedding_classical_mds(matrix, dimensions=3, additive_correct=False, solver='auto'):
     """
-    Private method to calculate CMDS embedding
+    Private method to calculate CMDS embedding. Only the leading `dimensions` eigenpairs
+    are computed.
     :param dimensions: (int)
+    :param solver: eigensolver, passed to eigen()
     :return: coordinate matrix (np.array)
     """
     if additive_correct:
-        dbc = double_centre(_additive_correct(matrix))
+        dbc = double_centre(_additive_correct(matrix, solver))
     else:
         dbc = double_centre(matrix)
-    decomp = eigen(dbc)
+    decomp = eigen(dbc, dimensions, solver=solver)
     lambda_ = np.diag(np.sqrt(np.abs(decomp.vals[:dimensions])))
     evecs = decomp.vecs[:, :dimensions]
     coords = evecs.dot(lambda_)
@@ -403,20 +576,28 @@ def _embedding_kernel_pca(matrix, dimensions=3, affinity_matrix=None,
 class Decomp(object):
     """ Eigen decomposition result """
 
-    def __init__(self, matrix, vals, vecs, cve):
+    def __init__(self, matrix, vals, vecs, cve, truncated=False):
         self.matrix = matrix
         self.vals = vals
         self.vecs = vecs
         self.cve = cve
+        self.truncated = truncated  # only the leading eigenpairs were found (see eigen)
 
     def __str__(self):
         return '\n'.join([str(self.vals), str(self.vecs), str(self.cve)])
 
     def coords_by_cutoff(self, cutoff=0.80):
         """ Returns fitted coordinates in as many dimensions as are needed to
-        explain a given amount of variance (specified in the cutoff) """
-
-        i = np.where(self.cve >= cutoff)[0][0]
+        explain a given amount of variance (specified in the cutoff).
+        The variance explained by a truncated decomposition is approximate, so the full
+        decomposition is done first in that case. """
+
+        if self.truncated:
+            return eigen(self.matrix).coords_by_cutoff(cutoff)
+        reached = np.where(self.cve >= cutoff)[0]
+        if len(reached) == 0:
+            raise ValueError('No number of dimensions explains {} of the variance'.format(cutoff))
+        i = reached[0]
         coords_matrix = self.vecs[:, :i + 1]
         return coords_matrix, self.cve[i]
 
@@ -456,14 +637,139 @@ class CoordinateMatrix(Matrix):
         self.df = pd.DataFrame(array, index=names)
 
 
+def _condensed_positions(n, i, j):
+    """
+    Positions of the (i, j) elements, i != j, of an n x n symmetric matrix in its condensed
+    (scipy.spatial.distance.squareform) representation. Works elementwise on arrays.
+    """
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - (i * (i + 1)) // 2 + j - i - 1
+
+
+def _condensed_size(length):
+    """ Size n of the n x n matrix whose condensed form has the given length """
+    return int(round((1 + np.sqrt(1 + 8 * length)) / 2))
+
+
 class DistanceMatrix(Matrix):
+    """
+    Square matrix of pairwise distances, with names. The distances are held either as a
+    square pandas DataFrame (df), or, for very large matrices, as just the condensed upper
+    triangle (see from_condensed and load), which can be float32 and memory-mapped from a
+    .npy file. For a condensed matrix, df and to_array() build the square matrix on demand,
+    and row(i) gets a single row without building it.
+    """
     def __init__(self):
-        self.df = pd.DataFrame()
+        self._df = pd.DataFrame()
+        self._condensed = None
+        self._names = None
 
     def __eq__(self, other):
         if (np.abs(self.sort().values - other.sort().values) < 1e-10).all():
             return True
 
+    def __len__(self):
+        return _condensed_size(len(self._condensed)) if self.is_condensed else len(self._df)
+
+    def __repr__(self):
+        if self.is_condensed and self._df is None:
+            return '<condensed DistanceMatrix: {0} x {0}, {1}>'.format(len(self), self._condensed.dtype)
+        return repr(self.df)
+
+    @property
+    def df(self):
+        if self._df is None:
+            self._df = pd.DataFrame(self.to_array(), index=self._names, columns=self._names)
+        return self._df
+
+    @df.setter
+    def df(self, value):
+        self._df = value
+        self._condensed = None
+        self._names = None
+
+    @property
+    def is_condensed(self):
+        return self._condensed is not None
+
+    @property
+    def condensed(self):
+        """ The condensed upper triangle of distances, as used by scipy.spatial.distance """
+        if self.is_condensed:
+            return self._condensed
+        return squareform(self._df.values)
+
+    @property
+    def shape(self):
+        n = len(self)
+        return (n, n)
+
+    def to_array(self):
+        if self.is_condensed:
+            return squareform(self._condensed)
+        return self._df.values
+
+    def row(self, i):
+        """ Distances from the ith item to all the others, as a 1d array """
+        if not self.is_condensed:
+            return self._df.values[i]
+        n = len(self)
+        others = np.arange(n)
+        result = np.zeros(n, dtype=self._condensed.dtype)
+        mask = others != i
+        result[mask] = self._condensed[_condensed_positions(n, i, others[mask])]
+        return result
+
+    @classmethod
+    def from_condensed(cls, condensed, names=None, dtype=None):
+        """
+        Makes a DistanceMatrix that only holds the condensed upper triangle of distances.
+        :param condensed: 1d array (can be a memory-mapped array)
+        :param names: list of names (default: 0...n-1)
+        :param dtype: e.g. np.float32 to halve the memory used (default: keep the input's dtype)
+        """
+        if not isinstance(condensed, np.ndarray):
+            condensed = np.asarray(condensed)
+        if dtype is not None and condensed.dtype != dtype:
+            condensed = condensed.astype(dtype)
+        n = _condensed_size(len(condensed))
+        if n * (n - 1) // 2 != len(condensed):
+            raise ValueError('Condensed distance vector has the wrong length ({})'.format(len(condensed)))
+        new_instance = cls()
+        new_instance._df = None
+        new_instance._condensed = condensed
+        new_instance.set_names(names if names is not None else list(range(n)))
+        return new_instance
+
+    def to_condensed(self, dtype=None):
+        """ Returns a copy of this matrix that holds only its condensed upper triangle """
+        return self.__class__.from_condensed(self.condensed, self.get_names(), dtype)
+
+    @staticmethod
+    def names_file(filename):
+        """ Name of the file that save() writes the names to, alongside the distances in `filename` """
+        return '{}.names.json'.format(filename[:-4] if filename.endswith('.npy') else filename)
+
+    def save(self, filename):
+        """
+        Writes the condensed distances to a binary .npy file, and the names alongside it,
+        in <filename>.names.json. Reload with DistanceMatrix.load.
+        """
+        np.save(filename, self.condensed)
+        with open(self.names_file(filename), 'w') as handle:
+            json.dump(self.get_names(), handle)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """
+        Reads a matrix written by save. The distances stay condensed, and, with mmap=True,
+        on disk - pages are read in as they are used.
+        """
+        condensed = np.load(filename, mmap_mode='r' if mmap else None)
+        with open(cls.names_file(filename)) as handle:
+            names = json.load(handle)
+        return cls.from_condensed(condensed, names)
+
     @classmethod
     def from_csv(cls, filename, **kwargs):
         with fileIO.freader(filename) as handle:
@@ -493,17 +799,27 @@ class DistanceMatrix(Matrix):
             return new_instance
 
     def get_names(self):
+        if self.is_condensed:
+            return [str(x) for x in self._names]
         return [str(x) for x in self.df.index]
 
     def set_names(self, names):
         if names is None:
             return
-        if len(names) != self.df.index.size:
-            errmsg = 'Expected {} names, got {}'.format(self.df.index.size, len(names))
+        if len(names) != len(self):
+            errmsg = 'Expected {} names, got {}'.format(len(self), len(names))
             raise ValueError(errmsg)
-        self.df.index = self.df.columns = names
+        if self.is_condensed:
+            self._names = list(names)
+            self._df = None
+        else:
+            self._df.index = self._df.columns = names
 
     def add_noise(self, std=0.0001):
+        if self.is_condensed:
+            noisy = self._condensed + np.random.normal(0, std, len(self._condensed))
+            noisy = np.abs(noisy).astype(self._condensed.dtype)
+            return self.__class__.from_condensed(noisy, self._names)
         ix = np.triu_indices(len(self.df), 1)
         rev_ix = ix[::-1]
         noise = np.random.normal(0, std, len(ix[0]))
@@ -511,7 +827,7 @@ class DistanceMatrix(Matrix):
         noisy[ix] += noise
         noisy[rev_ix] += noise
         noisy[noisy < 0] = np.abs(noisy[noisy < 0])
-        return self.__class__(noisy, self.df.index)
+        return self.__class__.from_array(noisy, self.df.index)
 
     def affinity(self, mask=None, scale=None):
         return affinity(self.to_array(), mask, scale)
@@ -530,6 +846,8 @@ class DistanceMatrix(Matrix):
             tsne: t-distributed Stochastic Neighbour Embedding
 
         Valid kwargs:
+            cmds: additive_correct - correct non-Euclidean distances with the additive constant
+                  solver - eigensolver for the leading eigenvectors: 'auto', 'lapack' or 'arpack'
             kpca: affinity_matrix - a precomputed array of affinities
                   sigma - the value of sigma to use when computing the affinity matrix via
                           the Radial Basis Function
@@ -557,15 +875,31 @@ class DistanceMatrix(Matrix):
         elif method == 'tsne':
             array = _embedding_tsne(self.to_array(), dimensions, **kwargs)
 
-        return CoordinateMatrix(array, names=self.df.index)
+        return CoordinateMatrix(array, names=self._names if self.is_condensed else self.df.index)
 
     def reorder(self, new_order):
+        if self.is_condensed:
+            return self._reorder_condensed(new_order)
         reordered_df = self.df.reindex(columns=new_order, index=new_order)
         reordered_names = reordered_df.columns
         newobj = self.__class__()
         newobj.df = reordered_df
         return newobj
 
+    def _reorder_condensed(self, new_order):
+        """ Reorders the condensed distances, one row at a time. New_order is a list of names or of positions. """
+        lookup = {name: i for (i, name) in enumerate(self._names)}
+        positions = np.array([lookup[x] if x in lookup else x for x in new_order], dtype=np.intp)
+        n = len(positions)
+        reordered = np.empty(n * (n - 1) // 2, dtype=self._condensed.dtype)
+        for i in range(n - 1):
+            start = _condensed_positions(n, i, i + 1)
+            reordered[start:start + n - i - 1] = self._condensed[
+                _condensed_positions(len(self), positions[i], positions[i + 1:])]
+        return self.__class__.from_condensed(reordered, [self._names[i] for i in positions])
+
     def sort(self):
+        if self.is_condensed:
+            return self.reorder(np.argsort(self.get_names(), kind='mergesort'))
         order = self.df.index.argsort()
         return self.reorder(order)
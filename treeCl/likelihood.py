@@ -0,0 +1,153 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+
+# third party
+import numpy as np
+from phylo_utils.likcalc import discrete_gamma
+
+# treeCl
+from .tree import Tree
+
+__all__ = ['LocusBlock', 'TreePlan', 'tree_loglikelihoods']
+
+
+def _eigen(q_matrix, freqs):
+    """
+    Eigen decomposition of a reversible rate matrix, via the symmetric matrix
+    diag(sqrt(pi)) Q diag(1/sqrt(pi)). Returns (evecs, evals, ivecs) such that
+    P(t) = evecs . diag(exp(evals * t)) . ivecs
+    """
+    rootf = np.sqrt(freqs)
+    b = (rootf[:, np.newaxis] * q_matrix) / rootf[np.newaxis, :]
+    evals, r = np.linalg.eigh((b + b.T) / 2)
+    evecs = r / rootf[:, np.newaxis]
+    ivecs = r.T * rootf[np.newaxis, :]
+    return evecs, evals, ivecs
+
+
+class LocusBlock(object):
+    """
+    A set of loci that share one substitution model (transition matrix and gamma shape).
+    The partials of the loci are stored end to end, so that the likelihood of every site of every
+    locus on a tree is calculated in one pass of the pruning algorithm. Each locus must have partials
+    for every leaf of the trees it will be evaluated on (missing taxa as all-ones partials, as produced
+    by utils.alignment_to_partials with the missing_data argument).
+    """
+
+    def __init__(self, partials, transition_matrix, alpha, ncat=4, weights=None):
+        """
+        :param partials: list of partials dicts ({leaf name: (nsites x nstates) array}), one per locus
+        :param transition_matrix: phylo_utils.markov.TransitionMatrix
+        :param alpha: float. Shape parameter of the discrete gamma rate distribution
+        :param ncat: int. Number of gamma rate categories
+        :param weights: list of site weight arrays, one per locus, if the partials are for
+            site patterns (see Alignment.get_site_patterns)
+        """
+        names = set(partials[0])
+        for p in partials[1:]:
+            names &= set(p)
+        self.partials = dict((name, np.ascontiguousarray(np.vstack([p[name] for p in partials]), dtype=np.double))
+                             for name in names)
+        sizes = [next(iter(p.values())).shape[0] for p in partials]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.intp)
+        self.weights = None if weights is None else np.concatenate(weights).astype(np.double)
+        self.freqs = np.asarray(transition_matrix.freqs, dtype=np.double)
+        self.evecs, self.evals, self.ivecs = _eigen(np.asarray(transition_matrix.get_q_matrix()), self.freqs)
+        self.rates = np.asarray(discrete_gamma(alpha, ncat), dtype=np.double)
+        self.logweights = np.log(np.ones(ncat) / ncat)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nsites(self):
+        return self.offsets[-1]
+
+    def p_matrices(self, lengths):
+        """
+        Transition probability matrices for every branch length and rate category, in one go
+        :param lengths: array of branch lengths
+        :return: array, shape (ncat, nbranches, nstates, nstates)
+        """
+        t = self.rates[:, np.newaxis] * np.asarray(lengths)[np.newaxis, :]
+        expl = np.exp(t[:, :, np.newaxis] * self.evals[np.newaxis, np.newaxis, :])
+        return np.matmul(self.evecs * expl[..., np.newaxis, :], self.ivecs)
+
+    def loglikelihoods(self, plan):
+        """
+        Log likelihood of each locus on a tree
+        :param plan: TreePlan
+        :return: array of log likelihoods, one per locus
+        """
+        probs = self.p_matrices(plan.lengths)
+        ncat = len(self.rates)
+        nodes = [None] * plan.nnodes
+        logscale = np.zeros((ncat, self.nsites))
+        for index, label in plan.leaves:
+            nodes[index] = self.partials[label]
+        for index, children in plan.internal:
+            partials = None
+            for child, branch in children:
+                # (ncat, nsites, nstates) . P^T, per category
+                contribution = np.matmul(nodes[child], probs[:, branch].transpose(0, 2, 1))
+                partials = contribution if partials is None else partials * contribution
+                nodes[child] = None
+            # Rescale to stop the partials underflowing, and keep track of the scaling
+            scale = partials.max(2)
+            scale[scale <= 0] = 1.0
+            partials /= scale[:, :, np.newaxis]
+            logscale += np.log(scale)
+            nodes[index] = partials
+        sitewise = np.log(nodes[plan.root].dot(self.freqs)) + logscale
+        m = sitewise.max(0)
+        mixed = np.log(np.exp(sitewise + self.logweights[:, np.newaxis] - m).sum(0)) + m
+        if self.weights is not None:
+            mixed *= self.weights
+        return np.add.reduceat(mixed, self.offsets[:-1]) if len(self) > 0 else np.array([])
+
+
+class TreePlan(object):
+    """
+    A tree parsed once into the arrays needed to run the pruning algorithm: leaf labels,
+    branch lengths and a postorder list of internal nodes with their children. Polytomies,
+    including at the root, are handled directly, so the tree doesn't need to be resolved.
+    """
+
+    def __init__(self, tree):
+        """
+        :param tree: Tree or newick string
+        """
+        if not isinstance(tree, Tree):
+            tree = Tree(tree)
+        index = {}
+        self.leaves = []
+        self.internal = []
+        lengths = []
+        for node in tree.postorder():
+            index[node] = i = len(index)
+            if node.is_leaf():
+                self.leaves.append((i, node.taxon.label))
+                continue
+            children = []
+            for child in node.child_nodes():
+                children.append((index[child], len(lengths)))
+                lengths.append(child.edge.length or 0.0)
+            self.internal.append((i, children))
+        self.lengths = np.array(lengths, dtype=np.double)
+        self.nnodes = len(index)
+        self.root = index[tree.seed_node]
+
+
+def tree_loglikelihoods(tree, blocks):
+    """
+    Log likelihoods of all the loci in `blocks` on one tree. The tree is parsed once, and
+    shared by all the blocks.
+    :param tree: Tree or newick string
+    :param blocks: list of LocusBlock
+    :return: array of log likelihoods, in block order
+    """
+    plan = TreePlan(tree)
+    if not blocks:
+        return np.array([])
+    return np.concatenate([block.loglikelihoods(plan) for block in blocks])
@@ -4,7 +4,11 @@ Data structures to hold model parameters and attributes such as alignment file p
 from __future__ import absolute_import
 from builtins import object
 import json
+import os
+import struct
 import sys
+import tempfile
+import numpy as np
 import logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -21,6 +25,17 @@ def setter_helper(fn, value):
     """
     return value if value is None else fn(value)
 
+def _json_default(obj):
+    """
+    Lets json.dump write numpy arrays and scalars (e.g. distances read from a ParameterStore)
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
 class BaseParameters(object):
     __slots__ = []
 
@@ -37,7 +52,7 @@ class BaseParameters(object):
                 setattr(self, k, v)
 
     def write(self, fileobj=sys.stdout, indent=None):
-        json.dump(self.dict, fileobj, indent=indent)
+        json.dump(self.dict, fileobj, indent=indent, default=_json_default)
 
 
 class PartitionParameters(BaseParameters):
@@ -198,3 +213,151 @@ class Parameters(BaseParameters):
             pp = PartitionParameters()
             pp.construct_from_dict(tmp[k])
             self.partitions.append(pp)
+
+
+# Atomic rename over an existing file (os.rename does this on POSIX, but not on Windows)
+_replace = getattr(os, 'replace', os.rename)
+
+
+class ParameterStore(object):
+    """
+    Parameters for many records in a single file. Trees, scalars and short model vectors are kept
+    in a JSON header, which also indexes each record by name; the distance and variance matrices
+    are stored after the header as float64 arrays, and read with a memory map, so loading a record
+    reads only its own matrices.
+
+    File layout: MAGIC, the header length (8 bytes, little-endian), the header (UTF-8 JSON), padding
+    to a multiple of ALIGN bytes, then the arrays, each starting at a multiple of ALIGN bytes. In
+    the header, arrays are recorded as {"__array__": [offset, shape]}, with offsets relative to the
+    start of the array data.
+    """
+    MAGIC = b'TREECLPS'
+    ALIGN = 64
+    ARRAY_KEYS = ('distances', 'variances')
+
+    def __init__(self, filename, mmap=True):
+        """
+        Open a store for reading
+        :param filename: path of the store
+        :param mmap: if True, arrays are read-only views of a memory map of the file; otherwise
+            each record's arrays are read into memory when the record is accessed
+        """
+        self.filename = filename
+        self.mmap = mmap
+        with open(filename, 'rb') as fl:
+            magic = fl.read(len(self.MAGIC))
+            if magic != self.MAGIC:
+                raise IOError('{} is not a parameter store'.format(filename))
+            size, = struct.unpack('<Q', fl.read(8))
+            header = json.loads(fl.read(size).decode('utf-8'))
+        self._records = header['records']
+        self._data_start = self._pad(len(self.MAGIC) + 8 + size)
+        self._map = None
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def names(self):
+        return list(self._records)
+
+    def __getitem__(self, name):
+        """
+        The parameters of the named record, as a dictionary for Parameters.construct_from_dict
+        """
+        return self._restore(self._records[name])
+
+    def get(self, name, default=None):
+        if name not in self._records:
+            return default
+        return self[name]
+
+    def _restore(self, obj):
+        if isinstance(obj, dict):
+            if '__array__' in obj:
+                offset, shape = obj['__array__']
+                return self._read_array(offset, tuple(shape))
+            return dict((k, self._restore(v)) for (k, v) in obj.items())
+        return obj
+
+    def _read_array(self, offset, shape):
+        count = int(np.prod(shape))
+        start = self._data_start + offset
+        if self.mmap:
+            if self._map is None:
+                self._map = np.memmap(self.filename, dtype=np.uint8, mode='r')
+            return np.frombuffer(self._map, dtype='<f8', count=count, offset=start).reshape(shape)
+        with open(self.filename, 'rb') as fl:
+            fl.seek(start)
+            return np.fromfile(fl, dtype='<f8', count=count).reshape(shape)
+
+    @classmethod
+    def _pad(cls, n):
+        return -(-n // cls.ALIGN) * cls.ALIGN
+
+    @classmethod
+    def write(cls, filename, items):
+        """
+        Write a store
+        :param filename: path to write to
+        :param items: iterable of (name, parameter dict) pairs, where the parameter dicts are as
+            given by Parameters.dict
+        :return: ParameterStore for the new file
+        """
+        arrays = []
+        offset = [0]
+
+        def split(obj, key=None):
+            # Replace the matrices by references into the array data, and collect them
+            if isinstance(obj, dict):
+                return dict((str(k), split(v, k)) for (k, v) in obj.items())
+            if key in cls.ARRAY_KEYS and obj is not None:
+                arr = np.ascontiguousarray(obj, dtype='<f8')
+                ref = {'__array__': [offset[0], list(arr.shape)]}
+                arrays.append((offset[0], arr))
+                offset[0] = cls._pad(offset[0] + arr.nbytes)
+                return ref
+            if isinstance(obj, np.ndarray):
+                return obj.tolist()
+            if isinstance(obj, np.generic):
+                return obj.item()
+            return obj
+
+        records = dict((name, split(d)) for (name, d) in items)
+        header = json.dumps({'records': records}).encode('utf-8')
+        data_start = cls._pad(len(cls.MAGIC) + 8 + len(header))
+        # The arrays may be memory-mapped views of the file being replaced (a store read and written
+        # back in place), so the new store is written to a temporary file and moved over the old one
+        # at the end. Existing views keep the old file's data until they are dropped.
+        fd, tmp = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as fl:
+                fl.write(cls.MAGIC)
+                fl.write(struct.pack('<Q', len(header)))
+                fl.write(header)
+                for (off, arr) in arrays:
+                    fl.seek(data_start + off)
+                    fl.write(arr.tobytes())
+                fl.truncate(data_start + offset[0])
+            _replace(tmp, filename)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return cls(filename)
+
+    @classmethod
+    def is_store(cls, filename):
+        """
+        True if filename is a file that starts with the store's magic bytes
+        """
+        try:
+            with open(filename, 'rb') as fl:
+                return fl.read(len(cls.MAGIC)) == cls.MAGIC
+        except (IOError, OSError):
+            return False
@@ -4,10 +4,16 @@ from builtins import range
 from builtins import object
 from abc import ABCMeta, abstractmethod
 from .constants import PARALLEL_PROFILE
-from .utils import setup_progressbar, grouper, flatten_list
+from .utils import setup_progressbar, grouper, flatten_list, fileIO
 import logging
 import multiprocessing
+import pickle
 import sys
+import traceback
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
 logger = logging.getLogger(__name__)
 
 __author__ = 'kgori'
@@ -37,6 +43,70 @@ def get_from_queue(queue, block=True, timeout=None):
 End of workaround
 """
 
+"""
+Read-only store of objects shared with worker processes.
+Worker processes are forked after objects are added to the store, so they inherit a
+(copy-on-write) snapshot of it and the objects never need to be pickled - they can even be
+unpicklable, e.g. tree_distance.PhyloTree. Tasks refer to objects in the store with SharedRef
+placeholders, which are small and cheap to send, and are swapped for the real objects in the
+worker just before the task is run.
+"""
+_shared_store = {}
+_shared_store_version = 0
+
+
+class SharedRef(object):
+    """
+    Placeholder for an object in the shared store, or for an item or slice of it
+    (e.g. SharedRef('trees')[10:20] stands for the 10th to 19th shared trees)
+    """
+    __slots__ = ('key', 'index')
+
+    def __init__(self, key, index=None):
+        self.key = key
+        self.index = index
+
+    def __getitem__(self, index):
+        if self.index is not None:
+            raise ValueError('SharedRef is already indexed')
+        return SharedRef(self.key, index)
+
+    def __getstate__(self):
+        return (self.key, self.index)
+
+    def __setstate__(self, state):
+        self.key, self.index = state
+
+    def __repr__(self):
+        return 'SharedRef({!r}, {!r})'.format(self.key, self.index)
+
+    def resolve(self):
+        value = _shared_store[self.key]
+        return value if self.index is None else value[self.index]
+
+
+def share(key, value):
+    """
+    Put `value` into the shared store under `key`.
+    Only worker processes started after this call will see it, except for the workers of a
+    WorkerPool, which are sent the change before their next call.
+    :return: SharedRef to the value
+    """
+    global _shared_store_version
+    _shared_store[key] = value
+    _shared_store_version += 1
+    return SharedRef(key)
+
+def unshare(key):
+    """ Remove the object stored under `key` from the shared store """
+    global _shared_store_version
+    if _shared_store.pop(key, None) is not None:
+        _shared_store_version += 1
+
+def resolve_shared(args):
+    """ Swap any SharedRef placeholders in the argument tuple `args` for the objects they stand for """
+    return tuple(a.resolve() if isinstance(a, SharedRef) else a for a in args)
+
 def fun(f, q_in, q_out):
     while True:
         (i, x) = get_from_queue(q_in)
@@ -71,6 +141,33 @@ def tupleise(args):
         else:
             yield (a,)
 
+def cost_order(costs):
+    """
+    Longest-processing-time-first schedule: the job indices, most costly first
+    (ties keep their input order)
+    """
+    return sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+
+def map_by_cost(map_fn, args, costs):
+    """
+    Runs map_fn on the args reordered so that the most costly jobs start first, so that a long
+    job isn't left to start last, when the other workers are running out of work. Workers that
+    pull jobs from a shared queue as they become free balance the rest of the load between them.
+    Results are returned in the original input order.
+    :param map_fn: function taking a list of argument tuples, returning a list of results
+    :param args: list of argument tuples
+    :param costs: list of estimated costs (e.g. alignment length x number of taxa), one per job
+    """
+    args = list(args)
+    if len(costs) != len(args):
+        raise ValueError('Got {} costs for {} jobs'.format(len(costs), len(args)))
+    order = cost_order(costs)
+    results = map_fn([args[i] for i in order])
+    reordered = [None] * len(args)
+    for (pos, i) in enumerate(order):
+        reordered[i] = results[pos]
+    return reordered
+
 def get_njobs(nargs, args):
     if nargs is not None:
         njobs = nargs
@@ -126,23 +223,28 @@ def sequential_map(task, args, message, nargs=None):
                       but longer execution time per job.
     :return: IPython.parallel.AsyncMapResult
     """
+    return list(sequential_imap(task, args, message, nargs))
+
+def sequential_imap(task, args, message, nargs=None):
+    """
+    Lazy version of sequential_map: arguments are consumed and results yielded one at a time.
+    """
     njobs = get_njobs(nargs, args)
     show_progress = bool(message)
     if show_progress:
         pbar = setup_progressbar(message, njobs, simple_progress=True)
         pbar.start()
-    map_result = []
     for (i, arglist) in enumerate(tupleise(args), start=1):
-        map_result.append(task(*arglist))
+        yield task(*resolve_shared(arglist))
         if show_progress:
             pbar.update(i)
     if show_progress:
         pbar.finish()
-    return map_result
 
-def threadpool_map(task, args, message, concurrency, batchsize=1, nargs=None):
+def threadpool_map(task, args, message, concurrency, batchsize=1, nargs=None, executor=None):
     """
     Helper to map a function over a range of inputs, using a threadpool, with a progress meter
+    :param executor: concurrent.futures.ThreadPoolExecutor to use. If None, one is created for this call.
     """
     import concurrent.futures
 
@@ -150,12 +252,12 @@ def threadpool_map(task, args, message, concurrency, batchsize=1, nargs=None):
     njobs = get_njobs(nargs, args)
     show_progress = bool(message)
     batches = grouper(batchsize, tupleise(args))
-    batched_task = lambda batch: [task(*job) for job in batch]
+    batched_task = lambda batch: [task(*resolve_shared(job)) for job in batch]
     if show_progress:
         message += ' (TP:{}w:{}b)'.format(concurrency, batchsize)
         pbar = setup_progressbar(message, njobs, simple_progress=True)
         pbar.start()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+    def run(executor):
         futures = []
         completed_count = 0
         for batch in batches:
@@ -168,31 +270,97 @@ def threadpool_map(task, args, message, concurrency, batchsize=1, nargs=None):
 
         else:
             concurrent.futures.wait(futures)
+        return futures
+
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = run(executor)
+    else:
+        futures = run(executor)
 
     if show_progress:
         pbar.finish()
 
     return flatten_list([fut.result() for fut in futures])
 
-def processpool_map(task, args, message, concurrency, batchsize=1, nargs=None):
+def threadpool_imap(task, args, message, concurrency, batchsize=1, nargs=None, executor=None, ordered=True):
+    """
+    Lazy version of threadpool_map. At most 2 x concurrency batches are submitted to the threadpool
+    at any time, and results are yielded as they complete - in input order if `ordered` is True,
+    otherwise as (index, result) pairs in order of completion.
+    """
+    import concurrent.futures
+
+    njobs = get_njobs(nargs, args)
+    show_progress = bool(message)
+    batches = enumerate(grouper(batchsize, tupleise(args)))
+    batched_task = lambda batch: [task(*resolve_shared(job)) for job in batch]
+    if show_progress:
+        message += ' (TP:{}w:{}b)'.format(concurrency, batchsize)
+        pbar = setup_progressbar(message, njobs, simple_progress=True)
+        pbar.start()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = {}
+        held = {}
+        next_batch = 0
+        completed_count = 0
+        exhausted = False
+        while True:
+            while not exhausted and len(futures) + len(held) < 2 * concurrency:
+                try:
+                    i, batch = next(batches)
+                except StopIteration:
+                    exhausted = True
+                    break
+                futures[executor.submit(batched_task, batch)] = i
+            if not futures:
+                break
+            done, _ = concurrent.futures.wait(list(futures), return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                i = futures.pop(fut)
+                result = fut.result()
+                completed_count += len(result)
+                if show_progress:
+                    pbar.update(completed_count)
+                if ordered:
+                    held[i] = result
+                else:
+                    for k, r in enumerate(result):
+                        yield i * batchsize + k, r
+            while next_batch in held:
+                for r in held.pop(next_batch):
+                    yield r
+                next_batch += 1
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+    if show_progress:
+        pbar.finish()
+
+def processpool_map(task, args, message, concurrency, batchsize=1, nargs=None, context=None):
     """
     See http://stackoverflow.com/a/16071616
+    :param context: multiprocessing context (or module) used to start the worker processes
     """
     njobs = get_njobs(nargs, args)
     show_progress = bool(message)
     batches = grouper(batchsize, tupleise(args))
+    context = context or multiprocessing
     def batched_task(*batch):
-        return [task(*job) for job in batch]
+        return [task(*resolve_shared(job)) for job in batch]
 
     if show_progress:
         message += ' (PP:{}w:{}b)'.format(concurrency, batchsize)
         pbar = setup_progressbar(message, njobs, simple_progress=True)
         pbar.start()
     
-    q_in   = multiprocessing.Queue()  # Should I limit either queue size? Limiting in-queue
-    q_out  = multiprocessing.Queue()  # increases time taken to send jobs, makes pbar less useful
+    q_in   = context.Queue()  # Should I limit either queue size? Limiting in-queue
+    q_out  = context.Queue()  # increases time taken to send jobs, makes pbar less useful
 
-    proc = [multiprocessing.Process(target=fun, args=(batched_task, q_in, q_out)) for _ in range(concurrency)]
+    proc = [context.Process(target=fun, args=(batched_task, q_in, q_out)) for _ in range(concurrency)]
     for p in proc:
         p.daemon = True
         p.start()
@@ -214,48 +382,496 @@ def processpool_map(task, args, message, concurrency, batchsize=1, nargs=None):
     return flatten_list([x for (i, x) in sorted(res)])
 
 
+# Task inherited by forked pool workers, for tasks that can't be pickled (e.g. closures)
+_inherited_task = None
+
+# Marks a message to a pool worker that updates its copy of the shared store
+_STORE_UPDATE = '__store_update__'
+
+def _same_shared_value(a, b):
+    """ True if b is a, or a list or tuple of the very same objects as a """
+    if a is b:
+        return True
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)) and len(a) == len(b):
+        return all(x is y for (x, y) in zip(a, b))
+    return False
+
+def _pool_worker(q_in, conn):
+    """
+    WorkerPool worker loop. Messages are (job_id, task, batch); a task of None means
+    use the task inherited from the parent when the worker was forked.
+    Exceptions are caught and sent back to the parent rather than killing the worker.
+    Results go back down the worker's own pipe, so a worker that dies part-way through
+    sending can't block the others.
+    """
+    while True:
+        msg = get_from_queue(q_in)
+        if msg is None:
+            break
+        if msg[0] == _STORE_UPDATE:
+            _, updates, removed = msg
+            _shared_store.update(pickle.loads(updates))
+            for key in removed:
+                _shared_store.pop(key, None)
+            continue
+        job_id, task, batch = msg
+        if task is None:
+            task = _inherited_task
+        try:
+            result = [task(*resolve_shared(job)) for job in batch]
+        except Exception:
+            conn.send((job_id, False, traceback.format_exc()))
+        else:
+            conn.send((job_id, True, result))
+    conn.close()
+
+
+def _wait_for_results(conns, timeout):
+    """ The connections in conns that have data (or have been closed at the other end) """
+    try:
+        from multiprocessing.connection import wait
+    except ImportError:  # python 2
+        import time
+        deadline = time.time() + timeout
+        while True:
+            ready = [c for c in conns if c.poll()]
+            if ready or time.time() >= deadline:
+                return ready
+            time.sleep(0.01)
+    return retry_on_eintr(wait, conns, timeout)
+
+def _is_picklable(obj):
+    try:
+        pickle.dumps(obj)
+        return True
+    except Exception:
+        return False
+
+
+class WorkerPool(object):
+    """
+    A long-lived pool of forked worker processes, reused from one map call to the next.
+    Forked workers inherit a snapshot of the shared store (see `share`). If the store has changed
+    since, the changes are pickled and sent to the workers before the next call; only if a changed
+    value can't be pickled are the workers restarted. Tasks are pickled and sent with
+    each batch; tasks that can't be pickled (closures, lambdas) are inherited by forking a fresh
+    set of workers instead.
+    Workers that die (killed, out of memory, segfault in a C extension) are replaced, and the
+    batches they were running are resubmitted - up to `max_retries` times per batch.
+    Use as a context manager, or call close() when done.
+    """
+    # Batches in flight per worker. More than one keeps workers busy while results travel back.
+    prefetch = 2
+    poll_interval = 1.0
+    max_retries = 3
+
+    def __init__(self, concurrency, context=None):
+        self.concurrency = concurrency
+        if context is None:
+            context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') \
+                else multiprocessing
+        self.context = context
+        self._workers = []
+        self._queues = []
+        self._conns = []
+        self._store_version = None
+        # The shared store as the workers have it
+        self._worker_store = {}
+        self._calls = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @property
+    def running(self):
+        return len(self._workers) > 0
+
+    def start(self):
+        if self.running:
+            return
+        self._store_version = _shared_store_version
+        self._worker_store = dict(_shared_store)
+        fileIO.clean_stale_scratch()
+        for worker_id in range(self.concurrency):
+            self._workers.append(None)
+            self._queues.append(None)
+            self._conns.append(None)
+            self._spawn(worker_id)
+
+    def _spawn(self, worker_id):
+        if self._conns[worker_id] is not None:
+            self._conns[worker_id].close()
+        q_in = self.context.Queue()
+        reader, writer = self.context.Pipe(duplex=False)
+        p = self.context.Process(target=_pool_worker, args=(q_in, writer))
+        p.daemon = True
+        p.start()
+        writer.close()
+        self._workers[worker_id] = p
+        self._queues[worker_id] = q_in
+        self._conns[worker_id] = reader
+
+    def close(self):
+        """ Stop the workers. The pool is restarted automatically if it is used again. """
+        for q in self._queues:
+            try:
+                q.put(None)
+            except Exception:
+                pass
+        for p in self._workers:
+            p.join(self.poll_interval)
+            if p.is_alive():
+                p.terminate()
+                p.join(self.poll_interval)
+            # A terminated worker doesn't get to remove its own scratch directory
+            fileIO.remove_scratch(p.pid)
+        for conn in self._conns:
+            conn.close()
+        self._workers = []
+        self._queues = []
+        self._conns = []
+        self._worker_store = {}
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def _prepare(self, task):
+        """ Make sure the workers are running and can see the task and the current shared store """
+        global _inherited_task
+        if _is_picklable(task):
+            sent_task = task
+        else:
+            sent_task = None
+            if _inherited_task is not task:
+                _inherited_task = task
+                self.close()
+        if self.running and self._store_version != _shared_store_version:
+            self._update_worker_store()
+        self.start()
+        return sent_task
+
+    def _update_worker_store(self):
+        """
+        Bring the workers' copies of the shared store up to date, without restarting them, by sending
+        them the changes. Values that are the same objects as before aren't sent. If a changed value
+        can't be pickled, the workers are restarted instead.
+        """
+        changed = dict((key, value) for (key, value) in _shared_store.items()
+                       if key not in self._worker_store or not _same_shared_value(self._worker_store[key], value))
+        removed = [key for key in self._worker_store if key not in _shared_store]
+        try:
+            updates = pickle.dumps(changed, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.debug('Shared store changes can\'t be pickled - restarting the workers')
+            self.close()
+            return
+        if changed or removed:
+            for q in self._queues:
+                q.put((_STORE_UPDATE, updates, removed))
+        self._worker_store = dict(_shared_store)
+        self._store_version = _shared_store_version
+
+    def _dispatch(self, task, batches, throttle=None, prefetch=None):
+        """
+        Runs the batches on the workers, and yields (batch number, result) pairs in order of completion.
+        `batches` is consumed lazily: a new batch is only taken from it when a worker has room for it
+        (at most `prefetch` batches in flight per worker), so the arguments are never all in memory
+        at once. While throttle() returns True, no new batches are sent out.
+        """
+        if prefetch is None:
+            prefetch = self.prefetch
+        sent_task = self._prepare(task)
+        # Job ids are (call number, batch number), so that stray results from an earlier,
+        # abandoned call can be recognised and dropped
+        self._calls += 1
+        call = self._calls
+        batches = iter(enumerate(batches))
+        retry = []  # batches lost with a dead worker, to be resent
+        in_flight = dict((w, {}) for w in range(self.concurrency))
+        retries = {}
+        state = {'exhausted': False}
+
+        def next_job():
+            if retry:
+                return retry.pop()
+            if state['exhausted'] or (throttle is not None and throttle()):
+                return None
+            try:
+                i, batch = next(batches)
+            except StopIteration:
+                state['exhausted'] = True
+                return None
+            return (call, i), batch
+
+        def send(worker_id):
+            while len(in_flight[worker_id]) < prefetch:
+                job = next_job()
+                if job is None:
+                    break
+                job_id, batch = job
+                in_flight[worker_id][job_id] = batch
+                self._queues[worker_id].put((job_id, sent_task, batch))
+
+        for worker_id in range(self.concurrency):
+            send(worker_id)
+
+        while not state['exhausted'] or retry or any(in_flight.values()):
+            ready = _wait_for_results(self._conns, self.poll_interval)
+            if not ready:
+                self._check_workers(in_flight, retry, retries)
+                for w in range(self.concurrency):
+                    send(w)
+                continue
+            for conn in ready:
+                if conn not in self._conns:  # its worker was replaced while handling an earlier result
+                    continue
+                worker_id = self._conns.index(conn)
+                try:
+                    job_id, ok, result = conn.recv()
+                except (EOFError, OSError):
+                    # The worker has gone; wait for it to be reaped, then replace it
+                    self._workers[worker_id].join(self.poll_interval)
+                    self._check_workers(in_flight, retry, retries)
+                    continue
+                if job_id[0] != call:
+                    continue
+                in_flight[worker_id].pop(job_id, None)
+                if not ok:
+                    raise RuntimeError('Job {} failed in worker process:\n{}'.format(job_id[1], result))
+                yield job_id[1], result
+            for w in range(self.concurrency):
+                send(w)
+
+    def _check_workers(self, in_flight, retry, retries):
+        """ Replace dead workers, and queue the batches they were running to be resent """
+        for worker_id, p in enumerate(self._workers):
+            if p.is_alive():
+                continue
+            logger.warning('Worker process {} died (exit code {}) - replacing it'.format(worker_id, p.exitcode))
+            lost = in_flight[worker_id]
+            for job_id in sorted(lost, reverse=True):
+                retries[job_id] = retries.get(job_id, 0) + 1
+                if retries[job_id] > self.max_retries:
+                    raise RuntimeError('Job {} killed its worker process {} times'.format(job_id[1], retries[job_id]))
+                retry.append((job_id, lost[job_id]))
+            in_flight[worker_id] = {}
+            fileIO.remove_scratch(p.pid)
+            self._spawn(worker_id)
+
+    def imap(self, task, args, message='', batchsize=1, nargs=None, ordered=True, max_buffered=None, costs=None):
+        """
+        Lazily map task over args on the pool, with progress meter.
+        Arguments are taken from `args` only as workers become free, and results are yielded as soon as
+        they are available, so neither the arguments nor the results need to fit in memory all at once.
+        :param task: Function
+        :param args: Iterable (e.g. a generator) of tuples of arguments that the task function will be mapped onto.
+        :param message: String for progress bar
+        :param batchsize: Jobs are sent to the workers in batches of this size.
+        :param ordered: If True, results are yielded in input order. Otherwise, (index, result) pairs are yielded
+            in order of completion.
+        :param max_buffered: In ordered mode, results that arrive ahead of a slow job are held back until it
+            completes. No new jobs are sent out while this many batches are held back
+            (default 4 x the number of workers). Not applied when `costs` are given.
+        :param costs: Optional list of estimated costs, one per job. If given, the most costly jobs are started
+            first, and each worker is given a new batch only when it is free, so that idle workers take up any
+            queued work (`args` is read in full up front, in this case).
+        :return: generator of results
+        """
+        njobs = get_njobs(nargs, args)
+        show_progress = bool(message)
+        prefetch = None
+        order = None
+        if costs is not None:
+            args = list(args)
+            if len(costs) != len(args):
+                raise ValueError('Got {} costs for {} jobs'.format(len(costs), len(args)))
+            order = cost_order(costs)
+            args = [args[i] for i in order]
+            prefetch = 1
+        batches = grouper(batchsize, tupleise(args))
+        if max_buffered is None:
+            max_buffered = 4 * self.concurrency
+        if show_progress:
+            message += ' (PP:{}w:{}b)'.format(self.concurrency, batchsize)
+            pbar = setup_progressbar(message, njobs, simple_progress=True)
+            pbar.start()
+        held = {}
+        next_index = 0
+        completed_count = 0
+        # With costs, jobs are sent out of input order, so the next result due may not have been sent yet:
+        # throttling could stop it from ever being sent. `args` is in memory already in that case anyway.
+        throttle = (lambda: len(held) >= max_buffered * batchsize) if order is None else None
+        for i, result in self._dispatch(task, batches, throttle=throttle, prefetch=prefetch):
+            completed_count += len(result)
+            if show_progress:
+                pbar.update(completed_count)
+            for k, r in enumerate(result):
+                index = i * batchsize + k
+                if order is not None:
+                    index = order[index]
+                if ordered:
+                    held[index] = r
+                else:
+                    yield index, r
+            while next_index in held:
+                yield held.pop(next_index)
+                next_index += 1
+        if show_progress:
+            pbar.finish()
+
+    def map(self, task, args, message='', batchsize=1, nargs=None, costs=None):
+        """
+        Map task over args on the pool, with progress meter. Results are returned in input order.
+        See imap for the parameters.
+        :return: list of results
+        """
+        return list(self.imap(task, args, message, batchsize, nargs, costs=costs))
+
+
 class JobHandler(object):
     """
     Base class to provide uniform interface for all job handlers
     """
     metaclass = ABCMeta
 
+    # True if tasks can read objects from the shared store (see `share`), i.e. they run
+    # in this process, or in a process forked from it
+    shares_memory = False
+
     @abstractmethod
     def __call__(self, task, args, message, batchsize):
-        """ If you define a message, then progress will be written to stderr """
+        """
+        If you define a message, then progress will be written to stderr.
+        Handlers that run jobs in parallel also accept `costs`, a list of estimated job costs (e.g.
+        alignment length x number of taxa), and start the most costly jobs first (see map_by_cost).
+        """
         pass
 
+    def imap(self, task, args, message, batchsize=1, nargs=None, ordered=True):
+        """
+        Lazy version of __call__: returns an iterator of results - in input order if `ordered` is True,
+        otherwise of (index, result) pairs in order of completion.
+        Handlers that can stream take arguments from `args` only as they are needed, and yield results as soon
+        as they are ready; this default implementation just runs __call__.
+        """
+        results = self(task, args, message, batchsize, nargs=nargs)
+        return iter(results) if ordered else enumerate(results)
+
+    def close(self):
+        """ Release any workers held between calls """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
 
 class SequentialJobHandler(JobHandler):
     """
     Jobs are handled using a simple map
     """
-    def __call__(self, task, args, message, batchsize, nargs=None):
+    shares_memory = True
+
+    def __call__(self, task, args, message, batchsize, nargs=None, costs=None):
         if batchsize > 1:
             logger.warn("Setting batchsize > 1 has no effect when using a SequentialJobHandler")
         return sequential_map(task, args, message, nargs)
 
+    def imap(self, task, args, message, batchsize=1, nargs=None, ordered=True):
+        results = sequential_imap(task, args, message, nargs)
+        return results if ordered else enumerate(results)
+
 
 class ThreadpoolJobHandler(JobHandler):
     """
     Jobs are handled by a threadpool using concurrent.futures
+    If persistent is True, the same threadpool is reused for every call, until close() is called
     """
-    def __init__(self, concurrency):
-        self.concurrency = concurrency
+    shares_memory = True
 
-    def __call__(self, task, args, message, batchsize, nargs=None):
-        return threadpool_map(task, args, message, self.concurrency, batchsize, nargs)
+    def __init__(self, concurrency, persistent=False):
+        self.concurrency = concurrency
+        self.persistent = persistent
+        self._executor = None
+
+    def __call__(self, task, args, message, batchsize, nargs=None, costs=None):
+        if self.persistent and self._executor is None:
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        map_fn = lambda args: threadpool_map(task, args, message, self.concurrency, batchsize, nargs,
+                                             executor=self._executor)
+        return map_fn(args) if costs is None else map_by_cost(map_fn, args, costs)
+
+    def imap(self, task, args, message, batchsize=1, nargs=None, ordered=True):
+        if self.persistent and self._executor is None:
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        return threadpool_imap(task, args, message, self.concurrency, batchsize, nargs,
+                               executor=self._executor, ordered=ordered)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
 
 class ProcesspoolJobHandler(JobHandler):
     """
-    Jobs are handled by a threadpool using concurrent.futures
+    Jobs are handled by a pool of processes using multiprocessing
+    If persistent is True, the processes are started once, on the first call, and reused (see WorkerPool)
+    until close() is called. Otherwise a new set of processes is started for every call.
     """
-    def __init__(self, concurrency):
+    def __init__(self, concurrency, persistent=False):
         self.concurrency = concurrency
+        self.persistent = persistent
+        self._pool = WorkerPool(concurrency) if persistent else None
+
+    def __call__(self, task, args, message, batchsize, nargs=None, costs=None):
+        if self._pool is not None:
+            return self._pool.map(task, args, message, batchsize, nargs, costs=costs)
+        # Workers take batches from a shared queue as they become free
+        map_fn = lambda args: processpool_map(task, args, message, self.concurrency, batchsize, nargs)
+        return map_fn(args) if costs is None else map_by_cost(map_fn, args, costs)
+
+    def imap(self, task, args, message, batchsize=1, nargs=None, ordered=True):
+        if self._pool is not None:
+            return self._pool.imap(task, args, message, batchsize, nargs, ordered=ordered)
+        return self._temporary_pool_imap(task, args, message, batchsize, nargs, ordered)
+
+    def _temporary_pool_imap(self, task, args, message, batchsize, nargs, ordered):
+        with WorkerPool(self.concurrency) as pool:
+            for result in pool.imap(task, args, message, batchsize, nargs, ordered=ordered):
+                yield result
 
-    def __call__(self, task, args, message, batchsize, nargs=None):
-        return processpool_map(task, args, message, self.concurrency, batchsize, nargs)
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+
+
+class SharedProcesspoolJobHandler(ProcesspoolJobHandler):
+    """
+    Jobs are handled by a persistent pool of forked processes, which inherit the shared store (see `share`).
+    Large read-only inputs can be shared once, and tasks sent only SharedRef placeholders
+    for them, instead of pickling the inputs into every job.
+    Requires the 'fork' start method, so is not available on Windows.
+    """
+    shares_memory = True
+
+    def __init__(self, concurrency):
+        super(SharedProcesspoolJobHandler, self).__init__(concurrency, persistent=True)
 
 
 class IPythonJobHandler(JobHandler):
@@ -282,6 +898,6 @@ class IPythonJobHandler(JobHandler):
             logger.error(msg)
             raise RuntimeError(msg)
 
-    def __call__(self, task, args, message, batchsize):
+    def __call__(self, task, args, message, batchsize, nargs=None, costs=None):
         logger.debug('__call__: len(client) = {}'.format(len(self.client)))
         return list(parallel_map(self.client, task, args, message, batchsize))
@@ -0,0 +1,343 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+
+# third party
+import numpy as np
+import scipy.sparse
+
+# treeCl
+from .tree import Tree
+
+__all__ = ['SplitIndex']
+
+
+def _popcount(mask):
+    return bin(mask).count('1')
+
+
+def _lowest_bit(mask):
+    return mask & -mask
+
+
+def _canonical(mask, leafmask):
+    """
+    Each split divides the leaves into two sides. Represent it by the side that
+    does not contain the lowest-indexed taxon of the tree, so that both sides map
+    to the same key.
+    """
+    if mask & _lowest_bit(leafmask):
+        return leafmask ^ mask
+    return mask
+
+
+def _encode_tree(tree, taxon_index):
+    """
+    Returns (leafmask, {canonical split mask: branch length}, rooted, bifurcating) for a Tree.
+    Edges that induce the same split (e.g. the two edges either side of a bifurcating root)
+    have their lengths summed, as for an unrooted tree.
+    """
+    masks = {}
+    splits = {}
+    seed = tree.seed_node
+    for node in tree.postorder():
+        if node.is_leaf():
+            mask = 1 << taxon_index[node.taxon.label]
+        else:
+            mask = 0
+            for child in node.child_nodes():
+                mask |= masks[child]
+        masks[node] = mask
+    leafmask = masks[seed]
+    nleaves = _popcount(leafmask)
+    for node in tree.postorder(skip_seed=True):
+        key = _canonical(masks[node], leafmask)
+        if key == 0:
+            continue
+        splits[key] = splits.get(key, 0.0) + (node.edge.length or 0.0)
+    n_internal = sum(1 for key in splits if 1 < _popcount(key) < nleaves - 1)
+    bifurcating = (nleaves < 4) or (n_internal == nleaves - 3)
+    return leafmask, splits, bool(tree.rooted), bifurcating
+
+
+def _restrict(splits, leafmask, subset):
+    """
+    Splits of a tree pruned to the leaves in `subset` (a mask). Splits that become identical
+    after pruning have their branch lengths summed - pruning removes the nodes between them.
+    """
+    restricted = {}
+    for mask, length in splits.items():
+        key = _canonical(mask & subset, subset)
+        if key == 0:
+            continue
+        restricted[key] = restricted.get(key, 0.0) + length
+    return restricted
+
+
+def _nontrivial(splits, nleaves):
+    return set(key for key in splits if 1 < _popcount(key) < nleaves - 1)
+
+
+class SplitIndex(object):
+    """
+    Encodes a collection of trees as sets of bipartitions ("splits") over a global taxon index,
+    so that Robinson-Foulds and weighted Robinson-Foulds distances between all pairs of trees can be
+    calculated in bulk. Each tree is parsed once. Splits are bitmasks over the taxon index, and every
+    distinct split in the collection is given an integer id, so that each tree is stored as a sorted
+    array of split ids with the branch lengths alongside.
+
+    For trees that share a leaf set, the distances are read off sparse matrix products over the
+    tree x split incidence matrix. Pairs of trees with different leaf sets are compared on the
+    intersection of their leaf sets, following treedist._generic_distance_calc.
+
+    The index treats trees as unrooted. Trees that tree_distance would treat differently -
+    trees with a bifurcating root when `rooted` is True (these are compared as rooted trees by
+    treedist.rfdist and friends), and multifurcating trees for weighted RF - are handed to the
+    `fallback` function, if one is given.
+    """
+
+    def __init__(self, trees):
+        """
+        :param trees: list of Tree objects or newick strings
+        """
+        trees = [t if isinstance(t, Tree) else Tree(t) for t in trees]
+        self.taxa = sorted(set().union(*[t.labels for t in trees])) if trees else []
+        taxon_index = dict((label, i) for (i, label) in enumerate(self.taxa))
+
+        encoded = [_encode_tree(t, taxon_index) for t in trees]
+        self.leafmasks = [e[0] for e in encoded]
+        self.rooted = np.array([e[2] for e in encoded], dtype=bool)
+        self.bifurcating = np.array([e[3] for e in encoded], dtype=bool)
+        self._splits = [e[1] for e in encoded]
+
+        # Global split table
+        split_ids = {}
+        self.split_ids = []
+        self.lengths = []
+        self.nontrivial = []
+        for leafmask, splits, _, _ in encoded:
+            nleaves = _popcount(leafmask)
+            items = sorted((split_ids.setdefault(key, len(split_ids)), key) for key in splits)
+            self.split_ids.append(np.array([i for (i, _) in items], dtype=np.intp))
+            self.lengths.append(np.array([splits[key] for (_, key) in items], dtype=np.float64))
+            self.nontrivial.append(np.array([1 < _popcount(key) < nleaves - 1 for (_, key) in items], dtype=bool))
+        self.nsplits = len(split_ids)
+
+    def __len__(self):
+        return len(self.leafmasks)
+
+    def _incidence(self, indices, weighted):
+        """
+        Sparse (tree x split) matrix. Weighted: entries are branch lengths, all splits.
+        Unweighted: entries are 1 for the nontrivial splits.
+        """
+        rows, cols, data = [], [], []
+        for r, i in enumerate(indices):
+            if weighted:
+                sel = np.ones(len(self.split_ids[i]), dtype=bool)
+                values = self.lengths[i]
+            else:
+                sel = self.nontrivial[i]
+                values = np.ones(sel.sum())
+            cols.append(self.split_ids[i][sel])
+            rows.append(np.repeat(r, sel.sum()))
+            data.append(values)
+        if not indices:
+            return scipy.sparse.csr_matrix((0, self.nsplits))
+        return scipy.sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                       shape=(len(indices), self.nsplits))
+
+    def _groups(self, exclude, indices=None):
+        """ Indices of trees (all, or those in `indices`) grouped by leaf set, skipping trees in `exclude` """
+        groups = {}
+        for i in (range(len(self)) if indices is None else indices):
+            if not exclude[i]:
+                groups.setdefault(self.leafmasks[i], []).append(i)
+        return [groups[leafmask] for leafmask in sorted(groups, key=lambda m: groups[m][0])]
+
+    def _special(self, weighted, rooted, fallback):
+        """ Trees that have to be handed to `fallback` """
+        special = self.rooted.copy() if rooted else np.zeros(len(self), dtype=bool)
+        if weighted:
+            special |= ~self.bifurcating
+        if fallback is None:
+            special[:] = False
+        return special
+
+    @staticmethod
+    def _normalise(dist, total, normalise):
+        if not normalise:
+            return dist
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total > 0, dist / np.where(total > 0, total, 1), 0.0)
+
+    def _rf_block(self, indices, normalise):
+        x = self._incidence(indices, weighted=False)
+        common = (x * x.T).toarray()
+        sizes = np.asarray(x.sum(1)).ravel()
+        total = sizes[:, np.newaxis] + sizes[np.newaxis, :]
+        return self._normalise(total - 2 * common, total, normalise)
+
+    def _wrf_block(self, indices, normalise):
+        x = self._incidence(indices, weighted=True)
+        xc = x.tocsc()
+        n = len(indices)
+        sizes = np.asarray(x.sum(1)).ravel()
+        common = np.zeros((n, n))
+        # sum over shared splits of min(l_a, l_b): |l_a - l_b| = l_a + l_b - 2 min(l_a, l_b)
+        for a in range(n):
+            row = x.getrow(a)
+            sub = xc[a + 1:, row.indices].tocoo()
+            mins = np.minimum(sub.data, row.data[sub.col])
+            common[a, a + 1:] = np.bincount(sub.row, mins, minlength=n - a - 1)
+        common = common + common.T
+        total = sizes[:, np.newaxis] + sizes[np.newaxis, :]
+        return self._normalise(np.maximum(total - 2 * common, 0), total, normalise)
+
+    def _rf_rect(self, rows, cols, normalise):
+        x, y = self._incidence(rows, weighted=False), self._incidence(cols, weighted=False)
+        common = (x * y.T).toarray()
+        total = np.asarray(x.sum(1)).ravel()[:, np.newaxis] + np.asarray(y.sum(1)).ravel()[np.newaxis, :]
+        return self._normalise(total - 2 * common, total, normalise)
+
+    def _wrf_rect(self, rows, cols, normalise):
+        x = self._incidence(rows, weighted=True)
+        yc = self._incidence(cols, weighted=True).tocsc()
+        common = np.zeros((len(rows), len(cols)))
+        for a in range(len(rows)):
+            row = x.getrow(a)
+            sub = yc[:, row.indices].tocoo()
+            mins = np.minimum(sub.data, row.data[sub.col])
+            common[a] = np.bincount(sub.row, mins, minlength=len(cols))
+        total = np.asarray(x.sum(1)).ravel()[:, np.newaxis] + np.asarray(yc.sum(1)).ravel()[np.newaxis, :]
+        return self._normalise(np.maximum(total - 2 * common, 0), total, normalise)
+
+    def _restricted_pair(self, i, j, weighted, normalise, cache):
+        subset = self.leafmasks[i] & self.leafmasks[j]
+        splits = []
+        for k in (i, j):
+            key = (k, subset)
+            if key not in cache:
+                cache[key] = _restrict(self._splits[k], self.leafmasks[k], subset)
+            splits.append(cache[key])
+        a, b = splits
+        if weighted:
+            keys = set(a) | set(b)
+            dist = sum(abs(a.get(key, 0.0) - b.get(key, 0.0)) for key in keys)
+            total = sum(a.values()) + sum(b.values())
+        else:
+            nleaves = _popcount(subset)
+            sa, sb = _nontrivial(a, nleaves), _nontrivial(b, nleaves)
+            dist = len(sa ^ sb)
+            total = len(sa) + len(sb)
+        if normalise:
+            return dist / total if total > 0 else 0.0
+        return float(dist)
+
+    def _calc(self, weighted, normalise, min_overlap, overlap_fail_value, rooted, fallback):
+        n = len(self)
+        result = np.zeros((n, n))
+        special = self._special(weighted, rooted, fallback)
+
+        # Trees with the same leaf set
+        block_fn = self._wrf_block if weighted else self._rf_block
+        groups = self._groups(special)
+        for group in groups:
+            result[np.ix_(group, group)] = block_fn(group, normalise)
+
+        # Trees with different leaf sets
+        cache = {}
+        for g, group1 in enumerate(groups):
+            for group2 in groups[g + 1:]:
+                if _popcount(self.leafmasks[group1[0]] & self.leafmasks[group2[0]]) < min_overlap:
+                    result[np.ix_(group1, group2)] = overlap_fail_value
+                    result[np.ix_(group2, group1)] = overlap_fail_value
+                    continue
+                for i in group1:
+                    for j in group2:
+                        result[i, j] = result[j, i] = self._restricted_pair(i, j, weighted, normalise, cache)
+
+        # Anything else
+        for i in np.flatnonzero(special):
+            for j in range(n):
+                if j != i and not (special[j] and j < i):
+                    result[i, j] = result[j, i] = fallback(min(i, j), max(i, j))
+        np.fill_diagonal(result, 0)
+        return result
+
+    def _calc_block(self, rows, cols, weighted, normalise, min_overlap, overlap_fail_value, rooted, fallback):
+        result = np.zeros((len(rows), len(cols)))
+        special = self._special(weighted, rooted, fallback)
+        row_pos = dict((i, r) for (r, i) in enumerate(rows))
+        col_pos = dict((j, c) for (c, j) in enumerate(cols))
+
+        block_fn = self._wrf_rect if weighted else self._rf_rect
+        cache = {}
+        for group1 in self._groups(special, rows):
+            for group2 in self._groups(special, cols):
+                ix = np.ix_([row_pos[i] for i in group1], [col_pos[j] for j in group2])
+                leafmask1, leafmask2 = self.leafmasks[group1[0]], self.leafmasks[group2[0]]
+                if leafmask1 == leafmask2:
+                    result[ix] = block_fn(group1, group2, normalise)
+                elif _popcount(leafmask1 & leafmask2) < min_overlap:
+                    result[ix] = overlap_fail_value
+                else:
+                    for i in group1:
+                        for j in group2:
+                            result[row_pos[i], col_pos[j]] = self._restricted_pair(i, j, weighted, normalise, cache)
+
+        for r, i in enumerate(rows):
+            for c, j in enumerate(cols):
+                if i == j:
+                    result[r, c] = 0
+                elif special[i] or special[j]:
+                    result[r, c] = fallback(min(i, j), max(i, j))
+        return result
+
+    def rfdist_matrix(self, normalise=False, min_overlap=4, overlap_fail_value=0, rooted=False, fallback=None):
+        """
+        Robinson-Foulds distances between all pairs of trees.
+        :param normalise: boolean. Divide by the total number of nontrivial splits in the two trees.
+        :param min_overlap: int
+        :param overlap_fail_value: any
+        :param rooted: boolean. If True, trees with a bifurcating root are treated as rooted, and
+            are handed to `fallback`.
+        :param fallback: function (i, j) -> distance, called for pairs that can't be handled here
+        :return: numpy.array
+        """
+        return self._calc(False, normalise, min_overlap, overlap_fail_value, rooted, fallback)
+
+    def wrfdist_matrix(self, normalise=False, min_overlap=4, overlap_fail_value=0, rooted=False, fallback=None):
+        """
+        Weighted Robinson-Foulds distances between all pairs of trees.
+        :param normalise: boolean. Divide by the total branch length of the two trees.
+        :param min_overlap: int
+        :param overlap_fail_value: any
+        :param rooted: boolean. If True, trees with a bifurcating root are treated as rooted, and
+            are handed to `fallback`.
+        :param fallback: function (i, j) -> distance, called for pairs that can't be handled here
+        :return: numpy.array
+        """
+        return self._calc(True, normalise, min_overlap, overlap_fail_value, rooted, fallback)
+
+    def rfdist_block(self, rows, cols, normalise=False, min_overlap=4, overlap_fail_value=0, rooted=False,
+                     fallback=None):
+        """
+        Robinson-Foulds distances between each tree in `rows` and each tree in `cols`.
+        :param rows: list of tree indices
+        :param cols: list of tree indices
+        The other parameters are as for rfdist_matrix.
+        :return: numpy.array of shape (len(rows), len(cols))
+        """
+        return self._calc_block(rows, cols, False, normalise, min_overlap, overlap_fail_value, rooted, fallback)
+
+    def wrfdist_block(self, rows, cols, normalise=False, min_overlap=4, overlap_fail_value=0, rooted=False,
+                      fallback=None):
+        """
+        Weighted Robinson-Foulds distances between each tree in `rows` and each tree in `cols`.
+        :param rows: list of tree indices
+        :param cols: list of tree indices
+        The other parameters are as for wrfdist_matrix.
+        :return: numpy.array of shape (len(rows), len(cols))
+        """
+        return self._calc_block(rows, cols, True, normalise, min_overlap, overlap_fail_value, rooted, fallback)
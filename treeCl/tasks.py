@@ -13,13 +13,15 @@ from abc import ABCMeta, abstractmethod, abstractproperty
 from functools import reduce
 
 import phylo_utils
+from tree_distance import PhyloTree
 
 from . import treedist
+from .splits import SplitIndex
 from .tree import Tree
 from .alignment import Alignment, SequenceSimulator
 from .parameters import Parameters
 from .utils import fileIO, smooth_freqs
-from .constants import RANDOM_SEED
+from .constants import RANDOM_SEED, ISPY3
 from .wrappers.phylogenetics import FastTree, parse_fasttree_output, Raxml, Phyml
 from .parsers import RaxmlParser, PhymlParser
 import logging
@@ -43,6 +45,50 @@ class TaskInterface(with_metaclass(ABCMeta, object)):
     def name(self):
         return self._name
 
+class PhylipData(object):
+    """
+    An alignment as PHYLIP text, passed to a task in place of an alignment file name, for
+    records that aren't backed by a PHYLIP file on disk. The task feeds the text to the
+    program's standard input, where it can read from there, or writes it into the worker's
+    scratch directory.
+    """
+    def __init__(self, text):
+        self.text = text
+
+
+def alignment_input(rec):
+    """
+    The alignment argument to pass to an external program task: the path of the record's
+    PHYLIP file if it has one, otherwise the alignment as PhylipData. No temporary file is written.
+    """
+    filename = rec.find_alignment_file(as_phylip=True)
+    if filename is not None:
+        return filename
+    return PhylipData(rec.to_phylip_string())
+
+
+def _scratch_alignment(alignment):
+    """
+    Put the alignment in this worker's scratch directory (see fileIO.scratch_dir), so that
+    programs that write their output files next to their input do so in scratch space.
+    PhylipData is written out; an existing file is symlinked.
+    :param alignment: alignment file name, or PhylipData
+    :return: (path, in_scratch) - in_scratch is False if an existing file couldn't be linked,
+        in which case its own path is returned
+    """
+    with fileIO.TempFile(fileIO.scratch_dir(), disable_delete=True) as name:
+        pass
+    if isinstance(alignment, PhylipData):
+        with open(name, 'w') as fl:
+            fl.write(alignment.text)
+        return name, True
+    os.remove(name)
+    try:
+        os.symlink(os.path.abspath(alignment), name)
+    except (AttributeError, OSError):
+        return os.path.abspath(alignment), False
+    return name, True
+
 def eucdist_task(newick_string_a, newick_string_b, normalise, min_overlap=4, overlap_fail_value=0):
     """
     Distributed version of tree_distance.eucdist
@@ -79,7 +125,72 @@ def wrfdist_task(newick_string_a, newick_string_b, normalise, min_overlap=4, ove
     tree_b = Tree(newick_string_b)
     return treedist.wrfdist(tree_a, tree_b, normalise, min_overlap, overlap_fail_value)
 
+def encode_trees(metric, trees):
+    """
+    Parse a list of trees into the data structure needed by the tree distance metric `metric`: a treeCl.Tree
+    for the leafset-checking metrics ('euc', 'geo', 'rf', 'wrf') and a tree_distance.PhyloTree for the
+    'fast' variants. Trees that are already in the right form are passed through unchanged, so a list of
+    trees only needs to be encoded once, however many distances are calculated from it.
+    Parameters: a metric name and a list of newick strings (or Tree / PhyloTree objects)
+    """
+    if metric.startswith('fast'):
+        encoded = []
+        for t in trees:
+            if not isinstance(t, PhyloTree):
+                newick = t.newick if isinstance(t, Tree) else t
+                t = PhyloTree(newick.encode() if ISPY3 else newick, False)
+            encoded.append(t)
+        return encoded
+    return [t if isinstance(t, Tree) else Tree(t) for t in trees]
+
+def tree_distance_block_task(metric, rows, cols, normalise, min_overlap=4, overlap_fail_value=0, diagonal=False):
+    """
+    Calculates a rectangular block of the tree distance matrix.
+    Each tree in `rows` and `cols` is parsed at most once per block. If `diagonal` is True, `rows` and `cols`
+    are the same trees and only the strict upper triangle of the block is filled.
+    Parameters: a metric name ('euc', 'geo', 'rf', 'wrf' or their 'fast' equivalents), two lists of newick strings (or pre-encoded trees,
+    see encode_trees), a boolean, and the overlap parameters of treedist.eucdist
+    """
+    fn = _block_distance_fns[metric]
+    rows = encode_trees(metric, rows)
+    cols = rows if diagonal else encode_trees(metric, cols)
+    return treedist._generic_block_calc(fn, rows, cols, normalise, min_overlap, overlap_fail_value, diagonal)
+
+def split_distance_block_task(metric, rows, cols, normalise, min_overlap=4, overlap_fail_value=0, diagonal=False):
+    """
+    Calculates a block of the RF or weighted RF distance matrix, as tree_distance_block_task does, from a
+    treeCl.splits.SplitIndex of the block's trees. The few pairs the index can't handle itself are calculated
+    with the same functions as tree_distance_block_task.
+    Parameters: a metric name ('rf', 'wrf', 'fastrf' or 'fastwrf'), and otherwise as tree_distance_block_task,
+    except that pre-encoded trees must be treeCl.Tree objects
+    """
+    trees = encode_trees('rf', rows) + ([] if diagonal else encode_trees('rf', cols))
+    index = SplitIndex(trees)
+    fn = _block_distance_fns[metric]
+    encoded = {}
+
+    def fallback(i, j):
+        for k in (i, j):
+            if k not in encoded:
+                encoded[k] = encode_trees(metric, [trees[k]])[0]
+        return fn(encoded[i], encoded[j], normalise, min_overlap, overlap_fail_value)
+
+    weighted = metric.endswith('wrf')
+    rooted = not metric.startswith('fast')
+    if diagonal:
+        calc = index.wrfdist_matrix if weighted else index.rfdist_matrix
+        return calc(normalise, min_overlap, overlap_fail_value, rooted=rooted, fallback=fallback)
+    calc = index.wrfdist_block if weighted else index.rfdist_block
+    return calc(list(range(len(rows))), list(range(len(rows), len(trees))), normalise, min_overlap,
+                overlap_fail_value, rooted=rooted, fallback=fallback)
+
 ### TASKS that calculate trees
+def load_alignment_task(filename, file_format, backend='biopython'):
+    """
+    Read an alignment file, which may be gzip or bzip2 compressed
+    """
+    return Alignment(filename, file_format, backend=backend)
+
 def pll_task(alignment_file, partition_string, guidetree=None, tree_search=True, threads=1, seed=RANDOM_SEED, frequencies=None,
              write_to_file=None):
     try:
@@ -111,9 +222,10 @@ def pll_task(alignment_file, partition_string, guidetree=None, tree_search=True,
 def phyml_task(alignment_file, model, **kwargs):
     """
     Kwargs are passed to the Phyml process command line
+    :param alignment_file: alignment file name, or PhylipData
     """
     import re
-    fl = os.path.abspath(alignment_file)
+    alignment_file, in_scratch = _scratch_alignment(alignment_file)
     ph = Phyml(verbose=False)
     if model in ['JC69', 'K80', 'F81', 'F84', 'HKY85', 'TN93', 'GTR']:
         datatype = 'nt'
@@ -133,7 +245,9 @@ def phyml_task(alignment_file, model, **kwargs):
             expected_outfiles[i] += '.txt'
     logger.debug('Stats file {} {}'.format(expected_outfiles[0], 'exists' if os.path.exists(expected_outfiles[0]) else 'doesn\'t exist'))
     logger.debug('Tree file {} {}'.format(expected_outfiles[1], 'exists' if os.path.exists(expected_outfiles[1]) else 'doesn\'t exist'))
-    with fileIO.TempFileList(expected_outfiles):
+    # Scratch files are private to this worker, so their deletion can be batched
+    to_delete = expected_outfiles + [alignment_file] if in_scratch else expected_outfiles
+    with fileIO.TempFileList(to_delete, deferred=in_scratch):
         try:
             result = parser.to_dict(*expected_outfiles)
         except IOError as ioerr:
@@ -147,9 +261,10 @@ def phyml_task(alignment_file, model, **kwargs):
 def bionj_task(alignment_file, model, **kwargs):
     """
     Kwargs are passed to the Phyml process command line
+    :param alignment_file: alignment file name, or PhylipData
     """
     import re
-    fl = os.path.abspath(alignment_file)
+    alignment_file, in_scratch = _scratch_alignment(alignment_file)
     ph = Phyml(verbose=False)
     if model in ['JC69', 'K80', 'F81', 'F84', 'HKY85', 'TN93', 'GTR']:
         datatype = 'nt'
@@ -169,7 +284,9 @@ def bionj_task(alignment_file, model, **kwargs):
             expected_outfiles[i] += '.txt'
     logger.debug('Stats file {} {}'.format(expected_outfiles[0], 'exists' if os.path.exists(expected_outfiles[0]) else 'doesn\'t exist'))
     logger.debug('Tree file {} {}'.format(expected_outfiles[1], 'exists' if os.path.exists(expected_outfiles[1]) else 'doesn\'t exist'))
-    with fileIO.TempFileList(expected_outfiles):
+    # Scratch files are private to this worker, so their deletion can be batched
+    to_delete = expected_outfiles + [alignment_file] if in_scratch else expected_outfiles
+    with fileIO.TempFileList(to_delete, deferred=in_scratch):
         try:
             result = parser.to_dict(*expected_outfiles)
         except IOError as ioerr:
@@ -181,11 +298,19 @@ def bionj_task(alignment_file, model, **kwargs):
     return result
 
 def fasttree_task(alignment_file, dna=False):
-    fl = os.path.abspath(alignment_file)
+    """
+    FastTree reads PhylipData from stdin, and writes the tree to stdout and the model
+    parameters to stderr, so no files are used
+    :param alignment_file: alignment file name, or PhylipData
+    """
     fst = FastTree(verbose=False)
+    if isinstance(alignment_file, PhylipData):
+        fl, stdin = '', alignment_file.text
+    else:
+        fl, stdin = os.path.abspath(alignment_file), None
     cmd = '{} -gamma -pseudo {} {}'.format('-gtr' if dna else '-wag', '-nt' if dna else '', fl)
     logger.debug('{} {}'.format(fst.exe, cmd))
-    fst(cmd, wait=True)
+    fst(cmd, wait=True, stdin=stdin)
     tree = fst.get_stdout()
     result = parse_fasttree_output(fst.get_stderr())
     result['ml_tree'] = Tree(tree).newick
@@ -194,7 +319,7 @@ def fasttree_task(alignment_file, dna=False):
 
 def raxml_task(executable, alignment_file, model, partitions_file=None, outfile=None, threads=1, parsimony=False, fast_tree=False, n_starts=1):
     logger.debug('raxml_task: executable {}, alignment_file {}, model {}, partitions_file {}, outfile {}, threads {}, parsimony {}, fast_tree {}'.format(executable, alignment_file, model, partitions_file, outfile, threads, parsimony, fast_tree))
-    afl = os.path.abspath(alignment_file)
+    afl, in_scratch = _scratch_alignment(alignment_file)
     pfl = os.path.abspath(partitions_file) if partitions_file else None
     if threads > 1:
         if 'raxmlHPC' in executable and not 'PTHREADS' in executable:
@@ -207,7 +332,11 @@ def raxml_task(executable, alignment_file, model, partitions_file=None, outfile=
     # initialise RAxML wrapper
     rax = Raxml(executable, verbose=False)
 
-    with fileIO.TempDir(disable_delete=False) as tmpd, fileIO.TempFile(tmpd, disable_delete=False) as name:
+    # RAxML writes a .reduced alignment next to its input, if it removes duplicate sequences
+    scratch_files = [afl, afl + '.reduced'] if in_scratch else []
+    with fileIO.TempFileList(scratch_files, deferred=True), \
+            fileIO.TempDir(fileIO.scratch_dir(), disable_delete=False) as tmpd, \
+            fileIO.TempFile(tmpd, disable_delete=False) as name:
         name = os.path.basename(name)
         seed=random.randint(1000, 9999)
         outdir=os.path.abspath(tmpd)
@@ -404,10 +533,7 @@ class PhymlTaskInterface(TaskInterface):
         for rec in records:
             if model is None:
                 model = DEFAULT_DNA_MODEL if rec.is_dna() else DEFAULT_PROTEIN_MODEL
-            filename, delete = rec.get_alignment_file(as_phylip=True)
-            if delete:
-                to_delete.append(filename)
-            args.append((filename, model))
+            args.append((alignment_input(rec), model))
         return args, to_delete
 
     def get_task(self):
@@ -425,10 +551,7 @@ class BionjTaskInterface(TaskInterface):
         for rec in records:
             if model is None:
                 model = DEFAULT_DNA_MODEL if rec.is_dna() else DEFAULT_PROTEIN_MODEL
-            filename, delete = rec.get_alignment_file(as_phylip=True)
-            if delete:
-                to_delete.append(filename)
-            args.append((filename, model))
+            args.append((alignment_input(rec), model))
         return args, to_delete
 
     def get_task(self):
@@ -462,7 +585,8 @@ class RaxmlTaskInterface(TaskInterface):
             available to their system, and for the RAxML executable being used.
         :param parsimony: Use RAxML's parsimony tree search only
         :param fast_tree: Use RAxML's experimental fast tree search (-f E)
-        :return: (List of command line arguments, List of created temporary files)
+        :return: (List of command line arguments, List of created temporary files). Alignments without a
+            PHYLIP file on disk are passed as PhylipData, so the only temporary files are partition files.
         """
         args = []
         to_delete = []
@@ -473,18 +597,17 @@ class RaxmlTaskInterface(TaskInterface):
         for (rec, qfile, ofile) in zip(records, partition_files, outfiles):
             if model is None:
                 model = 'GTRGAMMA' if rec.is_dna() else 'PROTGAMMALGX'
-            filename, delete = rec.get_alignment_file(as_phylip=True)
-            if delete:
-                to_delete.append(filename)
-                to_delete.append(filename + '.reduced')
+            alignment = alignment_input(rec)
 
             if qfile is None:
                 # Attempt to find partition file on disk, using extension 'partitions.txt'
-                if filename.endswith('.phy'):
-                    likely_qfile = filename.replace('phy', 'partitions.txt')
+                if isinstance(alignment, PhylipData):
+                    likely_qfile = None
+                elif alignment.endswith('.phy'):
+                    likely_qfile = alignment.replace('phy', 'partitions.txt')
                 else:
-                    likely_qfile = filename + '.partitions.txt'
-                if os.path.exists(likely_qfile):
+                    likely_qfile = alignment + '.partitions.txt'
+                if likely_qfile is not None and os.path.exists(likely_qfile):
                     qfile = likely_qfile
                 else:
                     with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmpfile:
@@ -496,7 +619,7 @@ class RaxmlTaskInterface(TaskInterface):
                             name=rec.name, seqlen=len(rec))
                         tmpfile.write(partition_string)
 
-            args.append((executable, filename, model, qfile, ofile, threads, parsimony, fast_tree, n_starts))
+            args.append((executable, alignment, model, qfile, ofile, threads, parsimony, fast_tree, n_starts))
         return args, to_delete
 
     def get_task(self):
@@ -514,11 +637,7 @@ class FastTreeTaskInterface(TaskInterface):
         args = []
         to_delete = []
         for rec in records:
-            filename, delete = rec.get_alignment_file(as_phylip=True)
-            if delete:
-                to_delete.append(filename)
-
-            curr_args = (filename, rec.is_dna())
+            curr_args = (alignment_input(rec), rec.is_dna())
             args.append(curr_args)
         return args, to_delete
 
@@ -652,33 +771,56 @@ class SimulatorTaskInterface(TaskInterface):
 
 class TreeDistanceTaskInterface(with_metaclass(ABCMeta, TaskInterface)):
     _name = 'TreeDistance'
+    _metric = None
 
     def scrape_args(self, trees, normalise, min_overlap, overlap_fail_value):
         for (t1, t2) in itertools.combinations(trees, 2):
             yield (t1, t2, normalise, min_overlap, overlap_fail_value)
 
+    def scrape_block_args(self, trees, normalise, min_overlap, overlap_fail_value, tiles):
+        """
+        Yields one argument tuple for tree_distance_block_task per tile of the upper triangle
+        of the distance matrix (see treedist.tile_ranges)
+        """
+        for (row_start, row_stop, col_start, col_stop) in tiles:
+            diagonal = (row_start == col_start)
+            yield (self._metric, trees[row_start:row_stop], [] if diagonal else trees[col_start:col_stop],
+                   normalise, min_overlap, overlap_fail_value, diagonal)
 
     @abstractmethod
     def get_task(self):
         pass
 
+    def get_block_task(self):
+        return tree_distance_block_task
+
 class GeodesicTreeDistance(TreeDistanceTaskInterface):
     _name = 'GeodesicDistance'
+    _metric = 'geo'
     def get_task(self):
         return geodist_task
 
 class RobinsonFouldsTreeDistance(TreeDistanceTaskInterface):
     _name = 'RFDistance'
+    _metric = 'rf'
     def get_task(self):
         return rfdist_task
 
+    def get_block_task(self):
+        return split_distance_block_task
+
 class WeightedRobinsonFouldsTreeDistance(TreeDistanceTaskInterface):
     _name = 'WeightedRFDistance'
+    _metric = 'wrf'
     def get_task(self):
         return wrfdist_task
 
+    def get_block_task(self):
+        return split_distance_block_task
+
 class EuclideanTreeDistance(TreeDistanceTaskInterface):
     _name = 'EuclideanDistance'
+    _metric = 'euc'
     def get_task(self):
         return eucdist_task
 
@@ -686,38 +828,59 @@ class EuclideanTreeDistance(TreeDistanceTaskInterface):
 from tree_distance import getEuclideanDistance, getGeodesicDistance, getRobinsonFouldsDistance,\
     getWeightedRobinsonFouldsDistance
 
-def _fast_geo(tree1, tree2, normalise=False):
+# The overlap arguments are accepted for signature compatibility with the treedist functions, but are ignored:
+# these assume the leaf sets are already equal
+def _fast_geo(tree1, tree2, normalise=False, min_overlap=4, overlap_fail_value=0):
     return getGeodesicDistance(tree1, tree2, normalise)
 
-def _fast_euc(tree1, tree2, normalise=False):
+def _fast_euc(tree1, tree2, normalise=False, min_overlap=4, overlap_fail_value=0):
     return getEuclideanDistance(tree1, tree2, normalise)
 
-def _fast_rf(tree1, tree2, normalise=False):
+def _fast_rf(tree1, tree2, normalise=False, min_overlap=4, overlap_fail_value=0):
     return getRobinsonFouldsDistance(tree1, tree2, normalise)
 
-def _fast_wrf(tree1, tree2, normalise=False):
+def _fast_wrf(tree1, tree2, normalise=False, min_overlap=4, overlap_fail_value=0):
     return getWeightedRobinsonFouldsDistance(tree1, tree2, normalise)
 
+_block_distance_fns = {'euc': treedist.eucdist,
+                       'geo': treedist.geodist,
+                       'rf': treedist.rfdist,
+                       'wrf': treedist.wrfdist,
+                       'fasteuc': _fast_euc,
+                       'fastgeo': _fast_geo,
+                       'fastrf': _fast_rf,
+                       'fastwrf': _fast_wrf}
+
 
 class EqualLeafSetGeodesicTreeDistance(TreeDistanceTaskInterface):
     _name = 'GeodesicDistance'
+    _metric = 'fastgeo'
     def get_task(self):
         return _fast_geo
 
 
 class EqualLeafSetEuclideanTreeDistance(TreeDistanceTaskInterface):
     _name = 'EuclideanDistance'
+    _metric = 'fasteuc'
     def get_task(self):
         return _fast_euc
 
 
 class EqualLeafSetRobinsonFouldsTreeDistance(TreeDistanceTaskInterface):
     _name = 'RobinsonFouldsDistance'
+    _metric = 'fastrf'
     def get_task(self):
         return _fast_rf
 
+    def get_block_task(self):
+        return split_distance_block_task
+
 
 class EqualLeafSetWeightedRobinsonFouldsTreeDistance(TreeDistanceTaskInterface):
     _name = 'WeightedRobinsonFouldsDistance'
+    _metric = 'fastwrf'
     def get_task(self):
         return _fast_wrf
+
+    def get_block_task(self):
+        return split_distance_block_task
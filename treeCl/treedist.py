@@ -3,27 +3,69 @@ from __future__ import print_function
 # standard library
 import functools
 import itertools
+import json
+import os
+import time
+import weakref
 
 # third party
+import numpy as np
 import scipy.spatial
 from tree_distance import getEuclideanDistance, getGeodesicDistance, getRobinsonFouldsDistance,\
     getWeightedRobinsonFouldsDistance
 
 # treeCl
-from .utils import setup_progressbar
+from .distance_matrix import DistanceMatrix
+from .utils import setup_progressbar, LRUCache
 
 __all__ = ["eucdist", "eucdist_matrix", "geodist", "geodist_matrix", "rfdist", "rfdist_matrix", "wrfdist",
-           "wrfdist_matrix"]
+           "wrfdist_matrix", "tile_ranges", "fill_condensed", "TileCheckpoint"]
+
+DEFAULT_TILE_SIZE = 256
+
+# Minimum number of seconds between updates of a TileCheckpoint's manifest
+CHECKPOINT_INTERVAL = 30
+
+# Rough memory footprint of a pruned tree (dendropy nodes, edges and taxa, plus
+# the PhyloTree), per leaf
+_PRUNED_TREE_BYTES_PER_LEAF = 4096
+
+# Trees pruned to a leaf subset by _equalise_leaf_sets, keyed on (id(tree), frozenset(subset)).
+# In a matrix of trees with patchy leaf sets, many pairs share the same intersection, so the same
+# pruned trees (and their PhyloTree encodings) are needed over and over.
+# Resize with prune_cache.resize(max_bytes=...), or empty it with prune_cache.clear().
+prune_cache = LRUCache(max_bytes=256 * 1024 ** 2)
+
+
+def _cached_prune(tree, subset):
+    """
+    Returns `tree` pruned to the leaves in `subset`, reusing a previously pruned copy if
+    there is one. Cached copies are discarded if the original tree has been modified since
+    (or has been garbage collected and its id reused).
+    """
+    key = (id(tree), frozenset(subset))
+    entry = prune_cache.get(key)
+    if entry is not None:
+        ref, phylotree, pruned = entry
+        if ref() is tree and not tree._dirty and tree._phylotree is phylotree:
+            return pruned
+        prune_cache.discard(key)
+    pruned = tree.prune_to_subset(subset, False)
+    if not tree._dirty:
+        prune_cache.set(key, (weakref.ref(tree), tree._phylotree, pruned),
+                        len(subset) * _PRUNED_TREE_BYTES_PER_LEAF)
+    return pruned
 
 
 def _equalise_leaf_sets(t1, t2, inplace):
     intersect = t1 & t2
+    prune = (lambda t: t.prune_to_subset(intersect, True)) if inplace else (lambda t: _cached_prune(t, intersect))
     if t1.labels != intersect:
-        pruned1 = t1.prune_to_subset(intersect, inplace)
+        pruned1 = prune(t1)
     else:
         pruned1 = t1
     if t2.labels != intersect:
-        pruned2 = t2.prune_to_subset(intersect, inplace)
+        pruned2 = prune(t2)
     else:
         pruned2 = t2
     return pruned1, pruned2
@@ -72,7 +114,149 @@ def _generic_distance_calc(fn, t1, t2, normalise, min_overlap=4, overlap_fail_va
     return fn(t1.phylotree, t2.phylotree, normalise)
 
 
-def _generic_matrix_calc(fn, trees, normalise, min_overlap=4, overlap_fail_value=0, show_progress=True):
+def _generic_block_calc(fn, rows, cols, normalise, min_overlap=4, overlap_fail_value=0, diagonal=False):
+    """(fn, rows, cols, normalise)
+
+    Calculates the rectangular block of distances between each tree in `rows` and each tree in `cols`.
+    The trees should already be parsed (Tree objects, or PhyloTree objects for the fast, non-leafset-checking
+    distance functions), so that no tree is parsed more than once however many pairs it takes part in.
+    If `diagonal` is True then `rows` and `cols` are the same trees, and only the strict upper triangle of the
+    block is calculated (the rest is left as zero).
+
+    :param rows: sequence of Tree objects
+    :param cols: sequence of Tree objects
+    :param normalise: boolean
+    :param min_overlap: int
+    :param overlap_fail_value: any
+    :param diagonal: boolean
+    :return: numpy.array of shape (len(rows), len(cols))
+    """
+    block = np.zeros((len(rows), len(cols)))
+    for i, t1 in enumerate(rows):
+        start = i + 1 if diagonal else 0
+        for j in range(start, len(cols)):
+            block[i, j] = fn(t1, cols[j], normalise, min_overlap, overlap_fail_value)
+    return block
+
+
+def tile_ranges(n, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Splits the upper triangle of an n x n pairwise matrix into square tiles of side `tile_size`.
+    Returns a list of (row_start, row_stop, col_start, col_stop) tuples. Tiles on the diagonal
+    (row_start == col_start) only contribute their strict upper triangle.
+    """
+    starts = list(range(0, n, tile_size))
+    return [(r, min(r + tile_size, n), c, min(c + tile_size, n))
+            for r in starts for c in starts if c >= r]
+
+
+def condensed_index(n, i, j):
+    """
+    Position of the (i, j) element, i < j, of an n x n symmetric matrix in its condensed
+    (scipy.spatial.distance.squareform) representation
+    """
+    return n * i - (i * (i + 1)) // 2 + j - i - 1
+
+
+def fill_condensed(condensed, n, tile, block):
+    """
+    Writes a block of distances, as returned by _generic_block_calc for the given
+    tile = (row_start, row_stop, col_start, col_stop), into its place in the condensed distance vector.
+    Alters `condensed` in place.
+    """
+    row_start, row_stop, col_start, col_stop = tile
+    block = np.asarray(block)
+    for i in range(row_start, row_stop):
+        first = max(col_start, i + 1)
+        if first >= col_stop:
+            continue
+        pos = condensed_index(n, i, first)
+        condensed[pos:pos + col_stop - first] = block[i - row_start, first - col_start:]
+    return condensed
+
+
+class TileCheckpoint(object):
+    """
+    On-disk state of a distance matrix calculation done in tiles (see tile_ranges), so that it
+    can be resumed after an interruption. Distances are written into a memory-mapped condensed
+    array in a .npy file, and the finished tiles are listed in a small JSON manifest,
+    <filename>.manifest.json, together with the settings of the calculation. Once every tile is
+    finished, the names are written too, so the file can be read with DistanceMatrix.load.
+    """
+
+    def __init__(self, filename, names, settings, tile_size=DEFAULT_TILE_SIZE, interval=CHECKPOINT_INTERVAL):
+        """
+        :param filename: Path of the .npy file. If it exists, with a manifest, the calculation is resumed.
+            If it exists without one, a ValueError is raised rather than overwriting it.
+        :param names: Names of the rows of the distance matrix
+        :param settings: Dict of anything (JSON-serialisable) that affects the distances. Resuming a
+            checkpoint made with different settings, names or tile size raises a ValueError.
+        :param tile_size: Passed to tile_ranges
+        :param interval: Minimum number of seconds between updates of the manifest
+        """
+        self.filename = filename
+        self.manifest_file = '{}.manifest.json'.format(filename)
+        self.names = [str(name) for name in names]
+        self.n = len(self.names)
+        self.tiles = tile_ranges(self.n, tile_size)
+        self.settings = dict(settings, n=self.n, tile_size=tile_size)
+        self.interval = interval
+        self._last_save = time.time()
+        manifest = self._read_manifest()
+        if manifest is not None and os.path.exists(filename):
+            if (json.dumps(manifest['settings'], sort_keys=True) != json.dumps(self.settings, sort_keys=True)
+                    or manifest['names'] != self.names):
+                raise ValueError('Checkpoint {} was made by a different calculation: {}. Remove it to start '
+                                 'again.'.format(filename, manifest['settings']))
+            self.array = np.load(filename, mmap_mode='r+')
+            self.done = set(manifest['done'])
+        elif os.path.exists(filename):
+            raise ValueError('{} exists, but has no checkpoint manifest ({}) - it was not written by a checkpointed '
+                             'calculation. Remove it, or use another file.'.format(filename, self.manifest_file))
+        else:
+            self.array = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64,
+                                                   shape=(self.n * (self.n - 1) // 2,))
+            self.done = set()
+            self.save()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_file) as handle:
+                return json.load(handle)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @property
+    def remaining(self):
+        """ Indices, into self.tiles, of the tiles still to do """
+        return [i for i in range(len(self.tiles)) if i not in self.done]
+
+    @property
+    def complete(self):
+        return len(self.done) == len(self.tiles)
+
+    def update(self, i, block):
+        """ Writes the block of distances for tile i, and updates the manifest if it's due """
+        fill_condensed(self.array, self.n, self.tiles[i], block)
+        self.done.add(i)
+        if self.complete or time.time() - self._last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        """ Flushes the distances to disk, then records the finished tiles """
+        self.array.flush()
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as handle:
+            json.dump({'settings': self.settings, 'names': self.names, 'done': sorted(self.done)}, handle)
+        os.rename(tmp, self.manifest_file)
+        if self.complete:
+            with open(DistanceMatrix.names_file(self.filename), 'w') as handle:
+                json.dump(self.names, handle)
+        self._last_save = time.time()
+
+
+def _generic_matrix_calc(fn, trees, normalise, min_overlap=4, overlap_fail_value=0, show_progress=True,
+                         tile_size=DEFAULT_TILE_SIZE):
     """(fn, trees, normalise)
 
     Calculates all pairwise distances between trees given in the parameter 'trees'.
@@ -92,23 +276,34 @@ def _generic_matrix_calc(fn, trees, normalise, min_overlap=4, overlap_fail_value
         getRobinsonFouldsDistance
         getWeightedRobinsonFouldsDistance
 
+    The pairs are visited in square tiles of side `tile_size`, and written straight into the
+    condensed distance vector.
+
     :param trees: list or tuple, or some other iterable container type containing Tree objects
     :param normalise: boolean
     :param min_overlap: int
+    :param tile_size: int
     :return: numpy.array
     """
-    jobs = itertools.combinations(trees, 2)
-    results = []
+    trees = list(trees)
+    n = len(trees)
+    tiles = tile_ranges(n, tile_size)
+    condensed = np.zeros(n * (n - 1) // 2)
     if show_progress:
-        pbar = setup_progressbar('Calculating tree distances', 0.5 * len(trees) * (len(trees) - 1))
+        pbar = setup_progressbar('Calculating tree distances', len(tiles))
         pbar.start()
-    for i, (t1, t2) in enumerate(jobs):
-        results.append(_generic_distance_calc(fn, t1, t2, normalise, min_overlap, overlap_fail_value))
+    for i, tile in enumerate(tiles, start=1):
+        row_start, row_stop, col_start, col_stop = tile
+        block = _generic_block_calc(functools.partial(_generic_distance_calc, fn),
+                                    trees[row_start:row_stop], trees[col_start:col_stop],
+                                    normalise, min_overlap, overlap_fail_value,
+                                    diagonal=(row_start == col_start))
+        fill_condensed(condensed, n, tile, block)
         if show_progress:
             pbar.update(i)
     if show_progress:
         pbar.finish()
-    return scipy.spatial.distance.squareform(results)
+    return scipy.spatial.distance.squareform(condensed)
 
 eucdist = functools.partial(_generic_distance_calc, getEuclideanDistance)
 geodist = functools.partial(_generic_distance_calc, getGeodesicDistance)
@@ -1,3 +1,5 @@
 from .misc import *
 from .enum import enum
-from .printing import print_and_return
\ No newline at end of file
+from .printing import print_and_return
+from .lrucache import LRUCache
+from .resultindex import ResultIndex
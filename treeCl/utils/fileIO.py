@@ -6,6 +6,7 @@ from builtins import range
 from builtins import object
 # standard library
 import bz2
+import errno
 import pickle
 import glob
 import gzip
@@ -13,6 +14,7 @@ import io
 import os
 import shutil
 import tempfile
+from multiprocessing.util import Finalize
 from subprocess import Popen, PIPE
 
 # treeCl
@@ -22,7 +24,11 @@ __all__ = [
     'TempFile',
     'TempDir',
     'ChDir',
-    'TempFileList'
+    'TempFileList',
+    'scratch_dir',
+    'remove_scratch',
+    'clean_stale_scratch',
+    'flush_deferred',
     'basename',
     'can_locate',
     'can_open',
@@ -62,11 +68,14 @@ class TempFile(object):
 
 class TempDir(object):
 
-    def __init__(self, disable_delete=False):
+    def __init__(self, dir_=None, disable_delete=False):
         self.disable_delete = disable_delete
+        if dir_ is not None and not os.path.exists(dir_):
+            raise IOError('Directory "{}" does not exist'.format(dir_))
+        self.dir = dir_
 
     def __enter__(self):
-        self._wrapped_tmpdir = tempfile.mkdtemp()
+        self._wrapped_tmpdir = tempfile.mkdtemp(dir=self.dir)
         return os.path.abspath(self._wrapped_tmpdir)
 
     def __exit__(self, type, value, tb):
@@ -75,21 +84,108 @@ class TempDir(object):
 
 
 class TempFileList(object):
+    """
+    Deletes a list of files on exit. With deferred=True the files are queued for deletion
+    instead, and removed in one batch once enough have accumulated, or when the process
+    exits (see flush_deferred). This suits workers that run many short jobs.
+    """
 
-    def __init__(self, filelist, disable_delete=False):
+    def __init__(self, filelist, disable_delete=False, deferred=False):
         self._filelist = filelist
         self.disable_delete = disable_delete
+        self.deferred = deferred
 
     def __enter__(self):
         return self._filelist
 
     def __exit__(self, type, value, tb):
-        for fl in self._filelist:
-            try:
-                if not self.disable_delete:
-                    os.remove(fl)
-            except:
-                pass  # No need to crash if deletion fails, just ignore
+        if self.disable_delete:
+            return
+        if self.deferred:
+            queue = _deferred.setdefault(os.getpid(), [])
+            queue.extend(self._filelist)
+            if len(queue) >= DEFERRED_DELETE_BATCH:
+                flush_deferred()
+        else:
+            _remove_files(self._filelist)
+
+
+# Files queued by TempFileList(deferred=True), and scratch directories, keyed by the owning
+# process id, so that forked workers don't act on anything inherited from their parent
+DEFERRED_DELETE_BATCH = 100
+_deferred = {}
+_scratch = {}
+
+
+def _remove_files(filelist):
+    for fl in filelist:
+        try:
+            os.remove(fl)
+        except:
+            pass  # No need to crash if deletion fails, just ignore
+
+
+def flush_deferred():
+    """
+    Delete all the files queued for deletion by this process
+    """
+    _remove_files(_deferred.pop(os.getpid(), []))
+
+
+def _cleanup_scratch(pid):
+    flush_deferred()
+    path = _scratch.pop(pid, None)
+    if path is not None:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _scratch_parent():
+    shm = '/dev/shm'
+    return shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else tempfile.gettempdir()
+
+
+def scratch_dir():
+    """
+    A scratch directory private to the current process, created on first use - in memory
+    (/dev/shm) where that is available, otherwise in the system temp directory. The directory,
+    and any files this process queued with TempFileList(deferred=True), are removed when the
+    process exits, including when it is a multiprocessing worker. The directory name includes
+    the process id, so that whatever is left behind by a process that was killed can be removed
+    with remove_scratch or clean_stale_scratch.
+    :return: absolute path of the directory
+    """
+    pid = os.getpid()
+    if pid not in _scratch:
+        _scratch[pid] = os.path.abspath(tempfile.mkdtemp(prefix='treeCl_{}_'.format(pid), dir=_scratch_parent()))
+        Finalize(None, _cleanup_scratch, args=(pid,), exitpriority=0)
+    return _scratch[pid]
+
+
+def remove_scratch(pid):
+    """
+    Remove the scratch directories of process `pid`, which must have exited
+    (e.g. a worker process that was terminated)
+    """
+    for path in glob.glob(os.path.join(_scratch_parent(), 'treeCl_{}_*'.format(pid))):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def clean_stale_scratch():
+    """
+    Remove scratch directories left behind by processes that no longer exist
+    """
+    for path in glob.glob(os.path.join(_scratch_parent(), 'treeCl_*_*')):
+        pid = os.path.basename(path).split('_')[1]
+        if pid.isdigit() and not _pid_exists(int(pid)):
+            shutil.rmtree(path, ignore_errors=True)
 
 
 class ChDir(object):
@@ -0,0 +1,79 @@
+from builtins import object
+from collections import OrderedDict
+import threading
+
+__all__ = ['LRUCache']
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache with an optional cap on the number of entries
+    and on the (estimated) total size of the entries, in bytes.
+    Entry sizes are supplied by the caller when the entry is added.
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxsize=None, max_bytes=None):
+        """
+        :param maxsize: int. Maximum number of entries (None for no limit)
+        :param max_bytes: int. Maximum total size of entries (None for no limit)
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """ Return the value for key, marking it as recently used, or default if it isn't cached """
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0):
+        """ Add a value to the cache, evicting least-recently-used entries to stay under the limits """
+        with self._lock:
+            self.discard(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def resize(self, maxsize=None, max_bytes=None):
+        """ Change the limits, evicting entries if necessary """
+        with self._lock:
+            self.maxsize = maxsize
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self._data and ((self.maxsize is not None and len(self._data) > self.maxsize) or
+                              (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, (_, size) = self._data.popitem(last=False)
+            self.nbytes -= size
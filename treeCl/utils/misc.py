@@ -25,6 +25,7 @@ __all__ = ['concatenate',
            'alignment_to_partials',
            'biopython_to_partials',
            'create_gamma_model',
+           'WeightedGammaMixture',
            'weighted_choice',
            'sample_wr']
 
@@ -178,10 +179,22 @@ def biopython_to_partials(alignment, datatype):
         partials_dict[seq.name] = seq_to_partials(seq, datatype)
     return partials_dict
 
-def create_gamma_model(alignment, missing_data=None, ncat=4):
+class WeightedGammaMixture(GammaMixture):
+    """ GammaMixture over site patterns: each pattern's log likelihood
+    is multiplied by the number of sites it stands for """
+    def __init__(self, alpha, ncat, site_weights):
+        super(WeightedGammaMixture, self).__init__(alpha, ncat)
+        self.site_weights = np.asarray(site_weights, dtype=np.double)
+
+    def get_likelihood(self):
+        return (self.get_sitewise_likelihoods().ravel() * self.site_weights).sum()
+
+
+def create_gamma_model(alignment, missing_data=None, ncat=4, compress=True):
     """ Create a phylo_utils.likelihood.GammaMixture for calculating
     likelihood on a tree, from a treeCl.Alignment and its matching 
-    treeCl.Parameters """
+    treeCl.Parameters. If compress is True, the model is built on
+    the alignment's site patterns (see Alignment.get_site_patterns) """
     model = alignment.parameters.partitions.model
     freqs = alignment.parameters.partitions.frequencies
     alpha = alignment.parameters.partitions.alpha
@@ -195,8 +208,13 @@ def create_gamma_model(alignment, missing_data=None, ncat=4):
     else:
         raise ValueError("Can't handle this model: {}".format(model))
     tm = TransitionMatrix(subs_model)
-    gamma = GammaMixture(alpha, ncat)
-    gamma.init_models(tm, alignment_to_partials(alignment, missing_data))
+    if compress:
+        patterns, weights = alignment.get_site_patterns()
+        gamma = WeightedGammaMixture(alpha, ncat, weights)
+        gamma.init_models(tm, alignment_to_partials(patterns, missing_data))
+    else:
+        gamma = GammaMixture(alpha, ncat)
+        gamma.init_models(tm, alignment_to_partials(alignment, missing_data))
     return gamma
 
 def weighted_choice(choices):
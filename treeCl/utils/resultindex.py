@@ -0,0 +1,80 @@
+from builtins import object
+import json
+import os
+import sqlite3
+import threading
+
+__all__ = ['ResultIndex']
+
+
+class ResultIndex(object):
+    """
+    Maps result ids to JSON-serialisable result records, in a single SQLite file.
+    Lookups are by primary key, so finding a result never scans a directory, and the
+    index persists between runs.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: path of the SQLite database (created if it doesn't exist)
+        """
+        self.filename = filename
+        self._local = threading.local()
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS results '
+                               '(id TEXT PRIMARY KEY, task TEXT, result TEXT)')
+
+    @property
+    def _conn(self):
+        """
+        The connection of the calling thread, opened on first use. SQLite connections
+        can't be shared between threads or processes, so each thread (and a forked child)
+        gets its own.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.filename)
+            self._local.pid = os.getpid()
+        return conn
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._local = threading.local()
+
+    def __contains__(self, id_):
+        return self._conn.execute('SELECT 1 FROM results WHERE id = ?', (id_,)).fetchone() is not None
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def get(self, id_, default=None):
+        row = self._conn.execute('SELECT result FROM results WHERE id = ?', (id_,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def put(self, id_, task, result):
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO results (id, task, result) VALUES (?, ?, ?)',
+                               (id_, task, json.dumps(result)))
+
+    def discard(self, id_):
+        with self._conn:
+            self._conn.execute('DELETE FROM results WHERE id = ?', (id_,))
+
+    def ids(self, task=None):
+        if task is None:
+            rows = self._conn.execute('SELECT id FROM results')
+        else:
+            rows = self._conn.execute('SELECT id FROM results WHERE task = ?', (task,))
+        return [row[0] for row in rows]
+
+    def close(self):
+        """ Close the calling thread's connection. It is reopened if the index is used again. """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -158,6 +158,30 @@ class AbstractWrapper(with_metaclass(ABCMeta, object)):
         t.start()
         self.threads.append(t)
 
+    def _feed_thread(self, pipe, data):
+        """
+        Start a thread writing data to pipe (the process's stdin), then closing it
+        so the process sees end-of-file
+        """
+
+        def feed(out, d):
+            try:
+                out.write(d)
+            except (IOError, OSError):
+                pass  # the process exited without reading all its input
+            finally:
+                try:
+                    out.close()
+                except (IOError, OSError):
+                    pass
+
+        if not isinstance(data, bytes):
+            data = data.encode(DEFAULT_ENCODING)
+        t = threading.Thread(target=feed, args=(pipe, data))
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
     def _search_for_executable(self, executable):
         """
         Search for file give in "executable". If it is not found, we try the environment PATH.
@@ -176,11 +200,13 @@ class AbstractWrapper(with_metaclass(ABCMeta, object)):
                     return os.path.abspath(exe)
 
     # Public
-    def __call__(self, cmd=None, wait=False, **flags):
+    def __call__(self, cmd=None, wait=False, stdin=None, **flags):
         """
         Spawns the subprocess and the threads used to monitor stdout and stderr without blocking.
         :param cmd: Pass the command line arguments as a string
         :param wait: Block until the process returns
+        :param stdin: String (or bytes) to write to the process's standard input, for programs that
+            can read their input data from stdin instead of a file
         :param flags: Pass the commandline arguments as a dictionary. Will be appended to any content in cmd.
 
         :return:
@@ -202,13 +228,16 @@ class AbstractWrapper(with_metaclass(ABCMeta, object)):
 
         # spawn
         self.process = Popen(shlex.split(self.cmd),
-                             shell=False, stdout=PIPE, stderr=PIPE, bufsize=1, close_fds=POSIX)
+                             shell=False, stdin=None if stdin is None else PIPE, stdout=PIPE, stderr=PIPE,
+                             bufsize=1, close_fds=POSIX)
         if self.verbose:
             print('Launched {} with PID {}'.format(self.exe, self.process.pid))
 
-        # start stdout and stderr logging threads
+        # start stdout and stderr logging threads, and feed stdin, if given
         self._log_thread(self.process.stdout, self.stdout_q)
         self._log_thread(self.process.stderr, self.stderr_q)
+        if stdin is not None:
+            self._feed_thread(self.process.stdin, stdin)
 
         if wait:
             self.process.wait()